@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import gzip
+import json
+import hashlib
+import time
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import shutil
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+import downloadDB
+from downloadDB import GenomeDownloader
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    # HTTP/1.1 so that clients can keep connections alive
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+class RangeHandler(QuietHandler):
+    """
+    Also serves Range: bytes=N- requests. With interrupt_bytes set, the first
+    transfer of each .fna.gz is cut off after that many bytes, as if the
+    connection dropped; with throttle_bps, each connection sends at most that
+    many bytes per second.
+    """
+    interrupt_bytes = 0
+    throttle_bps = 0
+    bytes_served = 0
+    interrupted = set()
+    lock = threading.Lock()
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if not match or not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        if start >= size:
+            self.send_error(416)
+            return None
+        f = open(path, "rb")
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        self.send_header("Content-Length", str(size - start))
+        self.end_headers()
+        return f
+
+    def copyfile(self, source, outputfile):
+        limit = -1
+        if self.interrupt_bytes and self.path.endswith(".fna.gz"):
+            with self.lock:
+                if self.path not in self.interrupted:
+                    self.interrupted.add(self.path)
+                    limit = self.interrupt_bytes
+        data = source.read(limit)
+        step = max(self.throttle_bps // 20, 1) if self.throttle_bps else max(len(data), 1)
+        for start in range(0, len(data), step):
+            piece = data[start:start + step]
+            outputfile.write(piece)
+            if self.throttle_bps:
+                time.sleep(len(piece) / self.throttle_bps)
+        with self.lock:
+            RangeHandler.bytes_served += len(data)
+        if limit != -1:
+            self.close_connection = True
+
+class WgetDownloader(GenomeDownloader):
+    """
+    The previous download path: one wget process per genome and attempt.
+    """
+
+    def salvar_genoma(self, metadata, output_path, retries=downloadDB.RETRIES):
+        url = f"{metadata['ftp_path']}/{os.path.basename(metadata['ftp_path'])}_genomic.fna.gz"
+        temp_gz = f"{output_path}.gz"
+        subprocess.run(["wget", "-O", temp_gz, "-q", "--tries=3", "--timeout=15", url], check=True)
+        with gzip.open(temp_gz, "rb") as f_in, open(output_path, "wb") as f_out:
+            f_out.write(f_in.read())
+        os.remove(temp_gz)
+        self.successful_downloads.add(metadata["file_name"])
+        return True
+
+class FifoDownloader(GenomeDownloader):
+    """
+    Downloads in list order on a fixed pool of MAX_WORKERS threads, as before
+    the largest-first scheduler.
+    """
+
+    def executar_downloads(self, identifiers):
+        self.assembly_data.carregar(identifiers)
+        with ThreadPoolExecutor(max_workers=downloadDB.MAX_WORKERS) as executor:
+            for gcf, result in zip(identifiers, executor.map(self.baixar_genoma, identifiers)):
+                if not result:
+                    self.failed_downloads.add(gcf)
+        self.http.fechar()
+
+class TwoPassDownloader(GenomeDownloader):
+    """
+    The pooled download before streaming decompression: the .fna.gz is written
+    to disk and decompressed in a second pass. The genomes are not registered,
+    so the taxonomy step reads each .fna a third time for its headers.
+    """
+
+    def salvar_genoma(self, metadata, output_path, retries=downloadDB.RETRIES):
+        url = f"{metadata['ftp_path']}/{os.path.basename(metadata['ftp_path'])}_genomic.fna.gz"
+        temp_gz = f"{output_path}.gz"
+        with open(temp_gz, "wb") as f_gz:
+            self.http.baixar(url, f_gz)
+        with gzip.open(temp_gz, "rb") as f_in, open(output_path, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(temp_gz)
+        self.successful_downloads.add(metadata["file_name"])
+        return True
+
+def io_counters():
+    # Bytes this process passed through read()/write() calls (Linux only)
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError):
+        return None, None
+
+def generate_genomes(root, base_url, genomes, genome_kb, seed=1, large=0, large_kb=0):
+    """
+    Write gzipped synthetic genomes in the NCBI FTP layout under root, and
+    assembly summaries pointing at base_url. The last `large` genomes have
+    large_kb KB instead of genome_kb. Returns the accessions.
+    """
+    rng = random.Random(seed)
+    accessions = []
+    cache_dir = os.path.join(root, "cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, "assembly_summary_refseq.txt"), "w") as summary:
+        summary.write("#assembly_accession\tbioproject\n")
+        for number in range(genomes):
+            accession = f"GCF_{number:09d}.1"
+            name = f"{accession}_ASM{number}v1"
+            directory = os.path.join(root, "genomes", name)
+            os.makedirs(directory, exist_ok=True)
+            size_kb = large_kb if number >= genomes - large else genome_kb
+            sequence = "".join(rng.choices("ACGT", k=size_kb * 1024))
+            genome_file = os.path.join(directory, f"{name}_genomic.fna.gz")
+            with gzip.open(genome_file, "wt", compresslevel=1) as out:
+                out.write(f">NZ_{number:08d}.1 synthetic\n")
+                for start in range(0, len(sequence), 80):
+                    out.write(sequence[start:start + 80] + "\n")
+            with open(genome_file, "rb") as f, open(os.path.join(directory, "md5checksums.txt"), "w") as out:
+                out.write(f"{hashlib.md5(f.read()).hexdigest()}  ./{name}_genomic.fna.gz\n")
+            columns = [accession, f"ASM{number}v1"] + [""] * 3 + [str(2 + number)] + [""] + [f"Organism {number}"]
+            columns += [""] * 11 + [f"{base_url}/genomes/{name}"] + [""] * 5 + [str(len(sequence))]
+            summary.write("\t".join(columns) + "\n")
+            accessions.append(accession)
+    open(os.path.join(cache_dir, "assembly_summary_genbank.txt"), "w").close()
+    return accessions
+
+def run(downloader_class, root, accessions, label):
+    output_dir = os.path.join(root, f"out_{label}")
+    os.makedirs(output_dir, exist_ok=True)
+    downloader = downloader_class(output_dir, os.path.join(root, "cache"))
+    RangeHandler.interrupted.clear()
+    RangeHandler.bytes_served = 0
+    read_before, written_before = io_counters()
+    start = time.perf_counter()
+    downloader.executar_downloads(accessions)
+    seconds = time.perf_counter() - start
+    downloader.create_detailed_taxonomy_from_directory(os.path.join(root, f"taxonomy_{label}.tsv"))
+    taxonomy_seconds = time.perf_counter() - start - seconds
+    read_after, written_after = io_counters()
+    report = {
+        "downloader": label,
+        "genomes": len(downloader.successful_downloads),
+        "failed": len(downloader.failed_downloads),
+        "seconds": round(seconds, 3),
+        "genomes_per_second": round(len(downloader.successful_downloads) / seconds, 1),
+        "taxonomy_seconds": round(taxonomy_seconds, 3),
+        "pool_connections": downloader.http.conexoes_abertas,
+        "verified": sum(genome["verified"] for genome in downloader.manifest.genomas()),
+        "bytes_served": RangeHandler.bytes_served,
+    }
+    if read_before is not None:
+        # Includes the local HTTP server threads, which serve the same bytes for every downloader
+        report.update(bytes_read=read_after - read_before, bytes_written=written_after - written_before)
+    return report
+
+def run_scheduler(jobs, job_ms):
+    """
+    Times the scheduler alone on more jobs than its concurrency limit, each a
+    sleep of job_ms; ideal is jobs / limit * job_ms.
+    """
+    http = downloadDB.HTTPConnectionPool()
+    scheduler = downloadDB.DownloadScheduler(lambda job: time.sleep(job_ms / 1000), http)
+    start = time.perf_counter()
+    results = scheduler.executar({job: 1 for job in range(jobs)})
+    seconds = time.perf_counter() - start
+    return {
+        "downloader": "scheduler",
+        "jobs": len(results),
+        "job_ms": job_ms,
+        "limit": downloadDB.CONCORRENCIA_INICIAL,
+        "seconds": round(seconds, 3),
+        "ideal_seconds": round(-(-jobs // downloadDB.CONCORRENCIA_INICIAL) * job_ms / 1000, 3),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Genomes per second of the scheduled streaming HTTP downloader "
+                                                 "against list-order, two-pass and one-wget-per-genome "
+                                                 "downloads, served by a local HTTP server")
+    parser.add_argument("--genomes", type=int, default=300, help="Number of synthetic genomes")
+    parser.add_argument("--genome-kb", type=int, default=64, help="Uncompressed size of each genome in KB")
+    parser.add_argument("--large-genomes", type=int, default=0,
+                        help="Make the last genomes of the list this many large ones")
+    parser.add_argument("--large-kb", type=int, default=8192, help="Uncompressed size of each large genome in KB")
+    parser.add_argument("--downloader", choices=["pool", "fifo", "twopass", "wget"], nargs="+",
+                        default=["pool", "fifo", "twopass", "wget"],
+                        help="Download paths to time")
+    parser.add_argument("--interrupt-kb", type=int, default=0,
+                        help="Cut the first transfer of every genome after this many KB, to time resumed "
+                             "downloads")
+    parser.add_argument("--throttle-kbps", type=int, default=0,
+                        help="Limit each server connection to this many KB per second")
+
+    parser.add_argument("--scheduler-jobs", type=int, default=200,
+                        help="Also time the scheduler alone on this many sleep jobs (0 to skip)")
+    parser.add_argument("--scheduler-job-ms", type=int, default=10, help="Duration of each scheduler job in ms")
+
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.scheduler_jobs:
+        report = run_scheduler(args.scheduler_jobs, args.scheduler_job_ms)
+        report.update(timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"), python=platform.python_version())
+        print(json.dumps(report))
+
+    with tempfile.TemporaryDirectory() as root:
+        RangeHandler.interrupt_bytes = args.interrupt_kb * 1024
+        RangeHandler.throttle_bps = args.throttle_kbps * 1024
+        server = ThreadingHTTPServer(("127.0.0.1", 0), partial(RangeHandler, directory=root))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        accessions = generate_genomes(root, base_url, args.genomes, args.genome_kb, large=args.large_genomes,
+                                      large_kb=args.large_kb)
+
+        classes = {"pool": GenomeDownloader, "fifo": FifoDownloader, "twopass": TwoPassDownloader,
+                   "wget": WgetDownloader}
+        for label in args.downloader:
+            report = run(classes[label], root, accessions, label)
+            report.update(timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"), python=platform.python_version(),
+                          genome_kb=args.genome_kb, large_genomes=args.large_genomes,
+                          large_kb=args.large_kb, interrupt_kb=args.interrupt_kb,
+                          throttle_kbps=args.throttle_kbps)
+            print(json.dumps(report))
+        server.shutdown()
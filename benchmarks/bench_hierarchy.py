@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import random
+import platform
+import resource
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+from synthetic import generate_taxdump
+from taxonomy_hierarchy import generate_taxonomy_hierarchy, load_snapshot, update_taxonomy_hierarchy
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def rename_taxa(names_file, count, seed=1):
+    # Renames count random taxa, as a monthly taxdump refresh would
+    with open(names_file, encoding="utf-8") as f:
+        lines = f.readlines()
+    scientific = [number for number, line in enumerate(lines) if "\tscientific name\t" in line]
+    for number in random.Random(seed).sample(scientific, min(count, len(scientific))):
+        taxid, name, rest = lines[number].split("\t|\t", 2)
+        lines[number] = f"{taxid}\t|\t{name} renamed\t|\t{rest}"
+    with open(names_file, "w", encoding="utf-8") as out:
+        out.writelines(lines)
+
+def time_update(workdir):
+    start = time.perf_counter()
+    output_file = os.path.join(workdir, "taxonomy_hierarchy.tsv")
+    update_taxonomy_hierarchy(os.path.join(workdir, "names.dmp"), os.path.join(workdir, "nodes.dmp"),
+                              os.path.join(workdir, "merged.dmp"), os.path.join(workdir, "delnodes.dmp"),
+                              output_file, load_snapshot(output_file))
+    return round(time.perf_counter() - start, 4)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time taxonomy_hierarchy.tsv generation from a synthetic "
+                                                 "NCBI taxdump")
+    parser.add_argument("--depth", type=int, default=12, help="Depth of the synthetic tree")
+    parser.add_argument("--branching", type=int, default=5, help="Maximum children per taxon")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed of the generator")
+    parser.add_argument("--workdir", help="Directory for the synthetic taxdump (default: temporary)")
+    parser.add_argument("--renamed", type=int, default=100,
+                        help="Then rename this many taxa and time the incremental update, and an update "
+                             "with an unchanged taxdump (0 to skip)")
+
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        workdir = args.workdir or temp_dir
+        taxa = generate_taxdump(workdir, depth=args.depth, branching=args.branching, seed=args.seed)
+        start = time.perf_counter()
+        generate_taxonomy_hierarchy(os.path.join(workdir, "names.dmp"), os.path.join(workdir, "nodes.dmp"),
+                                    os.path.join(workdir, "taxonomy_hierarchy.tsv"))
+        report = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "taxa": taxa,
+            "depth": args.depth,
+            "seconds": round(time.perf_counter() - start, 4),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        if args.renamed:
+            rename_taxa(os.path.join(workdir, "names.dmp"), args.renamed)
+            report.update(renamed=args.renamed, update_seconds=time_update(workdir),
+                          unchanged_update_seconds=time_update(workdir))
+        print(json.dumps(report))
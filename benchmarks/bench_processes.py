@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+import classificationminimap
+from synthetic import generate_dataset
+
+def run(paths, output_file, processes, streaming, engine):
+    start = time.perf_counter()
+    classificationminimap.main_process(
+        paths["paf"], paths["taxonomy"], paths["hierarchy"], output_file,
+        processes=processes, streaming=streaming, engine=engine
+    )
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Classifier throughput as a function of --processes")
+    parser.add_argument("--queries", type=int, default=200000, help="Number of synthetic queries")
+    parser.add_argument("--hits-per-query", type=int, default=5, help="Mean hits per query")
+    parser.add_argument("--references", type=int, default=2000, help="Number of synthetic references")
+    parser.add_argument("--branching", type=int, default=6,
+                        help="Maximum children per taxon (controls taxonomy size)")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="Process counts to benchmark")
+    parser.add_argument("--streaming", action="store_true", help="Benchmark the streaming mode")
+    parser.add_argument("--engine", choices=["python", "numpy"], default="python", help="Scoring engine")
+    parser.add_argument("--workdir", help="Directory for the synthetic data (default: temporary)")
+
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        workdir = args.workdir or temp_dir
+        paths = generate_dataset(workdir, queries=args.queries, hits_per_query=args.hits_per_query,
+                                 references=args.references, branching=args.branching)
+        output_file = os.path.join(workdir, "classified_sequences.tsv")
+
+        baseline = None
+        for processes in args.processes:
+            elapsed = run(paths, output_file, processes, args.streaming, args.engine)
+            baseline = baseline or elapsed
+            print(json.dumps({
+                "processes": processes,
+                "queries": args.queries,
+                "seconds": round(elapsed, 3),
+                "queries_per_second": round(args.queries / elapsed, 1),
+                "speedup": round(baseline / elapsed, 2),
+            }))
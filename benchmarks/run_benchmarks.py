@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+import platform
+import resource
+import tempfile
+from functools import partial
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+import batch_scoring
+import classification_core
+import classificationmashmap
+import classificationminimap
+from synthetic import generate_dataset
+
+# The classifiers' largest chunk (see choose_chunksize)
+CHUNK_SIZE = 2000
+
+PARSERS = {
+    "paf": classificationminimap.parse_paf_file,
+    "mashmap": classificationmashmap.parse_mashmap_file,
+}
+
+LINE_PARSERS = {
+    "paf": (classificationminimap.parse_paf_line, "PAF"),
+    "mashmap": (classificationmashmap.parse_mashmap_line, "Mashmap"),
+}
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+class StageTimer:
+    def __init__(self):
+        self.stages = []
+
+    def run(self, name, function, *args, items=None):
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        result = function(*args)
+        wall = time.perf_counter() - start_wall
+        count = items(result) if items else None
+        self.stages.append({
+            "stage": name,
+            "seconds": round(wall, 4),
+            "cpu_seconds": round(time.process_time() - start_cpu, 4),
+            "items": count,
+            "items_per_second": round(count / wall, 1) if count is not None and wall > 0 else None,
+            "peak_rss_mb": peak_rss_mb(),
+        })
+        return result
+
+def benchmark(paths, input_format, max_candidates, output_file, engine="python"):
+    """
+    Time the load, parse, classify and write stages of one classifier in-process.
+
+    Classification runs in this process through the pool worker functions, so
+    the numbers exclude multiprocessing overhead and are comparable across runs.
+    With the numpy engine, classify covers the whole worker side (scoring and
+    formatting the chunks) and write only what the main process does.
+    """
+    logging.getLogger().setLevel(logging.WARNING)
+    parse = PARSERS[input_format]
+    timer = StageTimer()
+
+    taxonomy, hierarchy = timer.run("load", classification_core.load_taxonomy, paths["taxonomy"], paths["hierarchy"],
+                                    items=lambda result: len(result[0]))
+    if engine == "numpy":
+        # The columnar counterpart of the parser: a HitTable instead of the query map
+        parse = partial(batch_scoring.read_hit_table, parse_line=LINE_PARSERS[input_format][0],
+                        source=LINE_PARSERS[input_format][1])
+    query_map, ref_abundance = timer.run("parse", parse, paths[input_format],
+                                         items=lambda result: len(result[0]))
+
+    def classify():
+        classification_core.init_worker(ref_abundance, taxonomy, hierarchy, max_candidates)
+        if engine == "numpy":
+            return [batch_scoring.process_batch(task)[1][0] for task in enumerate(query_map.batches(CHUNK_SIZE))]
+        return [classification_core.process_query(task) for task in query_map.items()]
+
+    results = timer.run("classify", classify, items=lambda result: len(query_map))
+
+    def write():
+        with open(output_file, "w") as f:
+            writer = csv.writer(f, delimiter="\t")
+            writer.writerow(["Query", "Confidence", "Lineage", "Taxonomic Level"])
+            if engine == "numpy":
+                for formatted in results:
+                    batch_scoring.write_formatted(f, None, formatted)
+            else:
+                classification_core.write_results(writer, results, max_candidates)
+        return results
+
+    timer.run("write", write, items=lambda result: len(query_map))
+    return timer.stages
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-stage benchmark of the classification scripts "
+                                                 "on synthetic data")
+    parser.add_argument("--format", choices=sorted(PARSERS), nargs="+", default=sorted(PARSERS),
+                        help="Alignment formats to benchmark")
+    parser.add_argument("--queries", type=int, default=100000, help="Number of synthetic queries")
+    parser.add_argument("--hits-per-query", type=int, default=5, help="Mean hits per query")
+    parser.add_argument("--references", type=int, default=2000, help="Number of synthetic references")
+    parser.add_argument("--depth", type=int, default=8, help="Lineage depth of the synthetic taxonomy")
+    parser.add_argument("--branching", type=int, default=4,
+                        help="Maximum children per taxon (controls taxonomy size)")
+    parser.add_argument("--max-candidates", type=int, default=5, help="Candidates kept per query")
+    parser.add_argument("--engine", choices=["python", "numpy"], default="python", help="Scoring engine")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed of the generators")
+    parser.add_argument("--workdir", help="Directory for the synthetic data (default: temporary)")
+    parser.add_argument("--output", help="Append the JSON report to this file (default: stdout)")
+
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        workdir = args.workdir or temp_dir
+        paths = generate_dataset(workdir, queries=args.queries, hits_per_query=args.hits_per_query,
+                                 references=args.references, depth=args.depth, branching=args.branching,
+                                 seed=args.seed, mashmap="mashmap" in args.format)
+
+        for input_format in args.format:
+            # A fresh interpreter per format, since ru_maxrss only ever grows
+            with multiprocessing.get_context("spawn").Pool(1) as pool:
+                stages = pool.apply(benchmark, (paths, input_format, args.max_candidates,
+                                                os.path.join(workdir, f"classified_{input_format}.tsv"),
+                                                args.engine))
+            report = json.dumps({
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "format": input_format,
+                "engine": args.engine,
+                "queries": args.queries,
+                "hits_per_query": args.hits_per_query,
+                "references": args.references,
+                "depth": args.depth,
+                "branching": args.branching,
+                "total_seconds": round(sum(stage["seconds"] for stage in stages), 4),
+                "stages": stages,
+            })
+            if args.output:
+                with open(args.output, "a") as out:
+                    out.write(report + "\n")
+            else:
+                print(report)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+import os
+import random
+
+RANKS = ['superkingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species', 'strain']
+
+def generate_taxonomy(path, depth=8, branching=3, seed=1):
+    """
+    Write a synthetic taxonomy_hierarchy.tsv and return the TaxIDs of its leaves.
+    """
+    rng = random.Random(seed)
+    ranks = [RANKS[level] if level < len(RANKS) else "no rank" for level in range(depth)]
+    next_taxid = 2
+    leaves = []
+
+    with open(path, "w", encoding="utf-8") as out:
+        out.write("TaxID\tName\tRank\tParentTaxID\tLineage\n")
+        out.write("1\troot\tno rank\t1\t\n")
+        # Depth-first, so only the current path has to be kept in memory
+        stack = [(1, "", 0)]
+        while stack:
+            parent, parent_lineage, level = stack.pop()
+            if level == depth:
+                leaves.append(parent)
+                continue
+            for _ in range(rng.randint(1, branching)):
+                taxid = next_taxid
+                next_taxid += 1
+                name = f"Taxon {taxid}"
+                entry = f"{ranks[level]}:{name}"
+                lineage = f"{parent_lineage};{entry}" if parent_lineage else entry
+                out.write(f"{taxid}\t{name}\t{ranks[level]}\t{parent}\t{lineage}\n")
+                stack.append((taxid, lineage, level + 1))
+
+    return leaves
+
+def generate_taxdump(directory, depth=8, branching=3, seed=1):
+    """
+    Write synthetic NCBI nodes.dmp and names.dmp files and return the number of TaxIDs.
+
+    Rows are shuffled, as TaxIDs in the real dump are not in parent-first order.
+    """
+    rng = random.Random(seed)
+    ranks = [RANKS[level] if level < len(RANKS) else "no rank" for level in range(depth)]
+    nodes = [(1, 1, "no rank")]
+    stack = [(1, 0)]
+    while stack:
+        parent, level = stack.pop()
+        if level == depth:
+            continue
+        for _ in range(rng.randint(1, branching)):
+            taxid = len(nodes) + 1
+            nodes.append((taxid, parent, ranks[level]))
+            stack.append((taxid, level + 1))
+    rng.shuffle(nodes)
+
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "nodes.dmp"), "w", encoding="utf-8") as out:
+        for taxid, parent, rank in nodes:
+            out.write(f"{taxid}\t|\t{parent}\t|\t{rank}\t|\t\t|\t0\t|\t1\t|\t11\t|\t1\t|\t0\t|\t1\t|\t0\t|\t0\t|\t\t|\n")
+    with open(os.path.join(directory, "names.dmp"), "w", encoding="utf-8") as out:
+        for taxid, _, _ in nodes:
+            name = "root" if taxid == 1 else f"Taxon {taxid}"
+            out.write(f"{taxid}\t|\t{name}\t|\t\t|\tscientific name\t|\n")
+            out.write(f"{taxid}\t|\tsynonym {taxid}\t|\t\t|\tsynonym\t|\n")
+    return len(nodes)
+
+def generate_detailed_taxonomy(path, leaves, references=1000, sequences_per_reference=3, seed=2):
+    """
+    Write a synthetic detailed_taxonomy.tsv and return the reference sequence IDs.
+    """
+    rng = random.Random(seed)
+    ref_ids = []
+    with open(path, "w", encoding="utf-8") as out:
+        out.write("GCF\tTaxID\tIdentifiers\n")
+        for reference in range(references):
+            identifiers = [f"NZ_{reference:08d}.{sequence}" for sequence in range(sequences_per_reference)]
+            ref_ids.extend(identifiers)
+            out.write(f"GCF_{reference:09d}.1\t{rng.choice(leaves)}\t{';'.join(identifiers)}\n")
+    return ref_ids
+
+def _hits(rng, ref_ids, queries, hits_per_query, max_query_len):
+    # Skew reference popularity so the abundance weighting has something to do
+    popular = ref_ids[:max(1, len(ref_ids) // 20)]
+    for query in range(queries):
+        query_id = f"read_{query:010d}"
+        query_len = rng.randint(max_query_len // 10, max_query_len)
+        for _ in range(rng.randint(1, hits_per_query * 2 - 1)):
+            ref_id = rng.choice(popular) if rng.random() < 0.5 else rng.choice(ref_ids)
+            align_len = rng.randint(query_len // 10, query_len)
+            start = rng.randint(0, query_len - align_len)
+            yield query_id, query_len, start, start + align_len, ref_id
+
+def generate_paf(path, ref_ids, queries=10000, hits_per_query=5, max_query_len=10000, seed=3):
+    """
+    Write a synthetic minimap2 PAF file with hits grouped by query.
+    """
+    rng = random.Random(seed)
+    lines = 0
+    with open(path, "w") as out:
+        for query_id, query_len, start, end, ref_id in _hits(rng, ref_ids, queries, hits_per_query, max_query_len):
+            align_len = end - start
+            out.write(f"{query_id}\t{query_len}\t{start}\t{end}\t+\t{ref_id}\t5000000\t0\t{align_len}\t"
+                      f"{align_len}\t{align_len}\t60\ttp:A:P\n")
+            lines += 1
+    return lines
+
+def generate_mashmap(path, ref_ids, queries=10000, hits_per_query=5, max_query_len=10000, seed=4):
+    """
+    Write a synthetic MashMap output file (PAF columns plus id:f: identity).
+    """
+    rng = random.Random(seed)
+    lines = 0
+    with open(path, "w") as out:
+        for query_id, query_len, start, end, ref_id in _hits(rng, ref_ids, queries, hits_per_query, max_query_len):
+            align_len = end - start
+            identity = 0.995 if rng.random() < 0.1 else round(rng.uniform(0.8, 0.99), 3)
+            out.write(f"{query_id}\t{query_len}\t{start}\t{end}\t+\t{ref_id}\t5000000\t0\t{align_len}\t"
+                      f"50\t{align_len}\t60\tid:f:{identity}\tkc:f:0.9\n")
+            lines += 1
+    return lines
+
+def generate_dataset(directory, queries=10000, hits_per_query=5, references=1000, depth=8, branching=3, seed=1,
+                     mashmap=False):
+    """
+    Generate a complete synthetic dataset in directory and return the file paths.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = {
+        "hierarchy": os.path.join(directory, "taxonomy_hierarchy.tsv"),
+        "taxonomy": os.path.join(directory, "detailed_taxonomy.tsv"),
+        "paf": os.path.join(directory, "resultados.paf"),
+    }
+    leaves = generate_taxonomy(paths["hierarchy"], depth=depth, branching=branching, seed=seed)
+    ref_ids = generate_detailed_taxonomy(paths["taxonomy"], leaves, references=references, seed=seed + 1)
+    generate_paf(paths["paf"], ref_ids, queries=queries, hits_per_query=hits_per_query, seed=seed + 2)
+    if mashmap:
+        paths["mashmap"] = os.path.join(directory, "mashmap.out")
+        generate_mashmap(paths["mashmap"], ref_ids, queries=queries, hits_per_query=hits_per_query, seed=seed + 3)
+    return paths
@@ -22,10 +22,12 @@ system("wget -q -O $taxonomy_files_dir/taxdmp.zip $taxdmp_url");
 
 # Unzip the downloaded file
 print "Unzipping taxonomy files...\n";
-system("unzip -q $taxonomy_files_dir/taxdmp.zip -d $taxonomy_files_dir");
+system("unzip -o -q $taxonomy_files_dir/taxdmp.zip -d $taxonomy_files_dir");
 
-# Execute the Python script
+# Execute the Python script. An existing taxonomy_hierarchy.tsv is updated
+# incrementally (taxonomy_hierarchy.py --full rebuilds it), and the index of
+# the classifiers is patched in place or compiled when missing.
 print "Executing Python script...\n";
-system("python3 $scripts_dir/taxonomy_hierarchy.py");
+system("python3 $scripts_dir/taxonomy_hierarchy.py --index $base_path/data/taxonomy_hierarchy.idx");
 
 print "Configuration completed.\n";
\ No newline at end of file
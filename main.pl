@@ -4,6 +4,7 @@ use warnings;
 use Time::HiRes qw(time);
 use Cwd 'abs_path';
 use Getopt::Long;
+use JSON::PP;
 
 # User-configurable parameters
 my $mash_threshold_refseq = 0.98;   # Threshold for RefSeq
@@ -11,10 +12,26 @@ my $mash_threshold_gtdb = 0.98;     # Threshold for GTDB
 my $mash_threshold_custom = 0.98;  # Threshold for custom database
 my $classification_processes = 8;    # Number of processes for classification
 my $max_top_candidates = 5;          # Default maximum number of top candidates to show
+my $classification_mode = "top";     # "top" candidates or their "lca"
+my $pipe_alignments = 0;             # Classify minimap2 output as it is produced (no resultados.paf)
+my $paf_archive = "";                # With --pipe, also keep the raw PAF here (gzip)
+my $profile_classifiers = 0;         # Dump cProfile stats of the classifiers into the output directory
+my $parquet_output = 0;              # Also write Parquet result stores (requires pyarrow)
+my $memory_budget = 0;               # MB; MashMap classification spills to disk beyond this (0 = in memory)
+my $classification_server = "";      # Socket of a running classification_server.py to send jobs to
+my $genome_cache_gb = 0;             # Disk limit of data/downloaded_genomes; least recently used genomes are removed (0 = no limit)
 
 # Get command line options
 GetOptions(
     "max-candidates=i" => \$max_top_candidates,
+    "mode=s" => \$classification_mode,
+    "pipe!" => \$pipe_alignments,
+    "paf-archive=s" => \$paf_archive,
+    "profile!" => \$profile_classifiers,
+    "parquet!" => \$parquet_output,
+    "memory-budget=i" => \$memory_budget,
+    "server=s" => \$classification_server,
+    "genome-cache-gb=f" => \$genome_cache_gb,
     # You can add other options here if needed
 ) or die "Error in command line arguments\n";
 
@@ -23,6 +40,8 @@ $max_top_candidates = 1 if $max_top_candidates < 1;
 $max_top_candidates = 10 if $max_top_candidates > 10;  # Setting a reasonable upper limit
 print "Maximum top candidates to display: $max_top_candidates\n";
 
+die "Error: --mode must be 'top' or 'lca'\n" unless $classification_mode =~ /^(top|lca)$/;
+
 # Base paths
 my $base_path = '.';
 
@@ -46,6 +65,19 @@ my $minimap_script = "$base_path/scripts/minimap2.sh";
 my $mashmap_script = "$base_path/scripts/mashmap.sh";
 my $classification_minimap = "$base_path/scripts/classificationminimap.py";
 my $classification_mashmap = "$base_path/scripts/classificationmashmap.py";
+my $index_script = "$base_path/scripts/taxonomy_index.py";
+my $results_store_script = "$base_path/scripts/results_store.py";
+my $profile_script = "$base_path/scripts/abundance_profile.py";
+my $client_script = "$base_path/scripts/classification_client.py";
+
+# With --server, classification jobs go to a long-running classification_server.py
+# (started with the same taxonomy) instead of loading the taxonomy for every run
+my $run_minimap_classifier = "python3 '$classification_minimap'";
+my $run_mashmap_classifier = "python3 '$classification_mashmap'";
+if ($classification_server) {
+    die "Error: no classification server listening on $classification_server\n" unless -S $classification_server;
+    $run_minimap_classifier = $run_mashmap_classifier = "python3 '$client_script' --socket '$classification_server'";
+}
 
 # MASH sketch files
 my %sketch_files = (
@@ -57,6 +89,9 @@ my %sketch_files = (
 # Important files
 my $taxonomy_file = "$data_dir/detailed_taxonomy.tsv";
 my $hierarchy_file = "$data_dir/taxonomy_hierarchy.tsv";
+my $hierarchy_index = "$data_dir/taxonomy_hierarchy.idx";   # Built by config.pl
+my $taxonomy_index = "$data_dir/taxonomy.idx";
+my $pruned_hierarchy = "$output_dir/taxonomy_hierarchy.pruned.tsv";   # Only this run's TaxIDs and ancestors
 
 # Create directories if they don't exist
 mkdir $output_dir unless -d $output_dir;
@@ -64,6 +99,34 @@ mkdir $data_dir unless -d $data_dir;
 mkdir "$data_dir/downloaded_genomes" unless -d "$data_dir/downloaded_genomes";
 mkdir $cache_dir unless -d $cache_dir;
 
+# Every Python stage appends its metrics here; see scripts/run_metrics.py
+my $stage_metrics = "$output_dir/stage_metrics.jsonl";
+my $run_report = "$output_dir/run_report.json";
+unlink $stage_metrics if -e $stage_metrics;
+$ENV{HYMET_METRICS} = $stage_metrics;
+my @step_metrics;
+
+# Run a pipeline step and record its wall time and CPU time (own and children's).
+# The code may return a hash ref of counts to add to the record.
+sub timed_step {
+    my ($name, $code) = @_;
+    my $wall_start = time();
+    my @cpu_start = times();
+    my $counts = $code->();
+    my @cpu_end = times();
+    my %record = (
+        step => $name,
+        wall_seconds => sprintf("%.3f", time() - $wall_start) + 0,
+        cpu_seconds => sprintf("%.3f", ($cpu_end[0] + $cpu_end[1]) - ($cpu_start[0] + $cpu_start[1])) + 0,
+        children_cpu_seconds => sprintf("%.3f", ($cpu_end[2] + $cpu_end[3]) - ($cpu_start[2] + $cpu_start[3])) + 0,
+    );
+    %record = (%record, %$counts) if ref $counts eq 'HASH';
+    push @step_metrics, \%record;
+    printf "Step %s took %.2f seconds\n", $name, $record{wall_seconds};
+}
+
+sub file_size { my ($file) = @_; return (-s $file) || 0; }
+
 sub run_command {
     my ($command) = @_;
     print "Executing: $command\n";
@@ -85,11 +148,16 @@ sub safe_concat {
     my ($output_file, @input_files) = @_;
     unlink $output_file if -e $output_file;
     
-    # Method 1: Use find + xargs (better for many files)
+    # Method 1: xargs over a NUL-separated list of exactly these files (better
+    # for many files). The directory is never globbed: genomes live in the
+    # shared cache, next to those of other runs.
     if (scalar(@input_files) > 100) {
-        my $input_dir = $input_files[0];
-        $input_dir =~ s/\/[^\/]+$//;
-        run_command("find '$input_dir' -type f -name '*.fna' -print0 | xargs -0 cat > '$output_file'");
+        my $list_file = "$output_file.list";
+        open(my $list, '>', $list_file) or die "Cannot create $list_file: $!";
+        print $list "$_\0" foreach @input_files;
+        close $list;
+        run_command("xargs -0 cat < '$list_file' > '$output_file'");
+        unlink $list_file;
     }
     # Method 2: Process directly in Perl (for few files)
     else {
@@ -143,40 +211,71 @@ foreach my $db (keys %sketch_files) {
     my $out_prefix = "$output_dir/$db";
     push @selected_genomes_files, "${out_prefix}_selected.txt";
     
-    run_command("$mash_script '$input_dir' '$sketch_files{$db}' ".
-               "'${out_prefix}_screen.tab' '${out_prefix}_filtered.tab' ".
-               "'${out_prefix}_sorted.tab' '${out_prefix}_top_hits.tab' ".
-               "'${out_prefix}_selected.txt' $threshold");
+    timed_step("mash_screen_$db", sub {
+        run_command("$mash_script '$input_dir' '$sketch_files{$db}' ".
+                   "'${out_prefix}_screen.tab' '${out_prefix}_filtered.tab' ".
+                   "'${out_prefix}_sorted.tab' '${out_prefix}_top_hits.tab' ".
+                   "'${out_prefix}_selected.txt' $threshold");
+        return { bytes_read => file_size($sketch_files{$db}), bytes_written => file_size("${out_prefix}_screen.tab") };
+    });
 }
 
 # Step 4: Combine results from all three databases
-safe_concat("$output_dir/combined_selected.txt", @selected_genomes_files);
-run_command("sort -u -o '$output_dir/selected_genomes.txt' '$output_dir/combined_selected.txt'");
+timed_step("combine_selections", sub {
+    safe_concat("$output_dir/combined_selected.txt", @selected_genomes_files);
+    run_command("sort -u -o '$output_dir/selected_genomes.txt' '$output_dir/combined_selected.txt'");
+    return { bytes_written => file_size("$output_dir/selected_genomes.txt") };
+});
 
 # Verify if the combined genome list was generated
 unless (-s "$output_dir/selected_genomes.txt") {
     die "ERROR: Failed to generate combined selected genomes list";
 }
 
-# Step 5: Download genomes
-run_command("python3 '$download_script' '$output_dir/selected_genomes.txt' ".
-           "'$data_dir/downloaded_genomes' '$taxonomy_file' '$cache_dir'");
+# Step 5: Download genomes. data/downloaded_genomes is a cache shared by all runs;
+# this run only sees the genomes listed in its own manifest
+my $genome_manifest = "$output_dir/genome_manifest.tsv";
+timed_step("download", sub {
+    run_command("python3 '$download_script' '$output_dir/selected_genomes.txt' ".
+               "'$data_dir/downloaded_genomes' '$taxonomy_file' '$cache_dir' ".
+               "'$hierarchy_file' '$pruned_hierarchy' --run-manifest '$genome_manifest' ".
+               "--cache-limit-gb $genome_cache_gb");
+});
+
+# Link this run's accessions into the compiled taxonomy index, if available;
+# otherwise the classifiers load the pruned hierarchy instead of the full tree
+my $taxonomy_args = "--taxonomy '$taxonomy_file' --hierarchy '$pruned_hierarchy'";
+if (-e $hierarchy_index) {
+    timed_step("index_build", sub {
+        run_command("python3 '$index_script' --base-index '$hierarchy_index' ".
+                   "--taxonomy '$taxonomy_file' --output '$taxonomy_index'");
+        return { bytes_read => file_size($taxonomy_file), bytes_written => file_size($taxonomy_index) };
+    });
+    $taxonomy_args = "--index '$taxonomy_index'";
+}
 
-# Step 6: Analyze downloaded genomes
+# Step 6: Analyze this run's genomes, from the manifest written by the download step
 my $large_count = 0;
 my $small_count = 0;
 my @large_genomes;
 my @small_genomes;
 
-opendir(my $dh, "$data_dir/downloaded_genomes") or die "Cannot open directory: $!";
-while (my $file = readdir $dh) {
-    next unless $file =~ /\.fna$/;
-    my $filepath = "$data_dir/downloaded_genomes/$file";
+open(my $mh, '<', $genome_manifest) or die "Cannot open genome manifest $genome_manifest: $!";
+chomp(my $manifest_header = <$mh> // '');
+my @manifest_columns = split /\t/, $manifest_header;
+my %column;
+@column{@manifest_columns} = (0 .. $#manifest_columns);
+die "Unexpected genome manifest header in $genome_manifest\n"
+    unless defined $column{file_name} && defined $column{total_bases};
+while (my $line = <$mh>) {
+    chomp $line;
+    my @fields = split /\t/, $line, -1;
+    my $filepath = "$data_dir/downloaded_genomes/$fields[$column{file_name}]";
     
-    # Estimate genome size
-    my $size = -s $filepath;
+    # Genome size in bases
+    my $size = $fields[$column{total_bases}];
     
-    if ($size > 1_000_000_000) { # >1GB
+    if ($size > 1_000_000_000) { # >1 Gbp
         push @large_genomes, $filepath;
         $large_count++;
     } else {
@@ -184,7 +283,7 @@ while (my $file = readdir $dh) {
         $small_count++;
     }
 }
-closedir $dh;
+close $mh;
 
 my $total_genomes = $large_count + $small_count;
 my $large_proportion = $total_genomes > 0 ? ($large_count / $total_genomes) * 100 : 0;
@@ -193,41 +292,90 @@ print "====================================\n";
 print " DOWNLOADED GENOME STATISTICS\n";
 print "====================================\n";
 print " Total genomes: $total_genomes\n";
-print " Large genomes (>1GB): $large_count ($large_proportion%)\n";
+print " Large genomes (>1 Gbp): $large_count ($large_proportion%)\n";
 print " Small genomes: $small_count\n";
 print "====================================\n";
 
+# Each classifier also writes a CAMI abundance profile of its queries; Step 8 merges them
+my $sample_id = $input_dir =~ s/\/+$//r =~ s/.*\///r;
+my @profiles;
+
 # Step 7: Execute appropriate workflow based on size
 if ($large_proportion > 70) {
     print "Predominance of large genomes (>70%), using MashMap\n";
     
     # Concatenate inputs for MashMap (safe method)
     my $concatenated_input = "$output_dir/concatenated_input.fasta";
-    safe_concat($concatenated_input, @input_files);
+    timed_step("concatenate_inputs", sub {
+        safe_concat($concatenated_input, @input_files);
+        return { files => scalar(@input_files), bytes_written => file_size($concatenated_input) };
+    });
     print "Input genomes concatenated into $concatenated_input for MashMap.\n";
 
     # Process each large genome
     foreach my $genome (@large_genomes) {
         my $base = $genome =~ s/.*\/([^\/]+)\.fna$/$1/r;
-        run_command("$mashmap_script '$concatenated_input' '$genome' '$output_dir/${base}_mashmap.out' 8");
-        run_command("python3 '$classification_mashmap' --mashmap '$output_dir/${base}_mashmap.out' ".
-                   "--taxonomy '$taxonomy_file' --hierarchy '$hierarchy_file' ".
-                   "--output '$output_dir/${base}_classified.tsv' --processes 8 ".
-                   "--max-candidates $max_top_candidates");
+        timed_step("alignment_$base", sub {
+            run_command("$mashmap_script '$concatenated_input' '$genome' '$output_dir/${base}_mashmap.out' 8");
+            return { bytes_written => file_size("$output_dir/${base}_mashmap.out") };
+        });
+        my $profile_args = $profile_classifiers ? "--profile '$output_dir/${base}_classification.prof' " : "";
+        $profile_args .= "--parquet '$output_dir/${base}_classified.parquet' " if $parquet_output;
+        $profile_args .= "--abundance-profile '$output_dir/${base}_profile.cami' --sample-id '$sample_id' ";
+        push @profiles, "'$output_dir/${base}_profile.cami'";
+        $profile_args .= "--memory-budget $memory_budget " if $memory_budget > 0;
+        timed_step("classification_$base", sub {
+            run_command("$run_mashmap_classifier --mashmap '$output_dir/${base}_mashmap.out' ".
+                       "$taxonomy_args $profile_args".
+                       "--output '$output_dir/${base}_classified.tsv' --processes 8 ".
+                       "--max-candidates $max_top_candidates --mode $classification_mode");
+            return { bytes_written => file_size("$output_dir/${base}_classified.tsv") };
+        });
     }
 } else {
     print "Predominance of small genomes, using Minimap2\n";
     
     if (@small_genomes) {
-        my $combined_small = "$data_dir/downloaded_genomes/combined_genomes.fasta";
-        safe_concat($combined_small, @small_genomes);
+        my $combined_small = "$output_dir/combined_genomes.fasta";
+        timed_step("concatenate_references", sub {
+            safe_concat($combined_small, @small_genomes);
+            return { files => scalar(@small_genomes), bytes_written => file_size($combined_small) };
+        });
         
-        run_command("$minimap_script '$input_dir' '$combined_small' ".
-                   "'$output_dir/reference.mmi' '$output_dir/resultados.paf'");
-        run_command("python3 '$classification_minimap' --paf '$output_dir/resultados.paf' ".
-                   "--taxonomy '$taxonomy_file' --hierarchy '$hierarchy_file' ".
-                   "--output '$output_dir/classified_sequences.tsv' --processes 8 ".
-                   "--max-candidates $max_top_candidates");
+        my $profile_args = $profile_classifiers ? "--profile '$output_dir/classification.prof' " : "";
+        $profile_args .= "--parquet '$output_dir/classified_sequences.parquet' " if $parquet_output;
+        $profile_args .= "--abundance-profile '$output_dir/classified_profile.cami' --sample-id '$sample_id' ";
+        push @profiles, "'$output_dir/classified_profile.cami'";
+        if ($pipe_alignments) {
+            # The classifier runs minimap2 itself and reads the alignments from the pipe
+            timed_step("minimap2_index", sub {
+                run_command("minimap2 -d '$output_dir/reference.mmi' '$combined_small'");
+                return { bytes_written => file_size("$output_dir/reference.mmi") };
+            });
+            my $archive_args = $paf_archive ? "--paf-archive '$paf_archive' " : "";
+            timed_step("alignment_classification", sub {
+                run_command("$run_minimap_classifier --minimap2-index '$output_dir/reference.mmi' ".
+                           "--queries '$input_dir'/*.fna $archive_args".
+                           "$taxonomy_args $profile_args".
+                           "--output '$output_dir/classified_sequences.tsv' --processes 8 ".
+                           "--max-candidates $max_top_candidates --mode $classification_mode");
+                return { bytes_written => file_size("$output_dir/classified_sequences.tsv") };
+            });
+        } else {
+            timed_step("alignment", sub {
+                run_command("$minimap_script '$input_dir' '$combined_small' ".
+                           "'$output_dir/reference.mmi' '$output_dir/resultados.paf'");
+                return { bytes_written => file_size("$output_dir/resultados.paf") };
+            });
+            timed_step("classification", sub {
+                run_command("$run_minimap_classifier --paf '$output_dir/resultados.paf' ".
+                           "$taxonomy_args $profile_args".
+                           "--output '$output_dir/classified_sequences.tsv' --processes 8 ".
+                           "--max-candidates $max_top_candidates --mode $classification_mode --streaming");
+                return { bytes_read => file_size("$output_dir/resultados.paf"),
+                         bytes_written => file_size("$output_dir/classified_sequences.tsv") };
+            });
+        }
     } else {
         print "WARNING: No small genomes found to process with Minimap2!\n";
     }
@@ -235,39 +383,76 @@ if ($large_proportion > 70) {
 
 # Step 8: Consolidate results
 my $final_output = "$output_dir/final_classifications.tsv";
-open(my $out, ">", $final_output) or die "Cannot create $final_output: $!";
-print $out "Query\tLineage\tTaxonomic Level\tConfidence\n";
-
-# Add MashMap results
-foreach my $genome (@large_genomes) {
-    my $base = $genome =~ s/.*\/([^\/]+)\.fna$/$1/r;
-    my $file = "$output_dir/${base}_classified.tsv";
-    if (-e $file) {
-        open(my $in, "<", $file) or next;
+timed_step("consolidation", sub {
+    open(my $out, ">", $final_output) or die "Cannot create $final_output: $!";
+    print $out "Query\tLineage\tTaxonomic Level\tConfidence\n";
+
+    # Add MashMap results
+    foreach my $genome (@large_genomes) {
+        my $base = $genome =~ s/.*\/([^\/]+)\.fna$/$1/r;
+        my $file = "$output_dir/${base}_classified.tsv";
+        if (-e $file) {
+            open(my $in, "<", $file) or next;
+            while (<$in>) {
+                print $out $_ unless $. == 1; # Skip header
+            }
+            close $in;
+        }
+    }
+
+    # Add Minimap2 results
+    if (-e "$output_dir/classified_sequences.tsv") {
+        open(my $in, "<", "$output_dir/classified_sequences.tsv") or die $!;
         while (<$in>) {
             print $out $_ unless $. == 1; # Skip header
         }
         close $in;
     }
-}
 
-# Add Minimap2 results
-if (-e "$output_dir/classified_sequences.tsv") {
-    open(my $in, "<", "$output_dir/classified_sequences.tsv") or die $!;
-    while (<$in>) {
-        print $out $_ unless $. == 1; # Skip header
-    }
-    close $in;
-}
+    close $out;
 
-close $out;
+    # Parquet stores are merged row group by row group, in the same order as the TSV
+    if ($parquet_output) {
+        my @stores = map { my $base = $_ =~ s/.*\/([^\/]+)\.fna$/$1/r; "'$output_dir/${base}_classified.parquet'" } @large_genomes;
+        push @stores, "'$output_dir/classified_sequences.parquet'";
+        run_command("python3 '$results_store_script' @stores --output '$output_dir/final_classifications.parquet'");
+    }
+    if (@profiles) {
+        run_command("python3 '$profile_script' @profiles --sample-id '$sample_id' ".
+                   "--output '$output_dir/abundance_profile.cami'");
+    }
+    return { bytes_written => file_size($final_output) };
+});
 
 my $end_time = time();
 my $execution_time = $end_time - $start_time;
 
+# Run report: the steps above plus the per-stage metrics of the Python scripts
+my @python_stages;
+if (open(my $metrics_in, "<", $stage_metrics)) {
+    while (my $line = <$metrics_in>) {
+        push @python_stages, decode_json($line) if $line =~ /\S/;
+    }
+    close $metrics_in;
+}
+open(my $report, ">", $run_report) or die "Cannot create $run_report: $!";
+print $report JSON::PP->new->canonical->pretty->encode({
+    input_dir => $input_dir,
+    mode => $classification_mode,
+    pipe => $pipe_alignments ? JSON::PP::true : JSON::PP::false,
+    server => $classification_server || undef,
+    genome_cache_gb => $genome_cache_gb + 0,
+    total_seconds => sprintf("%.3f", $execution_time) + 0,
+    steps => \@step_metrics,
+    python_stages => \@python_stages,
+});
+close $report;
+
 print "\nProcessing completed successfully!\n";
 print "Total execution time: ".sprintf("%.2f", $execution_time)." seconds\n";
 print "Final results in: $final_output\n";
+print "Abundance profile in: $output_dir/abundance_profile.cami\n" if @profiles;
+print "Run report in: $run_report\n";
 print "Used sketch files:\n";
 foreach my $db (keys %sketch_files) {
     print " - $db: $sketch_files{$db}\n";
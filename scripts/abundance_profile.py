@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+import os
+import csv
+import logging
+import argparse
+from collections import Counter, defaultdict
+
+from taxonomy_index import open_taxonomy_index
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+CAMI_VERSION = "0.9.1"
+CAMI_RANKS = ['superkingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species', 'strain']
+CAMI_RANK_INDEX = {rank: position for position, rank in enumerate(CAMI_RANKS)}
+ROOT_TAXID = "1"
+
+def count_assignments(results):
+    """
+    Count queries per assigned TaxID (the primary candidate) in a chunk of
+    (query, candidates) results. Run by the workers; the main process only
+    adds the per-chunk counters up.
+    """
+    counts = Counter()
+    for _, candidates in results:
+        taxid = candidates[0][3]
+        if taxid is not None:
+            counts[taxid] += 1
+    return counts
+
+def load_taxonomy_nodes(hierarchy_file, index_file=None):
+    """
+    Return (parents, ranks, names) mappings keyed by TaxID string.
+    """
+    if index_file:
+        index = open_taxonomy_index(index_file)
+        return index.parents, index.ranks, index.names
+
+    parents, ranks, names = {}, {}, {}
+    with open(hierarchy_file, "r") as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        for row in reader:
+            taxid = row["TaxID"]
+            parents[taxid] = row["ParentTaxID"]
+            ranks[taxid] = row["Rank"]
+            names[taxid] = row["Name"]
+    return parents, ranks, names
+
+def _ranked_path(taxid, parents, ranks):
+    # Ancestors of taxid (itself included) at CAMI ranks, root first
+    path = []
+    seen = set()
+    current = taxid
+    while current in parents and current != ROOT_TAXID and current not in seen:
+        seen.add(current)
+        if ranks.get(current) in CAMI_RANK_INDEX:
+            path.append(current)
+        current = parents[current]
+    path.reverse()
+    return path
+
+def build_profile(taxid_counts, parents, ranks, names):
+    """
+    Roll per-TaxID query counts up to every CAMI rank.
+
+    Returns {(rank, taxid): (count, taxpath, taxpathsn)}. Only the distinct
+    assigned TaxIDs are walked, so this is cheap next to classification.
+    """
+    profile = {}
+    for taxid, count in taxid_counts.items():
+        path = _ranked_path(taxid, parents, ranks)
+        for depth, ancestor in enumerate(path):
+            key = (ranks[ancestor], ancestor)
+            if key in profile:
+                profile[key][0] += count
+            else:
+                # One TAXPATH slot per CAMI rank, left empty where the lineage skips a rank
+                slots = [None] * (CAMI_RANK_INDEX[ranks[ancestor]] + 1)
+                for node in path[:depth + 1]:
+                    slots[CAMI_RANK_INDEX[ranks[node]]] = node
+                profile[key] = [count, "|".join(node or "" for node in slots),
+                                "|".join(names.get(node, "") if node else "" for node in slots)]
+    return {key: tuple(value) for key, value in profile.items()}
+
+def write_cami_profile(output_file, profile, total_queries, sample_id):
+    """
+    Write a CAMI profiling file. Percentages are relative to all queries, so
+    unclassified queries make a rank sum to less than 100.
+    """
+    rows = sorted(profile.items(), key=lambda item: (CAMI_RANK_INDEX[item[0][0]], -item[1][0], item[0][1]))
+    with open(output_file, "w") as out:
+        out.write(f"@SampleID:{sample_id}\n")
+        out.write(f"@Version:{CAMI_VERSION}\n")
+        out.write(f"@Ranks:{'|'.join(CAMI_RANKS)}\n")
+        out.write("@TaxonomyID:NCBI\n")
+        out.write(f"@__Queries:{total_queries}\n")
+        out.write("\n@@TAXID\tRANK\tTAXPATH\tTAXPATHSN\tPERCENTAGE\n")
+        for (rank, taxid), (count, taxpath, taxpathsn) in rows:
+            percentage = 100.0 * count / total_queries if total_queries else 0.0
+            out.write(f"{taxid}\t{rank}\t{taxpath}\t{taxpathsn}\t{percentage:.6f}\n")
+    logging.info(f"Abundance profile with {len(rows)} taxa saved to {output_file}")
+
+def read_cami_profile(profile_file):
+    # Returns (sample_id, total_queries, {(rank, taxid): (count, taxpath, taxpathsn)})
+    sample_id, total_queries, profile = None, 0, {}
+    with open(profile_file, "r") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.startswith("@SampleID:"):
+                sample_id = line.split(":", 1)[1]
+            elif line.startswith("@__Queries:"):
+                total_queries = int(line.split(":", 1)[1])
+            elif line and not line.startswith("@"):
+                taxid, rank, taxpath, taxpathsn, percentage = line.split("\t")
+                count = float(percentage) * total_queries / 100.0
+                profile[(rank, taxid)] = (count, taxpath, taxpathsn)
+    return sample_id, total_queries, profile
+
+def merge_cami_profiles(output_file, profile_files, sample_id=None):
+    """
+    Merge per-classifier profiles of one sample, weighting each by its query count.
+    """
+    merged = defaultdict(lambda: [0.0, "", ""])
+    total_queries = 0
+    for profile_file in profile_files:
+        file_sample_id, queries, profile = read_cami_profile(profile_file)
+        sample_id = sample_id or file_sample_id
+        total_queries += queries
+        for key, (count, taxpath, taxpathsn) in profile.items():
+            entry = merged[key]
+            entry[0] += count
+            entry[1], entry[2] = taxpath, taxpathsn
+    write_cami_profile(output_file, {key: tuple(value) for key, value in merged.items()}, total_queries,
+                       sample_id or "sample")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge CAMI abundance profiles written by the classifiers")
+    parser.add_argument("inputs", nargs="+", help="Profiles to merge (missing files are skipped)")
+    parser.add_argument("--output", required=True, help="Merged CAMI profile")
+    parser.add_argument("--sample-id", help="Sample ID of the merged profile (default: from the inputs)")
+
+    args = parser.parse_args()
+    merge_cami_profiles(args.output, [path for path in args.inputs if os.path.exists(path)], args.sample_id)
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+import io
+import csv
+import logging
+from collections import Counter
+from itertools import chain
+from operator import itemgetter
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for --engine numpy
+    np = None
+
+from classification_core import _worker_state, iter_query_batches
+from compressed_io import open_input
+
+# Confidences are printed with four decimals; this table holds the text of
+# every multiple of 1e-4 between 0 and 1, with the tabs around it
+CONFIDENCE_TEXT = [f"\t{step / 10000:.4f}\t" for step in range(10001)]
+if np is not None:
+    CONFIDENCE_TEXT = np.array(CONFIDENCE_TEXT, dtype=object)
+
+# rank_pairs sorts the candidates of a batch in a grid of one row per query
+# unless that grid would hold this many times more cells than candidates
+PADDED_SORT_LIMIT = 8
+
+def require_numpy():
+    if np is None:
+        raise ImportError("The numpy scoring engine requires numpy (conda install numpy)")
+
+def quote_fields(*fields):
+    # The fields as csv.writer(delimiter='\t') writes them, without the line
+    # ending (which must stay the default, as it decides what gets quoted)
+    buffer = io.StringIO()
+    csv.writer(buffer, delimiter="\t").writerow(fields)
+    return buffer.getvalue()[:-2]
+
+def stable_argsort(values):
+    # NumPy radix-sorts 16-bit integers, which covers the indices of a chunk
+    # of the usual size far faster than the merge sort used for wider ones
+    if len(values) and values.max() < 1 << 16:
+        values = values.astype(np.uint16)
+    return np.argsort(values, kind="stable")
+
+# Hits travel to the workers as columns. Reference codes are positions in the
+# reference abundance table, whose keys are in first-hit order both from
+# read_hit_table and from count_paf_references, so the workers decode them
+# with the table init_worker already gave them.
+
+class HitBatch:
+    """
+    A batch of queries in columnar form: the query names, the number of hits
+    of each, and per hit (grouped by query, in input order) the reference
+    code, coverage and exact-match flag.
+    """
+    __slots__ = ("queries", "lengths", "refs", "coverage", "exact")
+
+    def __init__(self, queries, lengths, refs, coverage, exact):
+        self.queries = queries
+        self.lengths = lengths
+        self.refs = refs
+        self.coverage = coverage
+        self.exact = exact
+
+    def __len__(self):
+        return len(self.queries)
+
+    @classmethod
+    def from_queries(cls, batch, ref_codes):
+        # From (query, [(ref_id, coverage, is_exact), ...]) pairs, as streaming mode reads them
+        hit_lists = list(map(itemgetter(1), batch))
+        hits = list(chain.from_iterable(hit_lists))
+        return cls(list(map(itemgetter(0), batch)),
+                   np.fromiter(map(len, hit_lists), dtype=np.int64, count=len(batch)),
+                   np.fromiter(map(ref_codes.__getitem__, map(itemgetter(0), hits)), dtype=np.int64,
+                               count=len(hits)),
+                   np.fromiter(map(itemgetter(1), hits), dtype=np.float64, count=len(hits)),
+                   np.fromiter(map(itemgetter(2), hits), dtype=bool, count=len(hits)))
+
+class HitTable:
+    """
+    All hits of an alignment file in columnar form, grouped by query in order
+    of first appearance (the order of parse_paf_file's query map).
+    """
+
+    def __init__(self, queries, offsets, refs, coverage, exact):
+        self.queries = queries
+        self.offsets = offsets
+        self.refs = refs
+        self.coverage = coverage
+        self.exact = exact
+
+    def __len__(self):
+        return len(self.queries)
+
+    def batches(self, batch_size):
+        offsets = self.offsets.tolist()
+        for start in range(0, len(self.queries), batch_size):
+            end = min(start + batch_size, len(self.queries))
+            first, last = offsets[start], offsets[end]
+            yield HitBatch(self.queries[start:end], np.diff(self.offsets[start:end + 1]),
+                           self.refs[first:last], self.coverage[first:last], self.exact[first:last])
+
+def read_hit_table(path, parse_line, source):
+    """
+    Columnar counterpart of parse_paf_file and parse_mashmap_file: parses the
+    alignments with parse_line and returns the HitTable and the per-reference
+    hit counts.
+    """
+    require_numpy()
+    query_codes = {}
+    ref_codes = {}
+    hit_query = []
+    hit_ref = []
+    coverages = []
+    exact_flags = []
+
+    with open_input(path) as f:
+        for line in f:
+            hit = parse_line(line)
+            if hit is None:
+                continue
+
+            query_id, ref_id, coverage, is_exact = hit
+            hit_query.append(query_codes.setdefault(query_id, len(query_codes)))
+            hit_ref.append(ref_codes.setdefault(ref_id, len(ref_codes)))
+            coverages.append(coverage)
+            exact_flags.append(is_exact)
+
+    hit_query = np.array(hit_query, dtype=np.int64)
+    refs = np.array(hit_ref, dtype=np.int64)
+    coverage = np.array(coverages, dtype=np.float64)
+    exact = np.array(exact_flags, dtype=bool)
+    if np.any(hit_query[1:] < hit_query[:-1]):
+        # The hits of a query are not contiguous (as in MashMap output)
+        order = np.argsort(hit_query, kind="stable")
+        hit_query, refs, coverage, exact = hit_query[order], refs[order], coverage[order], exact[order]
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(hit_query, minlength=len(query_codes)))))
+    ref_counts = dict(zip(ref_codes, np.bincount(refs, minlength=len(ref_codes)).tolist()))
+
+    logging.info(f"Processed {len(query_codes)} queries from {source} file")
+    return HitTable(list(query_codes), offsets, refs, coverage, exact), ref_counts
+
+def iter_hit_batches(queries, ref_abundance, batch_size):
+    # HitBatches of a HitTable, or of (query, refs) pairs as streaming mode reads them
+    if isinstance(queries, HitTable):
+        return queries.batches(batch_size)
+    ref_codes = {ref_id: code for code, ref_id in enumerate(ref_abundance)}
+    return (HitBatch.from_queries(batch, ref_codes) for batch in iter_query_batches(queries, batch_size))
+
+class BatchEncoder:
+    """
+    Dictionary-encodes the references' TaxIDs as integers.
+
+    Each reference is resolved against the taxonomy, and each TaxID's lineage
+    quoted for the TSV, once per worker. Code 0 is the Unknown candidate.
+    """
+
+    def __init__(self, ref_abundance, taxonomy, lineage_info):
+        require_numpy()
+        self.lineage_info = lineage_info
+        self.taxid_codes = {}
+        self.taxids = [None]
+        self.lineages = ["Unknown"]
+        self.levels = ["root"]
+        has_lineage = [False]
+
+        ref_taxid = []
+        for ref_id in ref_abundance:
+            taxid = taxonomy[ref_id] if ref_id in taxonomy else None
+            code = self.taxid_codes.get(taxid, -1) if taxid is not None else -1
+            if taxid is not None and code < 0:
+                code = self.taxid_codes[taxid] = len(self.taxids)
+                info = lineage_info(taxid)
+                lineage, level = info if info is not None else ("Unknown", "root")
+                self.taxids.append(taxid)
+                self.lineages.append(lineage)
+                self.levels.append(level)
+                has_lineage.append(info is not None)
+            ref_taxid.append(code)
+
+        self.ref_taxid = np.array(ref_taxid, dtype=np.int64)
+        self.ref_weight = np.fromiter(ref_abundance.values(), dtype=np.float64, count=len(ref_abundance))
+        self.has_lineage = np.array(has_lineage, dtype=bool)
+        self.fields = np.array([quote_fields(lineage, level) + "\r\n"
+                                for lineage, level in zip(self.lineages, self.levels)], dtype=object)
+
+def rank_pairs(pair_query, first_hit, confidence, query_count, max_candidates):
+    """
+    Indices of each query's top max_candidates (query, TaxID) pairs, ordered
+    by query, then confidence descending, then first hit. pair_query must be
+    sorted, and first_hit grows with it as hits come grouped by query.
+    """
+    order = stable_argsort(first_hit)
+    counts = np.bincount(pair_query, minlength=query_count)
+    starts = np.cumsum(counts) - counts
+    width = int(counts.max()) if len(order) else 0
+    if query_count * width <= PADDED_SORT_LIMIT * len(order):
+        # Each query's confidences go in a row of a padded grid, in first-hit
+        # order, and the rows are sorted at once: cheaper than one global sort
+        queries = pair_query[order]
+        grid = np.full((query_count, width), np.inf)
+        grid[queries, np.arange(len(order)) - starts[queries]] = -confidence[order]
+        ranked = np.argsort(grid, axis=1, kind="stable")[:, :max_candidates]
+        return order[(starts[:, None] + ranked)[ranked < counts[:, None]]]
+
+    # A few queries with many more candidates than the rest: sort globally
+    order = order[np.argsort(-confidence[order], kind="stable")]
+    order = order[stable_argsort(pair_query[order])]
+    return order[np.arange(len(order)) - starts[pair_query[order]] < max_candidates]
+
+class ScoredBatch:
+    """
+    Columnar results of a batch: one row per written candidate, as the query
+    index, TaxID code and confidence, sorted by query and rank.
+    """
+
+    def __init__(self, queries, row_query, row_taxid, confidence):
+        self.queries = queries
+        self.row_query = row_query
+        self.row_taxid = row_taxid
+        self.confidence = confidence
+
+    def __len__(self):
+        return len(self.queries)
+
+    def first_rows(self):
+        return np.flatnonzero(np.diff(self.row_query, prepend=-1))
+
+    def classified(self):
+        return int(np.count_nonzero(self.row_taxid[self.first_rows()]))
+
+    def ranks(self):
+        return np.arange(1, len(self.row_query) + 1) - np.repeat(self.first_rows(), np.bincount(self.row_query))
+
+def score_batch(hits, encoder, max_candidates):
+    """
+    Classify a HitBatch with grouped NumPy reductions.
+
+    Gives the same candidates as classify_query, in batch order: exact
+    matches first, otherwise coverage x abundance weights per TaxID,
+    normalised per query, ties keeping first-hit order. The sums run in hit
+    order like the per-query path, so the confidences are identical.
+    """
+    query_count = len(hits)
+    hit_query = np.repeat(np.arange(query_count, dtype=np.int64), hits.lengths)
+    hit_taxid = encoder.ref_taxid[hits.refs]
+    has_lineage = encoder.has_lineage
+    known = hit_taxid >= 0
+
+    # Exact matches: the first exact hit of a query decides, if its TaxID has a lineage
+    exact_taxid = np.full(query_count, -1, dtype=np.int64)
+    exact_hits = np.flatnonzero(hits.exact & known)
+    if exact_hits.size:
+        exact_queries, first = np.unique(hit_query[exact_hits], return_index=True)
+        taxids = hit_taxid[exact_hits[first]]
+        resolved = has_lineage[taxids]
+        exact_taxid[exact_queries[resolved]] = taxids[resolved]
+
+    # Weighted candidates for the remaining queries
+    known_hits = np.flatnonzero(known)
+    weights = hits.coverage[known_hits] * encoder.ref_weight[hits.refs[known_hits]]
+    hit_query = hit_query[known_hits]
+    hit_taxid = hit_taxid[known_hits]
+    total_weight = np.bincount(hit_query, weights=weights, minlength=query_count)
+
+    taxid_count = len(has_lineage)
+    pair_keys, first_hit, pair_of_hit = np.unique(hit_query * taxid_count + hit_taxid,
+                                                  return_index=True, return_inverse=True)
+    pair_weight = np.bincount(pair_of_hit.ravel(), weights=weights, minlength=len(pair_keys))
+    pair_query = pair_keys // taxid_count
+    pair_taxid = pair_keys % taxid_count
+
+    keep = has_lineage[pair_taxid] & (total_weight[pair_query] != 0) & (exact_taxid[pair_query] < 0)
+    pair_query, pair_taxid, first_hit = pair_query[keep], pair_taxid[keep], first_hit[keep]
+    confidence = pair_weight[keep] / total_weight[pair_query]
+
+    top = rank_pairs(pair_query, first_hit, confidence, query_count, max_candidates)
+    pair_query, pair_taxid, confidence = pair_query[top], pair_taxid[top], confidence[top]
+
+    # Exact matches and queries without candidates (Unknown, code 0) get one row each
+    single = np.ones(query_count, dtype=bool)
+    single[pair_query] = False
+    single_queries = np.flatnonzero(single)
+    single_taxid = np.maximum(exact_taxid[single_queries], 0)
+    row_query = np.concatenate((pair_query, single_queries))
+    order = stable_argsort(row_query)
+    return ScoredBatch(hits.queries, row_query[order],
+                       np.concatenate((pair_taxid, single_taxid))[order],
+                       np.concatenate((confidence, (single_taxid > 0).astype(np.float64)))[order])
+
+def format_confidences(confidence):
+    # Exact (round-half-even on the binary value) unless the scaled value is
+    # within rounding error of a tie, where Python formats it
+    scaled = confidence * 10000
+    steps = np.rint(scaled).astype(np.int64)
+    text = CONFIDENCE_TEXT[steps]
+    for row in np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6).tolist():
+        text[row] = f"\t{confidence[row]:.4f}\t"
+    return text
+
+def format_batch(scored, encoder):
+    # The batch's rows exactly as write_results and csv.writer write them
+    queries = scored.queries
+    names = "\n".join(queries)
+    if '"' in names or "\t" in names or "\r" in names or names.count("\n") != len(queries) - 1:
+        queries = [quote_fields(query) for query in queries]
+    names = np.array(queries, dtype=object)[scored.row_query]
+    fields = encoder.fields[scored.row_taxid]
+    return "".join(chain.from_iterable(zip(names.tolist(), format_confidences(scored.confidence).tolist(),
+                                           fields.tolist())))
+
+def batch_columns(scored, encoder):
+    # Parquet columns: query, rank, confidence and the candidate as a code into
+    # the TaxID, level and lineage tables, cut down to the codes in the batch
+    used, codes = np.unique(scored.row_taxid, return_inverse=True)
+    used = used.tolist()
+    return (np.array(scored.queries, dtype=object)[scored.row_query].tolist(), scored.ranks(),
+            scored.confidence, codes.ravel(), [encoder.taxids[code] for code in used],
+            [encoder.levels[code] for code in used], [encoder.lineages[code] for code in used])
+
+def assignment_counts(scored, encoder):
+    # Same counts as count_assignments: queries per primary TaxID
+    codes = scored.row_taxid[scored.first_rows()]
+    taxids = encoder.taxids
+    return Counter({taxids[code]: count for code, count in enumerate(np.bincount(codes).tolist())
+                    if code and count})
+
+class FormattedBatch:
+    """
+    What a worker sends back for a batch: its TSV text, query and classified
+    counts and, for Parquet output, its columns.
+    """
+    __slots__ = ("text", "queries", "classified", "columns")
+
+    def __init__(self, text, queries, classified, columns=None):
+        self.text = text
+        self.queries = queries
+        self.classified = classified
+        self.columns = columns
+
+    def __len__(self):
+        return self.queries
+
+def process_batch(task, columns=False):
+    # Worker side of the numpy engine; the encoder is built on the first
+    # chunk after init_worker
+    index, hits = task
+    encoder = _worker_state.get("encoder")
+    if encoder is None:
+        encoder = _worker_state["encoder"] = BatchEncoder(
+            _worker_state["ref_abundance"],
+            _worker_state["taxonomy"],
+            _worker_state["lineage_info"]
+        )
+    scored = score_batch(hits, encoder, _worker_state["max_candidates"])
+    formatted = FormattedBatch(format_batch(scored, encoder), len(scored), scored.classified(),
+                               batch_columns(scored, encoder) if columns else None)
+    return index, (formatted, assignment_counts(scored, encoder) if _worker_state["profile"] else None)
+
+def write_formatted(f, store, formatted):
+    # Main-process side: appends a batch's text (and columns) and returns its
+    # classified query count
+    f.write(formatted.text)
+    if store is not None:
+        store.write_columns(*formatted.columns)
+    return formatted.classified
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import socket
+import logging
+import argparse
+import subprocess
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+STREAM_CHUNK = 1 << 20
+
+def _absolute(path):
+    # The server does not share our working directory
+    return os.path.abspath(path) if path and path != "-" else path
+
+def submit_job(socket_path, job, stream=None):
+    """
+    Send a job to classification_server.py and return its JSON reply.
+    stream (a binary file) is sent after the request when job["input"] is "-".
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        connection.sendall((json.dumps(job) + "\n").encode("utf-8"))
+        if stream is not None:
+            try:
+                while True:
+                    chunk = stream.read(STREAM_CHUNK)
+                    if not chunk:
+                        break
+                    connection.sendall(chunk)
+            except BrokenPipeError:
+                pass  # the server gave up on the job; its reply says why
+        connection.shutdown(socket.SHUT_WR)
+        with connection.makefile("rb") as replies:
+            reply = replies.readline()
+    if not reply:
+        raise ConnectionError(f"No reply from the classification server at {socket_path}")
+    return json.loads(reply)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drop-in replacement for classificationminimap.py and "
+                                                 "classificationmashmap.py that runs the job on a "
+                                                 "classification_server.py")
+    parser.add_argument("--socket", required=True, help="Unix socket of the classification server")
+    parser.add_argument("--ping", action="store_true", help="Only check that the server is up")
+    parser.add_argument("--paf", help="Input PAF file, or - to stream it from stdin")
+    parser.add_argument("--mashmap", help="Input Mashmap file")
+    parser.add_argument("--minimap2-index", help="Run minimap2 against this index and stream its output")
+    parser.add_argument("--queries", nargs="+", default=[], help="Query FASTA files for --minimap2-index")
+    parser.add_argument("--minimap2-preset", default="asm10", help="minimap2 -x preset")
+    parser.add_argument("--minimap2-threads", type=int, help="minimap2 -t threads")
+    parser.add_argument("--paf-archive", help="With a streamed PAF, also keep it as a gzip file")
+    parser.add_argument("--output", help="Output TSV file (compressed if it ends in .gz or .zst)")
+    parser.add_argument("--max-candidates", type=int, default=5,
+                        help="Maximum number of candidate classifications to show (1-10)")
+    parser.add_argument("--streaming", action="store_true", help="Classify the PAF query by query")
+    parser.add_argument("--mode", choices=["top", "lca"], default="top",
+                        help="Output the top weighted candidates or their lowest common ancestor")
+    parser.add_argument("--lca-min-fraction", type=float, default=0.0,
+                        help="In LCA mode, ignore candidates below this share of a query's weight")
+    parser.add_argument("--parquet", help="Also write the results to this Parquet file")
+    parser.add_argument("--abundance-profile", help="Also write a CAMI abundance profile to this file")
+    parser.add_argument("--sample-id", help="Sample ID of the abundance profile")
+    parser.add_argument("--metrics", help="Append per-stage metrics as JSON lines to this file")
+    parser.add_argument("--memory-budget", type=int,
+                        help="Out-of-core mode for --mashmap: spill hits to disk in query partitions that "
+                             "each fit in this many MB")
+    parser.add_argument("--partitions", type=int, help="Out-of-core mode for --mashmap with this many partitions")
+    parser.add_argument("--spill-dir", help="Directory for the out-of-core spill files (default: the server's "
+                                            "state directory)")
+    parser.add_argument("--taxonomy", help="Taxonomy mapping file (the server reloads its taxonomy when "
+                                           "these files differ from the ones it holds)")
+    parser.add_argument("--hierarchy", help="Taxonomy hierarchy file")
+    parser.add_argument("--index", help="Compiled taxonomy index")
+    # Accepted for compatibility with the classifiers; the server has its own
+    for ignored in ("--processes", "--batch-size", "--profile"):
+        parser.add_argument(ignored, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.ping:
+        print(json.dumps(submit_job(args.socket, {"command": "ping"})))
+        sys.exit(0)
+
+    inputs = [name for name in ("paf", "mashmap", "minimap2_index") if getattr(args, name)]
+    if len(inputs) != 1:
+        parser.error("exactly one of --paf, --mashmap and --minimap2-index is required")
+    if not args.output:
+        parser.error("--output is required")
+    if args.index is None and (args.taxonomy is None) != (args.hierarchy is None):
+        parser.error("--taxonomy and --hierarchy are required unless --index is given")
+    if (args.memory_budget or args.partitions) and not args.mashmap:
+        parser.error("--memory-budget and --partitions are only supported with --mashmap")
+
+    job = {
+        "format": "mashmap" if args.mashmap else "paf",
+        "input": _absolute(args.mashmap or args.paf or "-"),
+        "output": _absolute(args.output),
+        "taxonomy": _absolute(args.taxonomy),
+        "hierarchy": _absolute(args.hierarchy),
+        "index": _absolute(args.index),
+        "max_candidates": args.max_candidates,
+        "streaming": args.streaming,
+        "mode": args.mode,
+        "lca_min_fraction": args.lca_min_fraction,
+        "parquet": _absolute(args.parquet),
+        "abundance_profile": _absolute(args.abundance_profile),
+        "sample_id": args.sample_id,
+        "paf_archive": _absolute(args.paf_archive),
+        "metrics": _absolute(args.metrics or os.environ.get("HYMET_METRICS")),
+        "memory_budget": args.memory_budget,
+        "partitions": args.partitions,
+        "spill_dir": _absolute(args.spill_dir),
+    }
+
+    aligner = None
+    stream = None
+    if args.minimap2_index:
+        command = ["minimap2", "-x", args.minimap2_preset]
+        if args.minimap2_threads:
+            command += ["-t", str(args.minimap2_threads)]
+        command += [args.minimap2_index] + args.queries
+        logging.info(f"Running {' '.join(command)}")
+        aligner = subprocess.Popen(command, stdout=subprocess.PIPE)
+        stream = aligner.stdout
+    elif job["input"] == "-":
+        stream = sys.stdin.buffer
+
+    reply = submit_job(args.socket, job, stream)
+    if aligner is not None:
+        aligner.stdout.close()
+        if aligner.wait() != 0:
+            logging.error(f"minimap2 exited with status {aligner.returncode}")
+            sys.exit(1)
+
+    if reply.get("status") != "ok":
+        logging.error(f"Classification failed: {reply.get('message')}")
+        sys.exit(1)
+    logging.info(f"Classification complete. Results saved to {args.output}")
+    logging.info(f"Classified: {reply['classified']}/{reply['queries']} in {reply['seconds']}s on the server")
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+import csv
+import sys
+import logging
+import threading
+from collections import defaultdict
+from functools import lru_cache
+from operator import itemgetter
+import heapq
+
+from abundance_profile import count_assignments
+from taxonomy_index import open_taxonomy_index
+from taxonomy_lca import ROOT_TAXID
+
+csv.field_size_limit(sys.maxsize)
+
+def load_taxonomy_file(taxonomy_file):
+    taxonomy = {}
+    with open(taxonomy_file, "r") as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        for row in reader:
+            taxid = row["TaxID"]
+            for identifier in row["Identifiers"].split(";"):
+                cleaned_id = identifier.strip()
+                if cleaned_id:
+                    taxonomy[cleaned_id] = taxid
+    logging.info(f"Loaded {len(taxonomy)} taxonomy mappings")
+    return taxonomy
+
+def load_taxonomy_hierarchy_file(taxonomy_hierarchy_file):
+    hierarchy = {}
+    with open(taxonomy_hierarchy_file, "r") as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        for row in reader:
+            taxid = row["TaxID"]
+            hierarchy[taxid] = row["Lineage"].strip()
+    logging.info(f"Loaded {len(hierarchy)} taxonomy hierarchies")
+    return hierarchy
+
+def load_taxonomy_parents(taxonomy_hierarchy_file, index_file=None):
+    if index_file:
+        return open_taxonomy_index(index_file).parents
+
+    parents = {}
+    with open(taxonomy_hierarchy_file, "r") as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        for row in reader:
+            parents[row["TaxID"]] = row["ParentTaxID"]
+    logging.info(f"Loaded {len(parents)} parent links")
+    return parents
+
+def load_taxonomy(taxonomy_file, hierarchy_file, index_file=None):
+    # A compiled index (see taxonomy_index.py) replaces the TSV parsing; a
+    # taxonomy file given alongside it still overrides the index accessions.
+    if index_file:
+        index = open_taxonomy_index(index_file)
+        logging.info(f"Opened taxonomy index {index_file}")
+        if not taxonomy_file and index.accession_count() == 0:
+            raise ValueError(f"{index_file} has no accession table; pass --taxonomy as well")
+        taxonomy = load_taxonomy_file(taxonomy_file) if taxonomy_file else index.accessions
+        return taxonomy, index.lineages
+
+    return load_taxonomy_file(taxonomy_file), load_taxonomy_hierarchy_file(hierarchy_file)
+
+def iter_query_batches(queries, batch_size):
+    batch = []
+    for query in queries:
+        batch.append(query)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+RANK_ORDER = [
+    'superkingdom', 'phylum', 'class', 'order',
+    'family', 'genus', 'species', 'strain'
+]
+RANK_INDEX = {rank: position for position, rank in enumerate(RANK_ORDER)}
+
+# Taxa resolved per worker are few compared to the hierarchy, so the bound
+# only matters for pathological inputs.
+LINEAGE_CACHE_SIZE = 1 << 18
+
+def determine_taxonomic_level(lineage):
+    deepest = -1
+    for part in lineage.split(';'):
+        part = part.strip()
+        if ':' in part:
+            rank = part.split(':', 1)[0].strip().lower()
+            deepest = max(deepest, RANK_INDEX.get(rank, -1))
+    return RANK_ORDER[deepest] if deepest >= 0 else 'root'
+
+def build_lineage_cache(taxonomy_hierarchy, maxsize=LINEAGE_CACHE_SIZE):
+    # Lineage and deepest rank are parsed once per TaxID; later candidates
+    # with the same TaxID are a single cache lookup.
+    @lru_cache(maxsize=maxsize)
+    def lineage_info(taxid):
+        if taxid not in taxonomy_hierarchy:
+            return None
+        lineage = taxonomy_hierarchy[taxid]
+        return lineage, determine_taxonomic_level(lineage)
+    return lineage_info
+
+def calculate_weighted_lineage(refs, ref_abundance, taxonomy):
+    taxid_weights = defaultdict(float)
+    total_weight = 0.0
+    
+    for ref_id, coverage, _ in refs:
+        if ref_id not in taxonomy:
+            continue
+            
+        taxid = taxonomy[ref_id]
+        weight = coverage * ref_abundance.get(ref_id, 1)
+        taxid_weights[taxid] += weight
+        total_weight += weight
+    
+    return taxid_weights, total_weight
+
+# Candidates are (lineage, level, confidence, taxid) tuples
+UNKNOWN_CANDIDATE = ("Unknown", "root", 0.0, None)
+
+def get_top_lineages(taxid_weights, total_weight, lineage_info, max_options):
+    if total_weight == 0:
+        return [UNKNOWN_CANDIDATE]
+
+    lineage_scores = []
+    for taxid, weight in taxid_weights.items():
+        info = lineage_info(taxid)
+        if info is not None:
+            lineage, level = info
+            lineage_scores.append((lineage, level, weight / total_weight, taxid))
+    
+    # Highest confidence first, limited to max_options (ties keep hit order)
+    top_lineages = heapq.nlargest(max_options, lineage_scores, key=itemgetter(2))
+    return top_lineages if top_lineages else [UNKNOWN_CANDIDATE]
+
+def find_exact_match(refs, taxonomy, lineage_info):
+    exact_matches = [ref for ref, _, is_exact in refs if is_exact and ref in taxonomy]
+    if exact_matches:
+        taxid = taxonomy[exact_matches[0]]
+        info = lineage_info(taxid)
+        if info is not None:
+            lineage, level = info
+            return (lineage, level, 1.0, taxid)
+    return None
+
+def classify_query(query, refs, ref_abundance, taxonomy, lineage_info, max_candidates):
+    # Check for exact matches first
+    match = find_exact_match(refs, taxonomy, lineage_info)
+    if match is not None:
+        return (query, [match])
+    
+    # Calculate weighted lineages for non-exact matches
+    taxid_weights, total_weight = calculate_weighted_lineage(refs, ref_abundance, taxonomy)
+    top_lineages = get_top_lineages(taxid_weights, total_weight, lineage_info, max_candidates)
+    
+    return (query, top_lineages)
+
+def classify_query_lca(query, refs, ref_abundance, taxonomy, lineage_info, lca, min_fraction):
+    match = find_exact_match(refs, taxonomy, lineage_info)
+    if match is not None:
+        return (query, [match])
+
+    # Lowest common ancestor of the weighted candidates; support is the share
+    # of the query's weight that falls inside the LCA's subtree
+    taxid_weights, total_weight = calculate_weighted_lineage(refs, ref_abundance, taxonomy)
+    ancestor, support = lca.weighted_lca(taxid_weights, total_weight, min_fraction)
+    info = lineage_info(ancestor) if ancestor not in (None, ROOT_TAXID) else None
+    if info is None:
+        return (query, [UNKNOWN_CANDIDATE])
+    lineage, level = info
+    return (query, [(lineage, level, support, ancestor)])
+
+# Read-only state shared by all tasks of a worker, set once by init_worker so
+# that tasks only carry the per-query hits.
+_worker_state = {}
+
+def init_worker(ref_abundance, taxonomy, taxonomy_hierarchy, max_candidates, lca=None, lca_min_fraction=0.0,
+                profile=False):
+    _worker_state.clear()
+    _worker_state.update(
+        ref_abundance=ref_abundance,
+        taxonomy=taxonomy,
+        lineage_info=build_lineage_cache(taxonomy_hierarchy),
+        max_candidates=max_candidates,
+        lca=lca,
+        lca_min_fraction=lca_min_fraction,
+        profile=profile
+    )
+
+def process_query(task):
+    query, refs = task
+    if _worker_state["lca"] is not None:
+        return classify_query_lca(
+            query, refs,
+            _worker_state["ref_abundance"],
+            _worker_state["taxonomy"],
+            _worker_state["lineage_info"],
+            _worker_state["lca"],
+            _worker_state["lca_min_fraction"]
+        )
+    return classify_query(
+        query, refs,
+        _worker_state["ref_abundance"],
+        _worker_state["taxonomy"],
+        _worker_state["lineage_info"],
+        _worker_state["max_candidates"]
+    )
+
+def choose_chunksize(task_count, processes, max_chunksize=2000):
+    # About four chunks per worker keeps the pool balanced, while the cap keeps
+    # result batches (and the pause before they are written) small.
+    return max(1, min(max_chunksize, task_count // (processes * 4)))
+
+def process_chunk(task):
+    # Returns the chunk's results and, for the abundance profile, its
+    # per-TaxID assignment counts
+    index, chunk = task
+    results = [process_query(query) for query in chunk]
+    return index, (results, count_assignments(results) if _worker_state["profile"] else None)
+
+def is_settled(refs, taxonomy, lineage_info):
+    # The reference abundances only weigh hits against each other, so a query
+    # with an exact match, or whose hits all fall on one TaxID, gets the same
+    # result whatever the abundances are
+    taxids = {taxonomy[ref_id] for ref_id, _, _ in refs if ref_id in taxonomy}
+    return len(taxids) <= 1 or find_exact_match(refs, taxonomy, lineage_info) is not None
+
+def process_settled_chunk(task):
+    # Pipe mode, while the aligner still runs and the abundances are not yet
+    # known: classifies the chunk's settled queries and returns their
+    # (position, result) pairs, the positions of the others and, for the
+    # abundance profile, the settled queries' assignment counts
+    index, chunk = task
+    settled = []
+    unsettled = []
+    for position, query in enumerate(chunk):
+        if is_settled(query[1], _worker_state["taxonomy"], _worker_state["lineage_info"]):
+            settled.append((position, process_query(query)))
+        else:
+            unsettled.append(position)
+    counts = count_assignments([result for _, result in settled]) if _worker_state["profile"] else None
+    return index, (settled, unsettled, counts)
+
+def iter_ordered_results(pool, chunks, max_pending, function=process_chunk):
+    # Chunks are classified with imap_unordered and put back in input order
+    # through a reorder buffer. A chunk is only submitted once fewer than
+    # max_pending chunks are in flight or waiting to be written, which bounds
+    # memory however far ahead the fast workers get.
+    slots = threading.Semaphore(max_pending)
+    abort = threading.Event()
+
+    def submit():
+        for index, chunk in enumerate(chunks):
+            while not slots.acquire(timeout=0.1):
+                if abort.is_set():
+                    return
+            yield index, chunk
+
+    pending = {}
+    next_index = 0
+    try:
+        for index, results in pool.imap_unordered(function, submit()):
+            pending[index] = results
+            while next_index in pending:
+                yield pending.pop(next_index)
+                next_index += 1
+                slots.release()
+    finally:
+        abort.set()
+
+def write_results(writer, results, max_candidates):
+    classified = 0
+    for query, lineages in results:
+        primary_lineage = lineages[0][0]
+        if primary_lineage != 'Unknown':
+            classified += 1
+        
+        # Write each lineage (up to max_candidates) as separate rows
+        for lineage, level, confidence, _ in lineages[:max_candidates]:
+            writer.writerow([query, f"{confidence:.4f}", lineage, level])
+    return classified
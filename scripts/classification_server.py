@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+import os
+import csv
+import json
+import time
+import pickle
+import shutil
+import signal
+import logging
+import argparse
+import tempfile
+import itertools
+import threading
+import socketserver
+from collections import Counter, OrderedDict
+from functools import partial
+from multiprocessing import Pool
+
+import classification_core as classifier
+import classificationmashmap
+import classificationminimap
+from abundance_profile import load_taxonomy_nodes, build_profile, write_cami_profile
+from compressed_io import open_input, open_output
+from results_store import open_results_store, require_pyarrow
+from run_metrics import StageMetrics
+from taxonomy_lca import TaxonomyLCA
+
+# Job states a worker keeps at once; more concurrent jobs only cost a reload
+JOB_STATE_CACHE = 8
+STREAM_BATCH_SIZE = 10000
+
+# Worker side. The taxonomy, lineage cache and LCA index are handed over once
+# when the pool starts; the per-job state (reference abundances and options)
+# is read from a state file the first time a worker sees a job.
+_shared = {}
+_job_states = OrderedDict()
+
+def init_server_worker(taxonomy, taxonomy_hierarchy, lca):
+    # Pools started by a reload fork after serve() installed its SIGTERM
+    # handler; Pool.terminate needs the default one to stop the workers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _shared.update(
+        taxonomy=taxonomy,
+        taxonomy_hierarchy=taxonomy_hierarchy,
+        lineage_info=classifier.build_lineage_cache(taxonomy_hierarchy),
+        lca=lca
+    )
+
+def run_job_chunk(job_id, state_file, task, function=None):
+    state = _job_states.get(job_id)
+    if state is None:
+        with open(state_file, "rb") as f:
+            ref_abundance, max_candidates, use_lca, lca_min_fraction, profile = pickle.load(f)
+        classifier.init_worker(ref_abundance, _shared["taxonomy"], _shared["taxonomy_hierarchy"], max_candidates,
+                               _shared["lca"] if use_lca else None, lca_min_fraction, profile)
+        # Keep the warm lineage cache instead of the fresh one init_worker made
+        classifier._worker_state["lineage_info"] = _shared["lineage_info"]
+        state = _job_states[job_id] = dict(classifier._worker_state)
+        while len(_job_states) > JOB_STATE_CACHE:
+            _job_states.popitem(last=False)
+    else:
+        _job_states.move_to_end(job_id)
+
+    classifier._worker_state.clear()
+    classifier._worker_state.update(state)
+    return (function or classifier.process_chunk)(task)
+
+def write_job_state(state_file, ref_abundance, settings):
+    # The per-job worker state run_job_chunk loads on a worker's first chunk
+    with open(state_file, "wb") as f:
+        pickle.dump((ref_abundance,) + settings, f, pickle.HIGHEST_PROTOCOL)
+
+def taxonomy_signature(files):
+    # main.pl rewrites the taxonomy files of every run in place, so the paths
+    # alone do not tell whether the loaded taxonomy is still current
+    signature = []
+    for path in files:
+        if path:
+            stat = os.stat(path)
+            signature.append((path, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        else:
+            signature.append(None)
+    return tuple(signature)
+
+class LoadedTaxonomy:
+    """
+    One version of the taxonomy files with the worker pool that holds it.
+    """
+
+    def __init__(self, files, signature, processes):
+        taxonomy_file, hierarchy_file, index_file = files
+        self.files = files
+        self.signature = signature
+        self.taxonomy, self.taxonomy_hierarchy = classifier.load_taxonomy(taxonomy_file, hierarchy_file, index_file)
+
+        parents = classifier.load_taxonomy_parents(hierarchy_file, index_file)
+        self.lca = TaxonomyLCA(parents, set(self.taxonomy.values()))
+        logging.info(f"Built LCA index over {len(self.lca.taxids)} taxa")
+        del parents
+
+        self.pool = Pool(processes, initializer=init_server_worker,
+                         initargs=(self.taxonomy, self.taxonomy_hierarchy, self.lca))
+        self.nodes = None
+        self.jobs = 0
+        self.retired = False
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+class ClassificationService:
+    """
+    Taxonomy, indexes and a worker pool loaded once and shared by all jobs.
+
+    A job is a dict with the classifier options: format ("paf" or "mashmap"),
+    input (a path, or "-" for PAF streamed after the request), output,
+    max_candidates, mode, lca_min_fraction, streaming, parquet,
+    abundance_profile, sample_id, paf_archive and metrics. MashMap jobs can
+    also set memory_budget (MB), partitions and spill_dir to run out of core.
+
+    Jobs also name their taxonomy, hierarchy and index files. When these are
+    not the files currently loaded, or have changed on disk since, the
+    taxonomy is reloaded with a new worker pool; the old pool is closed once
+    the jobs still using it are done.
+    """
+
+    def __init__(self, taxonomy_file, hierarchy_file, index_file=None, processes=4):
+        self.processes = processes
+        files = (taxonomy_file, hierarchy_file, index_file)
+        self.loaded = LoadedTaxonomy(files, taxonomy_signature(files), processes)
+        self.state_dir = tempfile.mkdtemp(prefix="hymet_server_")
+        self._job_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._retired = []
+        self.started = time.time()
+        self.jobs = 0
+        self.reloads = 0
+
+    def _acquire_taxonomy(self, job):
+        # Returns the LoadedTaxonomy for the job's files, reloading it if needed
+        files = tuple(job.get(key) for key in ("taxonomy", "hierarchy", "index"))
+        if not any(files):
+            files = self.loaded.files  # clients that do not send their files
+        elif files[2] is None and (files[0] is None or files[1] is None):
+            raise ValueError("taxonomy and hierarchy are required unless index is given")
+        with self._reload_lock:
+            signature = taxonomy_signature(files)
+            if signature != self.loaded.signature:
+                logging.info(f"Taxonomy files changed ({', '.join(path for path in files if path)}); reloading")
+                loaded = LoadedTaxonomy(files, signature, self.processes)
+                with self._lock:
+                    old, self.loaded = self.loaded, loaded
+                    old.retired = True
+                    if old.jobs:
+                        self._retired.append(old)
+                    self.reloads += 1
+                if not old.jobs:
+                    old.close()
+            with self._lock:
+                self.loaded.jobs += 1
+                return self.loaded
+
+    def _release_taxonomy(self, loaded):
+        with self._lock:
+            loaded.jobs -= 1
+            done = loaded.retired and not loaded.jobs
+            if done:
+                self._retired.remove(loaded)
+        if done:
+            loaded.close()
+
+    def nodes(self, loaded):
+        with self._lock:
+            if loaded.nodes is None:
+                _, hierarchy_file, index_file = loaded.files
+                loaded.nodes = load_taxonomy_nodes(hierarchy_file, index_file)
+            return loaded.nodes
+
+    def _read_alignments(self, job, stream, spool_file, pool, settle):
+        # Returns the reference abundances, the (query, refs) iterable and the
+        # query count (None when queries are streamed). A piped PAF is spooled
+        # instead, its settled queries classified by settle as it arrives, and
+        # the iterable is None.
+        if spool_file is not None:
+            chunk_size = classifier.choose_chunksize(STREAM_BATCH_SIZE, self.processes)
+            with open_input(job["input"], source=stream) as lines:
+                ref_abundance = classificationminimap.spool_paf_stream(
+                    lines, spool_file, pool, chunk_size, self.processes * 4, job.get("paf_archive"), settle)
+            return ref_abundance, None, None
+        if job["format"] == "paf":
+            return classificationminimap.read_alignments(job["input"], job.get("streaming", False))
+        query_map, ref_abundance = classificationmashmap.parse_mashmap_file(job["input"])
+        return ref_abundance, query_map.items(), len(query_map)
+
+    def classify(self, job, stream=None):
+        if job.get("format") not in ("paf", "mashmap"):
+            raise ValueError("format must be 'paf' or 'mashmap'")
+        max_candidates = min(10, max(1, int(job.get("max_candidates", 5))))
+        mode = job.get("mode", "top")
+        profile_file = job.get("abundance_profile")
+        output_file = job["output"]
+        if mode not in ("top", "lca"):
+            raise ValueError("mode must be 'top' or 'lca'")
+        if job.get("parquet"):
+            require_pyarrow()
+        if job["input"] == "-" and job["format"] != "paf":
+            raise ValueError("Only PAF input can be streamed")
+        memory_budget = job.get("memory_budget")
+        partitions = job.get("partitions")
+        if (memory_budget or partitions) and job["format"] != "mashmap":
+            raise ValueError("memory_budget and partitions are only supported for MashMap input")
+
+        settings = (max_candidates, mode == "lca", float(job.get("lca_min_fraction", 0.0)), profile_file is not None)
+        job_id = next(self._job_ids)
+        metrics = StageMetrics("classification_server", job.get("metrics"))
+        state_file = os.path.join(self.state_dir, f"job_{job_id}.state")
+        settle_state_file = os.path.join(self.state_dir, f"job_{job_id}.settle")
+        spool_file = os.path.join(self.state_dir, f"job_{job_id}.spool") if job["input"] == "-" else None
+        partition_count = partitions or (classificationmashmap.estimate_partitions(job["input"], memory_budget)
+                                         if memory_budget else None)
+        spill_dir = None
+        start = time.perf_counter()
+        with metrics.stage("load_taxonomy") as record:
+            loaded = self._acquire_taxonomy(job)
+            record["accessions"] = len(loaded.taxonomy)
+        try:
+            if partition_count:
+                spill_root = job.get("spill_dir") or self.state_dir
+                os.makedirs(spill_root, exist_ok=True)
+                spill_dir = tempfile.mkdtemp(prefix=f"job_{job_id}_spill_", dir=spill_root)
+            with metrics.stage("read_alignments") as record:
+                if partition_count:
+                    ref_abundance, partition_files = classificationmashmap.partition_mashmap_file(
+                        job["input"], spill_dir, partition_count)
+                    record["partitions"] = partition_count
+                else:
+                    settle = None
+                    if spool_file is not None:
+                        # Settled queries need no abundances, so their workers get an empty table
+                        write_job_state(settle_state_file, {}, settings)
+                        settle = partial(run_job_chunk, (job_id, "settle"), settle_state_file,
+                                         function=classifier.process_settled_chunk)
+                    ref_abundance, queries, query_count = self._read_alignments(
+                        job, stream, spool_file, loaded.pool, settle)
+                record["references"] = len(ref_abundance)
+
+            write_job_state(state_file, ref_abundance, settings)
+            function = partial(run_job_chunk, job_id, state_file)
+
+            classified = 0
+            total = 0
+            taxid_counts = Counter()
+            with metrics.stage("classify") as record:
+                with open_output(output_file) as f, open_results_store(job.get("parquet")) as store:
+                    writer = csv.writer(f, delimiter='\t')
+                    writer.writerow(['Query', 'Confidence', 'Lineage', 'Taxonomic Level'])
+
+                    if partition_count:
+                        result_files, taxid_counts = classificationmashmap.classify_partitions(
+                            loaded.pool, partition_files, self.processes, function)
+                        batches = ((results, None)
+                                   for results in classificationmashmap.iter_merged_results(result_files))
+                    elif spool_file is not None:
+                        batches = classificationminimap.iter_spooled_results(
+                            loaded.pool, spool_file, self.processes * 4, function)
+                    else:
+                        chunk_size = classifier.choose_chunksize(
+                            STREAM_BATCH_SIZE if query_count is None else query_count, self.processes)
+                        chunks = classifier.iter_query_batches(queries, chunk_size)
+                        batches = classifier.iter_ordered_results(loaded.pool, chunks, self.processes * 4, function)
+                    for results, counts in batches:
+                        classified += classifier.write_results(writer, results, max_candidates)
+                        if store is not None:
+                            store.write(results, max_candidates)
+                        if counts:
+                            taxid_counts.update(counts)
+                        total += len(results)
+                        f.flush()
+                record["queries"] = total
+                record["classified"] = classified
+
+            if profile_file:
+                with metrics.stage("abundance_profile"):
+                    parents, ranks, names = self.nodes(loaded)
+                    write_cami_profile(profile_file, build_profile(taxid_counts, parents, ranks, names), total,
+                                       job.get("sample_id") or os.path.basename(output_file).split(".")[0])
+        finally:
+            self._release_taxonomy(loaded)
+            for path in (state_file, settle_state_file, spool_file):
+                if path is not None and os.path.exists(path):
+                    os.remove(path)
+            if spill_dir is not None:
+                shutil.rmtree(spill_dir, ignore_errors=True)
+
+        with self._lock:
+            self.jobs += 1
+        seconds = time.perf_counter() - start
+        logging.info(f"Job {job_id}: classified {classified}/{total} queries from {job['input']} "
+                     f"in {seconds:.2f}s")
+        return {"job": job_id, "queries": total, "classified": classified, "seconds": round(seconds, 3)}
+
+    def status(self):
+        return {"taxa": len(self.loaded.lca.taxids), "processes": self.processes, "jobs": self.jobs,
+                "reloads": self.reloads, "uptime_seconds": round(time.time() - self.started, 1)}
+
+    def close(self):
+        for loaded in [self.loaded] + self._retired:
+            loaded.close()
+        for name in os.listdir(self.state_dir):
+            os.remove(os.path.join(self.state_dir, name))
+        os.rmdir(self.state_dir)
+
+class JobHandler(socketserver.StreamRequestHandler):
+    # One JSON request line (plus the PAF stream for input "-"), one JSON reply line
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            if request.get("command") == "ping":
+                reply = dict(status="ok", **self.server.service.status())
+            else:
+                reply = dict(status="ok", **self.server.service.classify(request, self.rfile))
+        except Exception as error:
+            logging.exception("Job failed")
+            reply = {"status": "error", "message": f"{type(error).__name__}: {error}"}
+        self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+
+class ClassificationServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, service):
+        self.service = service
+        super().__init__(socket_path, JobHandler)
+
+def serve(socket_path, service):
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = ClassificationServer(socket_path, service)
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    logging.info(f"Listening on {socket_path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        service.close()
+        logging.info("Server stopped")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Classification server: keeps the taxonomy loaded and "
+                                                 "classifies jobs sent by classification_client.py")
+    parser.add_argument("--socket", required=True, help="Unix socket to listen on")
+    parser.add_argument("--taxonomy", help="Taxonomy mapping file")
+    parser.add_argument("--hierarchy", help="Taxonomy hierarchy file")
+    parser.add_argument("--index", help="Compiled taxonomy index (replaces --hierarchy, and --taxonomy "
+                                        "when it holds the accession table)")
+    parser.add_argument("--processes", type=int, default=4, help="Number of worker processes shared by all jobs")
+
+    args = parser.parse_args()
+
+    if args.index is None and (args.taxonomy is None or args.hierarchy is None):
+        parser.error("--taxonomy and --hierarchy are required unless --index is given")
+
+    serve(args.socket, ClassificationService(args.taxonomy, args.hierarchy, args.index, args.processes))
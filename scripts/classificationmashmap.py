@@ -396,183 +396,308 @@
 #!/usr/bin/env python3
 import os
 import csv
-from collections import defaultdict
+from collections import Counter, defaultdict
 import argparse
 from multiprocessing import Pool
 import logging
-import sys
+import math
+import pickle
+import shutil
+import tempfile
+import zlib
 from operator import itemgetter
-
-csv.field_size_limit(sys.maxsize)
+import heapq
+from functools import partial
+
+from abundance_profile import load_taxonomy_nodes, build_profile, write_cami_profile
+from batch_scoring import process_batch, read_hit_table, require_numpy, write_formatted
+from classification_core import (choose_chunksize, init_worker, iter_ordered_results, iter_query_batches,
+                                 load_taxonomy, load_taxonomy_parents, process_chunk, write_results)
+from compressed_io import detect_compression, open_input, open_output
+from results_store import open_results_store, require_pyarrow
+from run_metrics import StageMetrics, profiling
+from taxonomy_lca import TaxonomyLCA
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def load_taxonomy_file(taxonomy_file):
-    taxonomy = {}
-    with open(taxonomy_file, "r") as f:
-        reader = csv.DictReader(f, delimiter="\t")
-        for row in reader:
-            taxid = row["TaxID"]
-            for identifier in row["Identifiers"].split(";"):
-                cleaned_id = identifier.strip()
-                if cleaned_id:
-                    taxonomy[cleaned_id] = taxid
-    logging.info(f"Loaded {len(taxonomy)} taxonomy mappings")
-    return taxonomy
-
-def load_taxonomy_hierarchy_file(taxonomy_hierarchy_file):
-    hierarchy = {}
-    with open(taxonomy_hierarchy_file, "r") as f:
-        reader = csv.DictReader(f, delimiter="\t")
-        for row in reader:
-            taxid = row["TaxID"]
-            hierarchy[taxid] = row["Lineage"].strip()
-    logging.info(f"Loaded {len(hierarchy)} taxonomy hierarchies")
-    return hierarchy
+def parse_mashmap_line(line):
+    parts = line.strip().split("\t")
+    if len(parts) < 14:  # Ensure enough columns exist
+        return None
 
-def parse_mashmap_file(mashmap_file):
-    query_map = defaultdict(list)
-    ref_counts = defaultdict(int)
+    query_id = parts[0]       # Query sequence name
+    query_len = int(parts[1]) # Query sequence length
+    ref_id = parts[5]        # Reference sequence name
 
-    with open(mashmap_file, "r") as f:
-        for line in f:
-            parts = line.strip().split("\t")
-            if len(parts) < 14:  # Ensure enough columns exist
-                continue
+    start_query = int(parts[2])  # Query start position
+    end_query = int(parts[3])    # Query end position
 
-            query_id = parts[0]       # Query sequence name
-            query_len = int(parts[1]) # Query sequence length
-            ref_id = parts[5]        # Reference sequence name
+    align_len = end_query - start_query  # Calculate alignment length
 
-            start_query = int(parts[2])  # Query start position
-            end_query = int(parts[3])    # Query end position
+    identity_str = parts[12]  # e.g., "id:f:1"
+    identity = float(identity_str.split(":")[2]) if "id:f:" in identity_str else 0.0
 
-            align_len = end_query - start_query  # Calculate alignment length
+    coverage = align_len / query_len if query_len > 0 else 0
+    is_exact = (identity >= 0.99) and (coverage >= 0.9)
 
-            identity_str = parts[12]  # e.g., "id:f:1"
-            identity = float(identity_str.split(":")[2]) if "id:f:" in identity_str else 0.0
+    return query_id, ref_id, coverage, is_exact
+
+def parse_mashmap_file(mashmap_file):
+    query_map = defaultdict(list)
+    ref_counts = defaultdict(int)
 
-            coverage = align_len / query_len if query_len > 0 else 0
-            is_exact = (identity >= 0.99) and (coverage >= 0.9)
+    with open_input(mashmap_file) as f:
+        for line in f:
+            hit = parse_mashmap_line(line)
+            if hit is None:
+                continue
 
+            query_id, ref_id, coverage, is_exact = hit
             query_map[query_id].append((ref_id, coverage, is_exact))
             ref_counts[ref_id] += 1
 
     logging.info(f"Processed {len(query_map)} queries from Mashmap file")
     return query_map, ref_counts
 
-def determine_taxonomic_level(lineage):
-    rank_order = [
-        'superkingdom', 'phylum', 'class', 'order',
-        'family', 'genus', 'species', 'strain'
-    ]
-    
-    current_level = None
-    for part in lineage.split(';'):
-        part = part.strip()
-        if ':' in part:
-            rank, name = part.split(':', 1)
-            rank = rank.strip().lower()
-            if rank in rank_order:
-                if current_level is None:
-                    current_level = rank
-                else:
-                    current_index = rank_order.index(current_level)
-                    new_index = rank_order.index(rank)
-                    if new_index > current_index:
-                        current_level = rank
-    return current_level if current_level is not None else 'root'
-
-def calculate_weighted_lineage(refs, ref_abundance, taxonomy):
-    taxid_weights = defaultdict(float)
-    total_weight = 0.0
-    
-    for ref_id, coverage, _ in refs:
-        if ref_id not in taxonomy:
-            continue
-            
-        taxid = taxonomy[ref_id]
-        weight = coverage * ref_abundance.get(ref_id, 1)
-        taxid_weights[taxid] += weight
-        total_weight += weight
-    
-    return taxid_weights, total_weight
-
-def get_top_lineages(taxid_weights, total_weight, taxonomy_hierarchy, max_options):
-    if total_weight == 0:
-        return [("Unknown", "root", 0.0)]
-
-    lineage_scores = []
-    for taxid, weight in taxid_weights.items():
-        if taxid in taxonomy_hierarchy:
-            lineage = taxonomy_hierarchy[taxid]
-            level = determine_taxonomic_level(lineage)
-            confidence = weight / total_weight
-            lineage_scores.append((lineage, level, confidence))
-    
-    # Sort by confidence score descending and limit to max_options
-    lineage_scores.sort(key=itemgetter(2), reverse=True)
-    return lineage_scores[:max_options] if lineage_scores else [("Unknown", "root", 0.0)]
-
-def process_query(args):
-    query, refs, ref_abundance, taxonomy, taxonomy_hierarchy, max_candidates = args
-    
-    # Check for exact matches first
-    exact_matches = [ref for ref, _, is_exact in refs if is_exact and ref in taxonomy]
-    if exact_matches:
-        taxid = taxonomy[exact_matches[0]]
-        if taxid in taxonomy_hierarchy:
-            lineage = taxonomy_hierarchy[taxid]
-            level = determine_taxonomic_level(lineage)
-            return (query, [(lineage, level, 1.0)])
-    
-    # Calculate weighted lineages for non-exact matches
-    taxid_weights, total_weight = calculate_weighted_lineage(refs, ref_abundance, taxonomy)
-    top_lineages = get_top_lineages(taxid_weights, total_weight, taxonomy_hierarchy, max_candidates)
-    
-    return (query, top_lineages)
-
-def main_process(mashmap_file, taxonomy_file, hierarchy_file, output_file, processes=4, max_candidates=5):
-    taxonomy = load_taxonomy_file(taxonomy_file)
-    taxonomy_hierarchy = load_taxonomy_hierarchy_file(hierarchy_file)
-    query_map, ref_abundance = parse_mashmap_file(mashmap_file)
-
-    tasks = [(query, refs, ref_abundance, taxonomy, taxonomy_hierarchy, max_candidates) 
-             for query, refs in query_map.items()]
-
-    results = []
-    with Pool(processes) as pool:
-        results = pool.map(process_query, tasks)
+# Out-of-core mode. MashMap output is not grouped by query, so hits are
+# hash-partitioned by query ID into spill files that each fit in memory.
+# Parsed hits take about three times their size in text.
+MEMORY_PER_INPUT_BYTE = 3
+COMPRESSION_RATIO = 5
+MAX_PARTITIONS = 256
+SPILL_BUFFER = 10000
+
+def estimate_partitions(mashmap_file, memory_budget_mb):
+    size = os.path.getsize(mashmap_file)
+    with open(mashmap_file, "rb") as f:
+        if detect_compression(f.read(16)):
+            size *= COMPRESSION_RATIO
+    needed = size * MEMORY_PER_INPUT_BYTE / (memory_budget_mb * 1024 * 1024)
+    return max(1, min(MAX_PARTITIONS, math.ceil(needed)))
+
+def partition_mashmap_file(mashmap_file, spill_dir, partitions):
+    # One pass: counts reference hits and spills every hit, tagged with its
+    # line number, to the partition of its query
+    ref_counts = defaultdict(int)
+    paths = [os.path.join(spill_dir, f"partition_{number:04d}.hits") for number in range(partitions)]
+    spills = [open(path, "wb") for path in paths]
+    buffers = [[] for _ in range(partitions)]
+    hits = 0
+
+    try:
+        with open_input(mashmap_file) as f:
+            for line_number, line in enumerate(f):
+                hit = parse_mashmap_line(line)
+                if hit is None:
+                    continue
+
+                query_id, ref_id, coverage, is_exact = hit
+                ref_counts[ref_id] += 1
+                hits += 1
+                partition = zlib.crc32(query_id.encode("utf-8")) % partitions
+                buffer = buffers[partition]
+                buffer.append((line_number, query_id, ref_id, coverage, is_exact))
+                if len(buffer) >= SPILL_BUFFER:
+                    pickle.dump(buffer, spills[partition], pickle.HIGHEST_PROTOCOL)
+                    buffer.clear()
+
+        for buffer, spill in zip(buffers, spills):
+            if buffer:
+                pickle.dump(buffer, spill, pickle.HIGHEST_PROTOCOL)
+    finally:
+        for spill in spills:
+            spill.close()
+
+    logging.info(f"Spilled {hits} hits into {partitions} partitions")
+    return ref_counts, paths
+
+def iter_spilled(path):
+    with open(path, "rb") as spill:
+        while True:
+            try:
+                yield from pickle.load(spill)
+            except EOFError:
+                return
+
+def load_partition(path):
+    # Queries come out in order of their first hit, as in parse_mashmap_file
+    query_map = {}
+    first_lines = {}
+    for line_number, query_id, ref_id, coverage, is_exact in iter_spilled(path):
+        refs = query_map.get(query_id)
+        if refs is None:
+            refs = query_map[query_id] = []
+            first_lines[query_id] = line_number
+        refs.append((ref_id, coverage, is_exact))
+    return query_map, first_lines
+
+def classify_partitions(pool, partition_files, processes, function=None):
+    # Partitions are classified one after the other, each by the whole pool.
+    # Results are spilled tagged with the query's first line for the merge.
+    result_files = []
+    taxid_counts = Counter()
+    for partition_file in partition_files:
+        query_map, first_lines = load_partition(partition_file)
+        os.remove(partition_file)
+        result_file = partition_file[:-len(".hits")] + ".results"
+        chunks = iter_query_batches(query_map.items(), choose_chunksize(len(query_map), processes))
+        with open(result_file, "wb") as spill:
+            for results, counts in iter_ordered_results(pool, chunks, processes * 4,
+                                                        function or process_chunk):
+                tagged = [(first_lines[query], query, lineages) for query, lineages in results]
+                pickle.dump(tagged, spill, pickle.HIGHEST_PROTOCOL)
+                if counts:
+                    taxid_counts.update(counts)
+        result_files.append(result_file)
+        del query_map, first_lines
+    return result_files, taxid_counts
+
+def iter_merged_results(result_files, batch_size=SPILL_BUFFER):
+    # k-way merge on the first line restores the in-memory output order
+    merged = heapq.merge(*(iter_spilled(path) for path in result_files), key=itemgetter(0))
+    batch = []
+    for _, query, lineages in merged:
+        batch.append((query, lineages))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def main_process(mashmap_file, taxonomy_file, hierarchy_file, output_file, processes=4, max_candidates=5,
+                 index_file=None, mode="top", lca_min_fraction=0.0, metrics=None, parquet_file=None, profile_file=None,
+                 sample_id=None, memory_budget=None, partitions=None, spill_dir=None, engine="python"):
+    metrics = metrics or StageMetrics("classificationmashmap")
+    if engine == "numpy":
+        require_numpy()
+        if mode != "top" or memory_budget or partitions:
+            raise ValueError("The numpy engine only supports --mode top without out-of-core mode")
+
+    partition_count = partitions or (estimate_partitions(mashmap_file, memory_budget) if memory_budget else None)
+    if partition_count:
+        spill_dir = spill_dir or os.path.dirname(os.path.abspath(output_file))
+        os.makedirs(spill_dir, exist_ok=True)
+        spill_dir = tempfile.mkdtemp(prefix="hymet_spill_", dir=spill_dir)
+    try:
+        with metrics.stage("load_taxonomy") as record:
+            taxonomy, taxonomy_hierarchy = load_taxonomy(taxonomy_file, hierarchy_file, index_file)
+            record["accessions"] = len(taxonomy)
+        with metrics.stage("read_alignments") as record:
+            if partition_count:
+                ref_abundance, partition_files = partition_mashmap_file(mashmap_file, spill_dir, partition_count)
+                record["partitions"] = partition_count
+            elif engine == "numpy":
+                query_map, ref_abundance = read_hit_table(mashmap_file, parse_mashmap_line, "Mashmap")
+                record["queries"] = len(query_map)
+            else:
+                query_map, ref_abundance = parse_mashmap_file(mashmap_file)
+                record["queries"] = len(query_map)
+            record["references"] = len(ref_abundance)
+            record["hits"] = sum(ref_abundance.values())
+
+        if parquet_file:
+            require_pyarrow()
+
+        lca = None
+        if mode == "lca":
+            with metrics.stage("lca_index") as record:
+                parents = load_taxonomy_parents(hierarchy_file, index_file)
+                lca = TaxonomyLCA(parents, set(taxonomy.values()))
+                logging.info(f"Built LCA index over {len(lca.taxids)} taxa")
+                del parents
+                record["taxa"] = len(lca.taxids)
+
+        initargs = (ref_abundance, taxonomy, taxonomy_hierarchy, max_candidates, lca, lca_min_fraction,
+                    profile_file is not None)
 
-    with open(output_file, 'w') as f:
-        writer = csv.writer(f, delimiter='\t')
-        writer.writerow(['Query', 'Confidence', 'Lineage', 'Taxonomic Level'])
-        
         classified = 0
-        for query, lineages in results:
-            primary_lineage = lineages[0][0]
-            if primary_lineage != 'Unknown':
-                classified += 1
-            
-            # Write each lineage (up to max_candidates) as separate rows
-            for lineage, level, confidence in lineages[:max_candidates]:
-                writer.writerow([query, f"{confidence:.4f}", lineage, level])
-
-    logging.info(f"Classification complete. Results saved to {output_file}")
-    logging.info(f"Classified: {classified}/{len(results)} ({classified/len(results):.1%})")
-    logging.info(f"Maximum candidates shown per query: {max_candidates}")
+        total = 0
+        taxid_counts = Counter()
+        with metrics.stage("classify") as record:
+            with open_output(output_file) as f, open_results_store(parquet_file) as store, \
+                    Pool(processes, initializer=init_worker, initargs=initargs) as pool:
+                writer = csv.writer(f, delimiter='\t')
+                writer.writerow(['Query', 'Confidence', 'Lineage', 'Taxonomic Level'])
+
+                if partition_count:
+                    result_files, taxid_counts = classify_partitions(pool, partition_files, processes)
+                    batches = ((results, None) for results in iter_merged_results(result_files))
+                elif engine == "numpy":
+                    # Chunks go out as columns and come back as TSV text (and Parquet columns)
+                    batches = iter_ordered_results(pool, query_map.batches(choose_chunksize(len(query_map), processes)),
+                                                   processes * 4, partial(process_batch, columns=store is not None))
+                else:
+                    # Rows reach the file in input order as soon as their chunk is done
+                    chunk_size = choose_chunksize(len(query_map), processes)
+                    chunks = iter_query_batches(query_map.items(), chunk_size)
+                    batches = iter_ordered_results(pool, chunks, processes * 4)
+
+                for results, counts in batches:
+                    if engine == "numpy":
+                        classified += write_formatted(f, store, results)
+                    else:
+                        classified += write_results(writer, results, max_candidates)
+                        if store is not None:
+                            store.write(results, max_candidates)
+                    if counts:
+                        taxid_counts.update(counts)
+                    total += len(results)
+                    f.flush()
+            record["queries"] = total
+            record["classified"] = classified
+
+        if profile_file:
+            with metrics.stage("abundance_profile") as record:
+                parents, ranks, names = load_taxonomy_nodes(hierarchy_file, index_file)
+                profile = build_profile(taxid_counts, parents, ranks, names)
+                write_cami_profile(profile_file, profile, total,
+                                   sample_id or os.path.basename(output_file).split(".")[0])
+                record["taxa"] = len(profile)
+
+        logging.info(f"Classification complete. Results saved to {output_file}")
+        logging.info(f"Classified: {classified}/{total} ({classified/total:.1%})")
+        logging.info(f"Maximum candidates shown per query: {max_candidates}")
+    finally:
+        if partition_count:
+            shutil.rmtree(spill_dir, ignore_errors=True)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Advanced LCA/Best Match Taxonomic Classifier for Mashmap")
-    parser.add_argument("--mashmap", required=True, help="Input Mashmap file")
-    parser.add_argument("--taxonomy", required=True, help="Taxonomy mapping file")
-    parser.add_argument("--hierarchy", required=True, help="Taxonomy hierarchy file")
-    parser.add_argument("--output", required=True, help="Output TSV file")
+    parser.add_argument("--mashmap", required=True, help="Input Mashmap file (plain, gzip, bgzip or zstd)")
+    parser.add_argument("--taxonomy", help="Taxonomy mapping file")
+    parser.add_argument("--hierarchy", help="Taxonomy hierarchy file")
+    parser.add_argument("--index", help="Compiled taxonomy index (replaces --hierarchy, and --taxonomy "
+                                        "when it holds the accession table)")
+    parser.add_argument("--output", required=True, help="Output TSV file (compressed if it ends in .gz or .zst)")
     parser.add_argument("--processes", type=int, default=4, help="Number of parallel processes")
     parser.add_argument("--max-candidates", type=int, default=5, 
                        help="Maximum number of candidate classifications to show (1-10)")
+    parser.add_argument("--mode", choices=["top", "lca"], default="top",
+                       help="Output the top weighted candidates or their lowest common ancestor")
+    parser.add_argument("--lca-min-fraction", type=float, default=0.0,
+                       help="In LCA mode, ignore candidates below this share of a query's weight")
+    parser.add_argument("--engine", choices=["python", "numpy"], default="python",
+                       help="Scoring engine: per-query Python, or NumPy over whole chunks "
+                            "(--mode top without out-of-core mode only; same output, faster)")
+    parser.add_argument("--parquet", help="Also write the results to this Parquet file (requires pyarrow)")
+    parser.add_argument("--abundance-profile", help="Also write a CAMI abundance profile to this file")
+    parser.add_argument("--sample-id", help="Sample ID of the abundance profile (default: output file name)")
+    parser.add_argument("--memory-budget", type=int,
+                       help="Out-of-core mode: spill hits to disk in query partitions that each fit "
+                            "in this many MB")
+    parser.add_argument("--partitions", type=int, help="Out-of-core mode with this many partitions")
+    parser.add_argument("--spill-dir", help="Directory for the out-of-core spill files "
+                                            "(default: the output directory)")
+    parser.add_argument("--metrics", help="Append per-stage metrics as JSON lines to this file "
+                                          "(default: $HYMET_METRICS, if set)")
+    parser.add_argument("--profile", help="Write cProfile statistics of the main process to this file")
     
     args = parser.parse_args()
+
+    if args.index is None and (args.taxonomy is None or args.hierarchy is None):
+        parser.error("--taxonomy and --hierarchy are required unless --index is given")
+    if args.engine == "numpy" and (args.mode != "top" or args.memory_budget or args.partitions):
+        parser.error("--engine numpy requires --mode top and no out-of-core mode")
     
     # Validate max-candidates
     if args.max_candidates < 1:
@@ -582,11 +707,23 @@ if __name__ == "__main__":
         args.max_candidates = 10
         logging.warning("max-candidates cannot be greater than 10. Setting to 10.")
     
-    main_process(
-        args.mashmap,
-        args.taxonomy,
-        args.hierarchy,
-        args.output,
-        args.processes,
-        args.max_candidates
-    )
\ No newline at end of file
+    with profiling(args.profile):
+        main_process(
+            args.mashmap,
+            args.taxonomy,
+            args.hierarchy,
+            args.output,
+            args.processes,
+            args.max_candidates,
+            index_file=args.index,
+            mode=args.mode,
+            lca_min_fraction=args.lca_min_fraction,
+            metrics=StageMetrics("classificationmashmap", args.metrics),
+            parquet_file=args.parquet,
+            profile_file=args.abundance_profile,
+            sample_id=args.sample_id,
+            memory_budget=args.memory_budget,
+            partitions=args.partitions,
+            spill_dir=args.spill_dir,
+            engine=args.engine
+        )
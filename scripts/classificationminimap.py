@@ -1,176 +1,369 @@
 #!/usr/bin/env python3
 import os
 import csv
-from collections import defaultdict
+from collections import Counter, defaultdict, deque
 import argparse
 from multiprocessing import Pool
 import logging
-import sys
-from operator import itemgetter
+import gzip
+import pickle
+import subprocess
+import tempfile
+from functools import partial
 
-csv.field_size_limit(sys.maxsize)
+from abundance_profile import load_taxonomy_nodes, build_profile, write_cami_profile
+from batch_scoring import iter_hit_batches, process_batch, read_hit_table, require_numpy, write_formatted
+from classification_core import (choose_chunksize, init_worker, iter_ordered_results, iter_query_batches,
+                                 load_taxonomy, load_taxonomy_parents, process_chunk, process_settled_chunk,
+                                 write_results)
+from compressed_io import open_input, open_output
+from results_store import open_results_store, require_pyarrow
+from run_metrics import StageMetrics, profiling
+from taxonomy_lca import TaxonomyLCA
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def load_taxonomy_file(taxonomy_file):
-    taxonomy = {}
-    with open(taxonomy_file, "r") as f:
-        reader = csv.DictReader(f, delimiter="\t")
-        for row in reader:
-            taxid = row["TaxID"]
-            for identifier in row["Identifiers"].split(";"):
-                cleaned_id = identifier.strip()
-                if cleaned_id:
-                    taxonomy[cleaned_id] = taxid
-    logging.info(f"Loaded {len(taxonomy)} taxonomy mappings")
-    return taxonomy
-
-def load_taxonomy_hierarchy_file(taxonomy_hierarchy_file):
-    hierarchy = {}
-    with open(taxonomy_hierarchy_file, "r") as f:
-        reader = csv.DictReader(f, delimiter="\t")
-        for row in reader:
-            taxid = row["TaxID"]
-            hierarchy[taxid] = row["Lineage"].strip()
-    logging.info(f"Loaded {len(hierarchy)} taxonomy hierarchies")
-    return hierarchy
+def parse_paf_line(line):
+    parts = line.strip().split("\t")
+    if len(parts) < 11:
+        return None
+
+    query_id = parts[0]
+    query_len = int(parts[1])
+    ref_id = parts[5]
+    align_len = int(parts[10])
+
+    coverage = align_len / query_len if query_len > 0 else 0
+    is_exact = (query_id == ref_id) and (coverage >= 0.99)
+
+    return query_id, ref_id, coverage, is_exact
 
 def parse_paf_file(paf_file):
     query_map = defaultdict(list)
     ref_counts = defaultdict(int)
     
-    with open(paf_file, "r") as f:
+    with open_input(paf_file) as f:
         for line in f:
-            parts = line.strip().split("\t")
-            if len(parts) < 11:
+            hit = parse_paf_line(line)
+            if hit is None:
                 continue
-                
-            query_id = parts[0]
-            query_len = int(parts[1])
-            ref_id = parts[5]
-            align_len = int(parts[10])
-            
-            coverage = align_len / query_len if query_len > 0 else 0
-            is_exact = (query_id == ref_id) and (coverage >= 0.99)
-            
+
+            query_id, ref_id, coverage, is_exact = hit
             query_map[query_id].append((ref_id, coverage, is_exact))
             ref_counts[ref_id] += 1
 
     logging.info(f"Processed {len(query_map)} queries from PAF file")
     return query_map, ref_counts
 
-def determine_taxonomic_level(lineage):
-    rank_order = [
-        'superkingdom', 'phylum', 'class', 'order',
-        'family', 'genus', 'species', 'strain'
-    ]
-    
-    current_level = None
-    for part in lineage.split(';'):
-        part = part.strip()
-        if ':' in part:
-            rank, name = part.split(':', 1)
-            rank = rank.strip().lower()
-            if rank in rank_order:
-                if current_level is None:
-                    current_level = rank
-                else:
-                    current_index = rank_order.index(current_level)
-                    new_index = rank_order.index(rank)
-                    if new_index > current_index:
-                        current_level = rank
-    return current_level if current_level is not None else 'root'
-
-def calculate_weighted_lineage(refs, ref_abundance, taxonomy):
-    taxid_weights = defaultdict(float)
-    total_weight = 0.0
-    
-    for ref_id, coverage, _ in refs:
-        if ref_id not in taxonomy:
+def count_paf_references(paf_file):
+    # Cheap first pass for streaming mode: only the reference column is needed
+    # to get the global abundance weights used by calculate_weighted_lineage.
+    ref_counts = defaultdict(int)
+
+    with open_input(paf_file) as f:
+        for line in f:
+            parts = line.strip().split("\t", 11)
+            if len(parts) < 11:
+                continue
+            ref_counts[parts[5]] += 1
+
+    logging.info(f"Counted hits for {len(ref_counts)} references in PAF file")
+    return ref_counts
+
+def group_paf_queries(lines):
+    # minimap2 writes all hits of a query contiguously, so a query is complete
+    # as soon as the next one starts.
+    current_query = None
+    refs = []
+
+    for line in lines:
+        hit = parse_paf_line(line)
+        if hit is None:
             continue
-            
-        taxid = taxonomy[ref_id]
-        weight = coverage * ref_abundance.get(ref_id, 1)
-        taxid_weights[taxid] += weight
-        total_weight += weight
-    
-    return taxid_weights, total_weight
-
-def get_top_lineages(taxid_weights, total_weight, taxonomy_hierarchy, max_options):
-    if total_weight == 0:
-        return [("Unknown", "root", 0.0)]
-
-    lineage_scores = []
-    for taxid, weight in taxid_weights.items():
-        if taxid in taxonomy_hierarchy:
-            lineage = taxonomy_hierarchy[taxid]
-            level = determine_taxonomic_level(lineage)
-            confidence = weight / total_weight
-            lineage_scores.append((lineage, level, confidence))
-    
-    # Sort by confidence score descending and limit to max_options
-    lineage_scores.sort(key=itemgetter(2), reverse=True)
-    return lineage_scores[:max_options] if lineage_scores else [("Unknown", "root", 0.0)]
 
-def process_query(args):
-    query, refs, ref_abundance, taxonomy, taxonomy_hierarchy, max_candidates = args
-    
-    # Check for exact matches first
-    exact_matches = [ref for ref, _, is_exact in refs if is_exact and ref in taxonomy]
-    if exact_matches:
-        taxid = taxonomy[exact_matches[0]]
-        if taxid in taxonomy_hierarchy:
-            lineage = taxonomy_hierarchy[taxid]
-            level = determine_taxonomic_level(lineage)
-            return (query, [(lineage, level, 1.0)])
-    
-    # Calculate weighted lineages for non-exact matches
-    taxid_weights, total_weight = calculate_weighted_lineage(refs, ref_abundance, taxonomy)
-    top_lineages = get_top_lineages(taxid_weights, total_weight, taxonomy_hierarchy, max_candidates)
-    
-    return (query, top_lineages)
+        query_id, ref_id, coverage, is_exact = hit
+        if query_id != current_query:
+            if refs:
+                yield current_query, refs
+            current_query = query_id
+            refs = []
+        refs.append((ref_id, coverage, is_exact))
+
+    if refs:
+        yield current_query, refs
 
-def main_process(paf_file, taxonomy_file, hierarchy_file, output_file, processes=4, max_candidates=5):
-    taxonomy = load_taxonomy_file(taxonomy_file)
-    taxonomy_hierarchy = load_taxonomy_hierarchy_file(hierarchy_file)
+def iter_paf_queries(paf_file):
+    with open_input(paf_file) as f:
+        yield from group_paf_queries(f)
+
+def start_minimap2(index_file, query_files, preset="asm10", threads=None):
+    command = ["minimap2", "-x", preset]
+    if threads:
+        command += ["-t", str(threads)]
+    command += [index_file] + list(query_files)
+    logging.info(f"Running {' '.join(command)}")
+    return subprocess.Popen(command, stdout=subprocess.PIPE, text=True, bufsize=1 << 20)
+
+def spool_paf_stream(lines, spool_file, pool, chunk_size, max_pending, archive_file=None,
+                     function=process_settled_chunk):
+    # A live PAF stream (stdin or minimap2) can only be read once, and the
+    # abundance weights need every hit, so most queries can only be classified
+    # once the stream ends. While the aligner runs, queries are parsed and
+    # grouped, and the pool (set up without abundances) already classifies the
+    # settled ones, whose result does not depend on the weights. Each chunk is
+    # spooled as (size, settled results, unsettled positions, unsettled
+    # queries, settled counts) for iter_spooled_results.
+    ref_counts = defaultdict(int)
+    archive = gzip.open(archive_file, "wt", compresslevel=1) if archive_file else None
+    pending = deque()
+
+    def tee(lines):
+        for line in lines:
+            archive.write(line)
+            yield line
+
+    def chunks():
+        # Runs in the pool's task thread, as the stream arrives
+        grouped = group_paf_queries(tee(lines) if archive is not None else lines)
+        for chunk in iter_query_batches(grouped, chunk_size):
+            for _, refs in chunk:
+                for ref_id, _, _ in refs:
+                    ref_counts[ref_id] += 1
+            pending.append(chunk)
+            yield chunk
+
+    queries = 0
+    settled_queries = 0
+    try:
+        with open(spool_file, "wb") as spool:
+            for settled, positions, counts in iter_ordered_results(pool, chunks(), max_pending, function):
+                chunk = pending.popleft()
+                pickle.dump((len(chunk), settled, positions, [chunk[position] for position in positions], counts),
+                            spool, pickle.HIGHEST_PROTOCOL)
+                queries += len(chunk)
+                settled_queries += len(settled)
+    finally:
+        if archive is not None:
+            archive.close()
+
+    logging.info(f"Spooled {queries} queries hitting {len(ref_counts)} references; {settled_queries} "
+                 f"were classified while the alignments streamed")
+    return ref_counts
+
+def iter_spooled_results(pool, spool_file, max_pending, function=process_chunk):
+    # Second pass of pipe mode: classifies the unsettled queries of each
+    # spooled chunk with the complete abundances and puts them back between
+    # the chunk's settled results, in input order
+    spooled = deque()
+
+    def chunks():
+        with open(spool_file, "rb") as spool:
+            while True:
+                try:
+                    size, settled, positions, queries, counts = pickle.load(spool)
+                except EOFError:
+                    return
+                spooled.append((size, settled, positions, counts))
+                yield queries
+
+    for results, counts in iter_ordered_results(pool, chunks(), max_pending, function):
+        size, settled, positions, settled_counts = spooled.popleft()
+        merged = [None] * size
+        for position, result in settled:
+            merged[position] = result
+        for position, result in zip(positions, results):
+            merged[position] = result
+        if settled_counts:
+            counts = counts + settled_counts if counts else settled_counts
+        yield merged, counts
+
+def spool_alignments(aligner, spool_file, pool, chunk_size, max_pending, paf_archive=None):
+    # Pipe mode: spools minimap2's output, or the PAF piped to stdin, and
+    # returns the reference abundances
+    if aligner is not None:
+        with aligner.stdout:
+            ref_abundance = spool_paf_stream(aligner.stdout, spool_file, pool, chunk_size, max_pending, paf_archive)
+        if aligner.wait() != 0:
+            raise RuntimeError(f"minimap2 exited with status {aligner.returncode}")
+        return ref_abundance
+    with open_input("-") as lines:
+        return spool_paf_stream(lines, spool_file, pool, chunk_size, max_pending, paf_archive)
+
+def read_alignments(paf_file, streaming, engine="python"):
+    # Returns the reference abundances, the (query, refs) iterable and the
+    # query count, or None for the count when queries are streamed. The numpy
+    # engine reads a whole file into a columnar HitTable instead.
+    if streaming:
+        return count_paf_references(paf_file), iter_paf_queries(paf_file), None
+    if engine == "numpy":
+        hit_table, ref_abundance = read_hit_table(paf_file, parse_paf_line, "PAF")
+        return ref_abundance, hit_table, len(hit_table)
     query_map, ref_abundance = parse_paf_file(paf_file)
+    return ref_abundance, query_map.items(), len(query_map)
+
+def main_process(paf_file, taxonomy_file, hierarchy_file, output_file, processes=4, max_candidates=5,
+                 streaming=False, batch_size=10000, index_file=None,
+                 mode="top", lca_min_fraction=0.0, minimap2_index=None, query_files=(),
+                 minimap2_preset="asm10", minimap2_threads=None, paf_archive=None, spool_dir=None,
+                 metrics=None, parquet_file=None, profile_file=None, sample_id=None, engine="python"):
+    metrics = metrics or StageMetrics("classificationminimap")
+    if engine == "numpy":
+        require_numpy()
+        if mode != "top" or minimap2_index or paf_file == "-":
+            raise ValueError("The numpy engine only supports --mode top on a PAF file")
+
+    # Started first so minimap2 loads its index while the taxonomy is read
+    aligner = None
+    if minimap2_index:
+        aligner = start_minimap2(minimap2_index, query_files, minimap2_preset, minimap2_threads)
+
+    spool_file = None
+    if aligner is not None or paf_file == "-":
+        fd, spool_file = tempfile.mkstemp(prefix="hymet_", suffix=".spool",
+                                          dir=spool_dir or os.path.dirname(os.path.abspath(output_file)))
+        os.close(fd)
+
+    try:
+        with metrics.stage("load_taxonomy") as record:
+            taxonomy, taxonomy_hierarchy = load_taxonomy(taxonomy_file, hierarchy_file, index_file)
+            record["accessions"] = len(taxonomy)
+
+        if parquet_file:
+            require_pyarrow()
 
-    tasks = [(query, refs, ref_abundance, taxonomy, taxonomy_hierarchy, max_candidates) 
-             for query, refs in query_map.items()]
+        # Built before the alignments are read, as pipe mode classifies while they stream
+        lca = None
+        if mode == "lca":
+            with metrics.stage("lca_index") as record:
+                parents = load_taxonomy_parents(hierarchy_file, index_file)
+                lca = TaxonomyLCA(parents, set(taxonomy.values()))
+                logging.info(f"Built LCA index over {len(lca.taxids)} taxa")
+                del parents
+                record["taxa"] = len(lca.taxids)
 
-    results = []
-    with Pool(processes) as pool:
-        results = pool.map(process_query, tasks)
+        def worker_args(ref_abundance):
+            return (ref_abundance, taxonomy, taxonomy_hierarchy, max_candidates, lca, lca_min_fraction,
+                    profile_file is not None)
+
+        with metrics.stage("read_alignments") as record:
+            if spool_file is not None:
+                # When streaming, about batch_size queries are in flight or waiting to be written at any time
+                query_count = None
+                chunk_size = choose_chunksize(batch_size, processes)
+                with Pool(processes, initializer=init_worker, initargs=worker_args({})) as pool:
+                    ref_abundance = spool_alignments(aligner, spool_file, pool, chunk_size, processes * 4,
+                                                     paf_archive)
+            else:
+                ref_abundance, queries, query_count = read_alignments(paf_file, streaming, engine)
+                chunk_size = choose_chunksize(batch_size if query_count is None else query_count, processes)
+            record["references"] = len(ref_abundance)
+            record["hits"] = sum(ref_abundance.values())
 
-    with open(output_file, 'w') as f:
-        writer = csv.writer(f, delimiter='\t')
-        writer.writerow(['Query', 'Confidence', 'Lineage', 'Taxonomic Level'])
-        
         classified = 0
-        for query, lineages in results:
-            primary_lineage = lineages[0][0]
-            if primary_lineage != 'Unknown':
-                classified += 1
-            
-            # Write each lineage (up to max_candidates) as separate rows
-            for lineage, level, confidence in lineages[:max_candidates]:
-                writer.writerow([query, f"{confidence:.4f}", lineage, level])
+        total = 0
+        taxid_counts = Counter()
+        with metrics.stage("classify") as record:
+            with open_output(output_file) as f, open_results_store(parquet_file) as store, \
+                    Pool(processes, initializer=init_worker, initargs=worker_args(ref_abundance)) as pool:
+                writer = csv.writer(f, delimiter='\t')
+                writer.writerow(['Query', 'Confidence', 'Lineage', 'Taxonomic Level'])
+
+                # Rows reach the file in input order as soon as their chunk is done
+                if spool_file is not None:
+                    batches = iter_spooled_results(pool, spool_file, processes * 4)
+                elif engine == "numpy":
+                    # Chunks go out as columns and come back as TSV text (and Parquet columns)
+                    batches = iter_ordered_results(pool, iter_hit_batches(queries, ref_abundance, chunk_size),
+                                                   processes * 4, partial(process_batch, columns=store is not None))
+                else:
+                    batches = iter_ordered_results(pool, iter_query_batches(queries, chunk_size), processes * 4)
+                for results, counts in batches:
+                    if engine == "numpy":
+                        classified += write_formatted(f, store, results)
+                    else:
+                        classified += write_results(writer, results, max_candidates)
+                        if store is not None:
+                            store.write(results, max_candidates)
+                    if counts:
+                        taxid_counts.update(counts)
+                    total += len(results)
+                    f.flush()
+            record["queries"] = total
+            record["classified"] = classified
 
+        if profile_file:
+            with metrics.stage("abundance_profile") as record:
+                parents, ranks, names = load_taxonomy_nodes(hierarchy_file, index_file)
+                profile = build_profile(taxid_counts, parents, ranks, names)
+                write_cami_profile(profile_file, profile, total,
+                                   sample_id or os.path.basename(output_file).split(".")[0])
+                record["taxa"] = len(profile)
+    finally:
+        if spool_file is not None:
+            os.remove(spool_file)
+        if aligner is not None and aligner.poll() is None:
+            aligner.kill()
+            aligner.wait()
+
+    if query_count is None:
+        logging.info(f"Processed {total} queries from PAF file")
     logging.info(f"Classification complete. Results saved to {output_file}")
-    logging.info(f"Classified: {classified}/{len(results)} ({classified/len(results):.1%})")
+    logging.info(f"Classified: {classified}/{total} ({classified/total:.1%})")
     logging.info(f"Maximum candidates shown per query: {max_candidates}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Advanced LCA/Best Match Taxonomic Classifier")
-    parser.add_argument("--paf", required=True, help="Input PAF file")
-    parser.add_argument("--taxonomy", required=True, help="Taxonomy mapping file")
-    parser.add_argument("--hierarchy", required=True, help="Taxonomy hierarchy file")
-    parser.add_argument("--output", required=True, help="Output TSV file")
+    parser.add_argument("--paf", help="Input PAF file (plain, gzip, bgzip or zstd), or - to read it from stdin "
+                                      "(see --minimap2-index for when piped queries are classified)")
+    parser.add_argument("--taxonomy", help="Taxonomy mapping file")
+    parser.add_argument("--hierarchy", help="Taxonomy hierarchy file")
+    parser.add_argument("--index", help="Compiled taxonomy index (replaces --hierarchy, and --taxonomy "
+                                        "when it holds the accession table)")
+    parser.add_argument("--output", required=True, help="Output TSV file (compressed if it ends in .gz or .zst)")
     parser.add_argument("--processes", type=int, default=4, help="Number of parallel processes")
     parser.add_argument("--max-candidates", type=int, default=5, 
                        help="Maximum number of candidate classifications to show (1-10)")
+    parser.add_argument("--streaming", action="store_true",
+                       help="Classify the PAF query by query instead of loading it whole "
+                            "(requires hits grouped by query, as written by minimap2)")
+    parser.add_argument("--batch-size", type=int, default=10000,
+                       help="Number of queries per worker batch in streaming mode")
+    parser.add_argument("--mode", choices=["top", "lca"], default="top",
+                       help="Output the top weighted candidates or their lowest common ancestor")
+    parser.add_argument("--lca-min-fraction", type=float, default=0.0,
+                       help="In LCA mode, ignore candidates below this share of a query's weight")
+    parser.add_argument("--minimap2-index", help="Run minimap2 against this index and classify its output "
+                                                 "directly, without an intermediate PAF (replaces --paf). "
+                                                 "Queries with an exact match or a single TaxID are "
+                                                 "classified as the alignments stream; the rest depend on "
+                                                 "the reference abundances and wait until minimap2 exits")
+    parser.add_argument("--queries", nargs="+", default=[], help="Query FASTA files for --minimap2-index")
+    parser.add_argument("--minimap2-preset", default="asm10", help="minimap2 -x preset")
+    parser.add_argument("--minimap2-threads", type=int, help="minimap2 -t threads")
+    parser.add_argument("--paf-archive", help="With --paf - or --minimap2-index, also keep the raw PAF "
+                                              "as a gzip file")
+    parser.add_argument("--engine", choices=["python", "numpy"], default="python",
+                        help="Scoring engine: per-query Python, or NumPy over whole chunks "
+                             "(--mode top on a PAF file only; same output, faster)")
+    parser.add_argument("--parquet", help="Also write the results to this Parquet file (requires pyarrow)")
+    parser.add_argument("--abundance-profile", help="Also write a CAMI abundance profile to this file")
+    parser.add_argument("--sample-id", help="Sample ID of the abundance profile (default: output file name)")
+    parser.add_argument("--metrics", help="Append per-stage metrics as JSON lines to this file "
+                                          "(default: $HYMET_METRICS, if set)")
+    parser.add_argument("--profile", help="Write cProfile statistics of the main process to this file")
+    parser.add_argument("--spool-dir", help="Directory for the spool of queries awaiting a piped PAF's end "
+                                            "(default: the output directory)")
     
     args = parser.parse_args()
+
+    if args.index is None and (args.taxonomy is None or args.hierarchy is None):
+        parser.error("--taxonomy and --hierarchy are required unless --index is given")
+    if (args.paf is None) == (args.minimap2_index is None):
+        parser.error("exactly one of --paf and --minimap2-index is required")
+    if args.minimap2_index and not args.queries:
+        parser.error("--minimap2-index requires --queries")
+    if args.engine == "numpy" and (args.mode != "top" or args.paf in (None, "-")):
+        parser.error("--engine numpy requires --mode top and a PAF file")
     
     # Validate max-candidates
     if args.max_candidates < 1:
@@ -180,11 +373,28 @@ if __name__ == "__main__":
         args.max_candidates = 10
         logging.warning("max-candidates cannot be greater than 10. Setting to 10.")
     
-    main_process(
-        args.paf,
-        args.taxonomy,
-        args.hierarchy,
-        args.output,
-        args.processes,
-        args.max_candidates
-    )
\ No newline at end of file
+    with profiling(args.profile):
+        main_process(
+            args.paf,
+            args.taxonomy,
+            args.hierarchy,
+            args.output,
+            args.processes,
+            args.max_candidates,
+            args.streaming,
+            args.batch_size,
+            args.index,
+            args.mode,
+            args.lca_min_fraction,
+            minimap2_index=args.minimap2_index,
+            query_files=args.queries,
+            minimap2_preset=args.minimap2_preset,
+            minimap2_threads=args.minimap2_threads,
+            paf_archive=args.paf_archive,
+            spool_dir=args.spool_dir,
+            metrics=StageMetrics("classificationminimap", args.metrics),
+            parquet_file=args.parquet,
+            profile_file=args.abundance_profile,
+            sample_id=args.sample_id,
+            engine=args.engine
+        )
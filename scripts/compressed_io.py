@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+import io
+import os
+import sys
+import gzip
+import shutil
+import threading
+import subprocess
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:  # the zstd command is used when available
+    zstandard = None
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+DECOMPRESS_THREADS = 4
+COPY_CHUNK = 1 << 20
+
+def detect_compression(header):
+    """
+    Return "bgzip", "gzip", "zstd" or None from the first bytes of a file.
+    """
+    if header.startswith(ZSTD_MAGIC):
+        return "zstd"
+    if header.startswith(GZIP_MAGIC):
+        # BGZF is gzip with an extra field whose subfield ID is "BC"
+        if len(header) >= 14 and header[3] & 4 and header[12:14] == b"BC":
+            return "bgzip"
+        return "gzip"
+    return None
+
+def compression_from_suffix(path):
+    if path.endswith((".gz", ".bgz")):
+        return "gzip"
+    if path.endswith(".zst"):
+        return "zstd"
+    return None
+
+def _decompress_command(compression, threads):
+    # Multi-block formats are decompressed by a separate process (bgzip with
+    # worker threads when installed), so parsing never waits on inflation.
+    if compression == "bgzip" and shutil.which("bgzip"):
+        return ["bgzip", "-dc", "-@", str(threads)]
+    if compression in ("gzip", "bgzip"):
+        if shutil.which("pigz"):
+            return ["pigz", "-dc", "-p", str(threads)]
+        if shutil.which("gzip"):
+            return ["gzip", "-dc"]
+    if compression == "zstd" and shutil.which("zstd"):
+        return ["zstd", "-dc", "-q"]
+    return None
+
+def _compress_command(compression, threads):
+    if compression == "gzip":
+        if shutil.which("pigz"):
+            return ["pigz", "-c", "-p", str(threads)]
+        if shutil.which("gzip"):
+            return ["gzip", "-c"]
+    if compression == "zstd" and shutil.which("zstd"):
+        return ["zstd", "-c", "-q", f"-T{threads}"]
+    return None
+
+def _python_decompressor(compression, source):
+    if compression in ("gzip", "bgzip"):
+        return gzip.GzipFile(fileobj=source, mode="rb")
+    if zstandard is None:
+        raise ImportError("zstd input requires the zstd command or the zstandard module")
+    return zstandard.ZstdDecompressor().stream_reader(source, read_across_frames=True)
+
+def _copy_in_background(source, destination, errors):
+    # Thread body: copy source into destination (a pipe), then close it. A
+    # reader that stopped early shows up as a broken pipe and is not an error.
+    def run():
+        try:
+            while True:
+                chunk = source.read(COPY_CHUNK)
+                if not chunk:
+                    break
+                destination.write(chunk)
+        except BrokenPipeError:
+            pass
+        except Exception as error:
+            errors.append(error)
+        finally:
+            try:
+                destination.close()
+            except BrokenPipeError:
+                pass
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+def _peek_header(stream):
+    return stream.peek(16)[:16] if hasattr(stream, "peek") else b""
+
+@contextmanager
+def open_input(path, threads=DECOMPRESS_THREADS, source=None):
+    """
+    Open a plain, gzip, bgzip or zstd text file (or stdin for "-") for reading.
+    With source, a binary stream such as a socket is read instead and path
+    only names it in error messages; the stream is left open.
+
+    Compressed input is detected from its magic bytes and decompressed
+    concurrently with the caller, by an external process when one is installed
+    or else by a background thread.
+    """
+    if source is None and path == "-":
+        source = sys.stdin.buffer
+    if source is not None:
+        compression = detect_compression(_peek_header(source))
+    else:
+        with open(path, "rb") as f:
+            compression = detect_compression(f.read(16))
+
+    if compression is None:
+        if source is sys.stdin.buffer:
+            yield sys.stdin
+        elif source is not None:
+            lines = io.TextIOWrapper(source, encoding="utf-8")
+            try:
+                yield lines
+            finally:
+                lines.detach()
+        else:
+            with open(path, "r") as f:
+                yield f
+        return
+
+    errors = []
+    threads_started = []
+    process = None
+    command = _decompress_command(compression, threads)
+    owned = None
+    try:
+        if command is not None:
+            if source is None:
+                owned = open(path, "rb")
+                process = subprocess.Popen(command, stdin=owned, stdout=subprocess.PIPE)
+            else:
+                # Bytes already buffered by peek() would be lost if the
+                # process read the descriptor directly, so they are fed through
+                process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                threads_started.append(_copy_in_background(source, process.stdin, errors))
+            stream = io.TextIOWrapper(process.stdout)
+        else:
+            owned = open(path, "rb") if source is None else None
+            read_fd, write_fd = os.pipe()
+            decompressor = _python_decompressor(compression, owned or source)
+            threads_started.append(_copy_in_background(decompressor, os.fdopen(write_fd, "wb"), errors))
+            stream = io.TextIOWrapper(os.fdopen(read_fd, "rb"))
+
+        with stream:
+            yield stream
+            # Reaching the end of the text is only a success if the
+            # decompressor finished cleanly as well
+            for thread in threads_started:
+                thread.join()
+            if process is not None and process.wait() != 0:
+                raise IOError(f"{command[0]} failed to decompress {path} (exit status {process.returncode})")
+            if errors:
+                raise IOError(f"Failed to decompress {path}: {errors[0]}")
+    finally:
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait()
+        if owned is not None:
+            owned.close()
+
+@contextmanager
+def open_output(path, threads=DECOMPRESS_THREADS):
+    """
+    Open a text file for writing, compressed when path ends in .gz/.bgz or .zst.
+
+    Compression runs in a separate process when pigz/gzip or zstd is
+    installed, so it overlaps with the caller.
+    """
+    compression = compression_from_suffix(path)
+    if compression is None:
+        with open(path, "w") as f:
+            yield f
+        return
+
+    command = _compress_command(compression, threads)
+    if command is None:
+        if compression == "gzip":
+            with gzip.open(path, "wt") as f:
+                yield f
+            return
+        if zstandard is None:
+            raise ImportError("zstd output requires the zstd command or the zstandard module")
+        with open(path, "wb") as raw, zstandard.ZstdCompressor().stream_writer(raw) as writer, \
+                io.TextIOWrapper(writer) as f:
+            yield f
+        return
+
+    with open(path, "wb") as raw:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=raw)
+        try:
+            with io.TextIOWrapper(process.stdin) as f:
+                yield f
+            if process.wait() != 0:
+                raise IOError(f"{command[0]} failed to compress {path} (exit status {process.returncode})")
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
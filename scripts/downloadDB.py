@@ -1,19 +1,40 @@
 #!/usr/bin/env python3
+import io
 import os
-import sys
-import gzip
-import shutil
+import zlib
 import csv
+import json
+import time
+import hashlib
+import sqlite3
 import logging
+import argparse
+import threading
 import subprocess
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from collections import defaultdict
+import http.client
+from collections import defaultdict, deque
 from time import sleep
+from urllib.parse import urljoin, urlsplit
+
+from run_metrics import StageMetrics, profiling
+from taxonomy_hierarchy import prune_taxonomy_hierarchy
 
 # Configurações globais
 MAX_WORKERS = 64  # Número máximo de threads para downloads paralelos
+CONCORRENCIA_INICIAL = 16  # Downloads simultâneos no início; o agendador ajusta entre os limites
+CONCORRENCIA_MINIMA = 2
+INTERVALO_AJUSTE = 5  # Segundos entre ajustes da concorrência (e relatórios de progresso)
 RETRIES = 3       # Número máximo de tentativas por download
 TIMEOUT = 15      # Tempo limite (em segundos) para cada tentativa de download
+MAX_CONEXOES_POR_HOST = MAX_WORKERS  # Teto de conexões por host; o DownloadScheduler decide quantas usar
+MAX_REDIRECTS = 5
+HTTP_CHUNK = 1 << 20  # Bytes lidos por vez do corpo da resposta
+
+CATALOG_VERSION = 2  # Aumentar quando o esquema do catálogo mudar
+CATALOG_COLUMNS = ('ftp_path', 'organism_name', 'taxid', 'file_name', 'genome_size')
+CATALOG_BATCH = 500  # Acessos por consulta ao catálogo
+MANIFEST_COLUMNS = ('file_name', 'accession', 'taxid', 'total_bases', 'contigs', 'file_bytes', 'md5', 'verified',
+                    'last_used', 'uses', 'identifiers')
 
 # Configuração de logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -25,6 +46,610 @@ def configurar_diretorios(output_dir, cache_dir):
     os.makedirs(output_dir, exist_ok=True)
     os.makedirs(cache_dir, exist_ok=True)
 
+def ler_assembly_summary(file_path):
+    """
+    Lê um arquivo de sumário de assembly, gerando (acesso, metadados) para cada linha com FTP.
+    """
+    with open(file_path, 'r') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            parts = line.strip().split('\t')
+            if len(parts) > 19 and parts[19]:
+                yield parts[0], (
+                    parts[19].replace('ftp://', 'https://'),
+                    parts[7],
+                    parts[5],
+                    f"{parts[0]}_{parts[1]}.fna",
+                    int(parts[25]) if len(parts) > 25 and parts[25].isdigit() else None
+                )
+
+class AssemblyCatalog:
+    """
+    Catálogo indexado (SQLite) dos sumários de assembly, consultado por acesso.
+
+    O catálogo é gerado uma vez a partir dos sumários em cache e só é refeito
+    quando algum deles muda (tamanho ou data de modificação). As consultas leem
+    apenas os acessos pedidos, então o tempo de inicialização e a memória não
+    dependem do tamanho do GenBank.
+    """
+
+    def __init__(self, catalog_file, summaries):
+        self.catalog_file = catalog_file
+        self.summaries = summaries  # [(chave, arquivo)]; em acessos repetidos vale o último arquivo
+        self._lock = threading.Lock()
+        self._cache = {}
+
+        if self._assinatura_salva() != self._assinatura_atual():
+            self._construir()
+        self._conexao = sqlite3.connect(f"file:{catalog_file}?mode=ro", uri=True, check_same_thread=False)
+
+    def _assinatura_atual(self):
+        files = []
+        for key, file_path in self.summaries:
+            stat = os.stat(file_path)
+            files.append([key, stat.st_size, stat.st_mtime_ns])
+        return json.dumps({"version": CATALOG_VERSION, "files": files})
+
+    def _assinatura_salva(self):
+        if not os.path.exists(self.catalog_file):
+            return None
+        try:
+            conexao = sqlite3.connect(f"file:{self.catalog_file}?mode=ro", uri=True)
+            try:
+                row = conexao.execute("SELECT value FROM meta WHERE key = 'signature'").fetchone()
+            finally:
+                conexao.close()
+        except sqlite3.Error:
+            return None
+        return row[0] if row else None
+
+    def _construir(self):
+        """
+        Gera o catálogo num arquivo temporário e o substitui atomicamente.
+        """
+        logging.info(f"Gerando catálogo de assemblies em {self.catalog_file}...")
+        start = time.perf_counter()
+        temp_file = f"{self.catalog_file}.{os.getpid()}.tmp"
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+        conexao = sqlite3.connect(temp_file)
+        try:
+            conexao.execute("PRAGMA journal_mode = OFF")
+            conexao.execute("PRAGMA synchronous = OFF")
+            conexao.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+            conexao.execute("CREATE TABLE assemblies (accession TEXT PRIMARY KEY, ftp_path TEXT, "
+                            "organism_name TEXT, taxid TEXT, file_name TEXT, genome_size INTEGER) WITHOUT ROWID")
+            for _, file_path in self.summaries:
+                rows = ((accession,) + metadata for accession, metadata in ler_assembly_summary(file_path))
+                conexao.executemany(f"INSERT OR REPLACE INTO assemblies "
+                                    f"VALUES ({', '.join('?' * (len(CATALOG_COLUMNS) + 1))})", rows)
+            conexao.execute("INSERT INTO meta VALUES ('signature', ?)", (self._assinatura_atual(),))
+            conexao.commit()
+            total = conexao.execute("SELECT COUNT(*) FROM assemblies").fetchone()[0]
+        finally:
+            conexao.close()
+        os.replace(temp_file, self.catalog_file)
+        logging.info(f"Catálogo com {total} assemblies gerado em {time.perf_counter() - start:.1f}s")
+
+    def carregar(self, accessions):
+        """
+        Consulta de uma vez os acessos ainda não consultados, em lotes.
+        """
+        with self._lock:
+            pendentes = [accession for accession in set(accessions) if accession not in self._cache]
+            for i in range(0, len(pendentes), CATALOG_BATCH):
+                lote = pendentes[i:i + CATALOG_BATCH]
+                for accession in lote:
+                    self._cache[accession] = None
+                rows = self._conexao.execute(
+                    f"SELECT accession, {', '.join(CATALOG_COLUMNS)} FROM assemblies "
+                    f"WHERE accession IN ({', '.join('?' * len(lote))})", lote)
+                for row in rows:
+                    self._cache[row[0]] = dict(zip(CATALOG_COLUMNS, row[1:]))
+
+    def get(self, accession, default=None):
+        if accession not in self._cache:
+            self.carregar([accession])
+        metadata = self._cache[accession]
+        return metadata if metadata is not None else default
+
+    def __contains__(self, accession):
+        return self.get(accession) is not None
+
+class ErroHTTP(IOError):
+    def __init__(self, url, status, reason):
+        self.status = status
+        super().__init__(f"HTTP {status} {reason}: {url}")
+
+class ErroRetomada(IOError):
+    """
+    O servidor não continuou o download do ponto pedido (ignorou o Range ou recusou o intervalo).
+    """
+
+class ErroChecksum(IOError):
+    pass
+
+class HTTPConnectionPool:
+    """
+    Downloads HTTP/HTTPS por conexões persistentes (keep-alive) reutilizadas.
+
+    Cada host tem no máximo max_per_host conexões em uso ao mesmo tempo; uma
+    conexão volta ao pool quando a resposta foi lida até o fim e o servidor não
+    pediu para fechá-la, evitando um novo handshake TLS por arquivo. O corpo é
+    gravado em blocos, sem carregar o arquivo inteiro na memória, e um download
+    interrompido pode continuar do byte em que parou (Range).
+    """
+
+    def __init__(self, max_per_host=MAX_CONEXOES_POR_HOST, timeout=TIMEOUT):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.conexoes_abertas = 0
+        self.bytes_recebidos = 0  # Contadores lidos pelo DownloadScheduler
+        self.erros = 0
+        self._ociosas = defaultdict(list)
+        self._limites = {}
+        self._lock = threading.Lock()
+
+    def _limite(self, host):
+        with self._lock:
+            if host not in self._limites:
+                self._limites[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._limites[host]
+
+    def _abrir(self, scheme, netloc):
+        with self._lock:
+            self.conexoes_abertas += 1
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _get(self, conexao, path, inicio):
+        headers = {"Accept-Encoding": "identity"}
+        if inicio:
+            headers["Range"] = f"bytes={inicio}-"
+        conexao.request("GET", path, headers=headers)
+        return conexao.getresponse()
+
+    def baixar(self, url, saida, inicio=0, redirects=MAX_REDIRECTS):
+        """
+        Baixa url a partir do byte inicio, gravando o corpo no arquivo binário saida.
+        Retorna o número de bytes gravados.
+        """
+        parts = urlsplit(url)
+        host = (parts.scheme, parts.netloc)
+        path = f"{parts.path or '/'}?{parts.query}" if parts.query else (parts.path or "/")
+
+        with self._limite(host):
+            with self._lock:
+                conexao = self._ociosas[host].pop() if self._ociosas[host] else None
+            reutilizada = conexao is not None
+            if conexao is None:
+                conexao = self._abrir(*host)
+            try:
+                try:
+                    resposta = self._get(conexao, path, inicio)
+                except (http.client.RemoteDisconnected, ConnectionError):
+                    if not reutilizada:
+                        raise
+                    # O servidor fechou a conexão ociosa; repete numa conexão nova
+                    conexao.close()
+                    conexao = self._abrir(*host)
+                    resposta = self._get(conexao, path, inicio)
+
+                destino = None
+                total = 0
+                if resposta.status in (301, 302, 303, 307, 308) and resposta.getheader("Location"):
+                    destino = urljoin(url, resposta.getheader("Location"))
+                    resposta.read()
+                elif inicio and (resposta.status in (200, 416) or resposta.status == 206 and not (
+                        resposta.getheader("Content-Range") or "").startswith(f"bytes {inicio}-")):
+                    # Não lê o corpo: a conexão é fechada abaixo
+                    raise ErroRetomada(f"O servidor não retomou {url} do byte {inicio} (HTTP {resposta.status})")
+                elif resposta.status != (206 if inicio else 200):
+                    resposta.read()
+                    raise ErroHTTP(url, resposta.status, resposta.reason)
+                else:
+                    esperado = resposta.getheader("Content-Length")
+                    while True:
+                        chunk = resposta.read(HTTP_CHUNK)
+                        if not chunk:
+                            break
+                        saida.write(chunk)
+                        total += len(chunk)
+                        with self._lock:
+                            self.bytes_recebidos += len(chunk)
+                    # read(n) devolve menos bytes sem erro quando a conexão cai no meio do corpo
+                    if esperado is not None and total != int(esperado):
+                        raise IOError(f"Resposta incompleta: {total} de {esperado} bytes de {url}")
+            except BaseException as e:
+                conexao.close()
+                # Erros 4xx (exceto 429) dizem respeito ao arquivo, não à rede
+                if not (isinstance(e, ErroHTTP) and 400 <= e.status < 500 and e.status != 429):
+                    with self._lock:
+                        self.erros += 1
+                raise
+
+            if resposta.will_close:
+                conexao.close()
+            else:
+                with self._lock:
+                    self._ociosas[host].append(conexao)
+
+        if destino is not None:
+            if redirects == 0:
+                raise ErroHTTP(url, resposta.status, "excesso de redirecionamentos")
+            return self.baixar(destino, saida, inicio, redirects - 1)
+        return total
+
+    def fechar(self):
+        with self._lock:
+            for conexoes in self._ociosas.values():
+                for conexao in conexoes:
+                    conexao.close()
+            self._ociosas.clear()
+
+class DownloadScheduler:
+    """
+    Executa downloads do maior para o menor genoma com um limite ajustável de
+    downloads simultâneos.
+
+    A cada intervalo o limite é ajustado pela vazão do pool HTTP: com todos os
+    lugares ocupados, sobe enquanto a vazão cresce e desce quando ela cai; erros
+    de rede ou do servidor o cortam pela metade. O progresso, a vazão e o tempo
+    restante estimado (pelo tamanho esperado dos genomas que faltam) vão para o log.
+    """
+
+    def __init__(self, funcao, http, limite=CONCORRENCIA_INICIAL, limite_min=CONCORRENCIA_MINIMA,
+                 limite_max=MAX_WORKERS, intervalo=INTERVALO_AJUSTE):
+        self.funcao = funcao
+        self.http = http
+        self.limite = limite
+        self.limite_min = limite_min
+        self.limite_max = limite_max
+        self.intervalo = intervalo
+        self._cond = threading.Condition()
+        self._fila = deque()
+        self._ativos = 0
+
+    def executar(self, tamanhos):
+        """
+        Executa funcao(tarefa) para cada tarefa de tamanhos ({tarefa: tamanho esperado}),
+        começando pelas maiores. Retorna {tarefa: resultado ou exceção}.
+        """
+        self._fila = deque(sorted(tamanhos, key=tamanhos.get, reverse=True))
+        self._tamanhos = tamanhos
+        self._restante = sum(tamanhos.values())
+        self.resultados = {}
+        inicio = time.perf_counter()
+        self._medicao = (inicio, self.http.bytes_recebidos, self.http.erros)
+        self._vazao_anterior = None
+
+        threads = [threading.Thread(target=self._trabalhar, daemon=True)
+                   for _ in range(min(self.limite_max, len(self._fila)))]
+        for thread in threads:
+            thread.start()
+        while threads:
+            threads[0].join(max(self._medicao[0] + self.intervalo - time.perf_counter(), 0))
+            threads = [thread for thread in threads if thread.is_alive()]
+            if threads and time.perf_counter() >= self._medicao[0] + self.intervalo:
+                self._ajustar(time.perf_counter() - inicio)
+        return self.resultados
+
+    def _trabalhar(self):
+        while True:
+            with self._cond:
+                while self._fila and self._ativos >= self.limite:
+                    self._cond.wait()
+                if not self._fila:
+                    return
+                tarefa = self._fila.popleft()
+                self._ativos += 1
+            try:
+                resultado = self.funcao(tarefa)
+            except Exception as e:
+                resultado = e
+            with self._cond:
+                self._ativos -= 1
+                self._restante -= self._tamanhos[tarefa]
+                self.resultados[tarefa] = resultado
+                # Acorda todos: este trabalhador pode pegar a próxima tarefa antes de um
+                # acordado, e com a fila vazia os que esperam precisam ver isso para sair
+                self._cond.notify_all()
+
+    def _ajustar(self, decorrido):
+        agora, bytes_recebidos, erros = time.perf_counter(), self.http.bytes_recebidos, self.http.erros
+        antes, bytes_antes, erros_antes = self._medicao
+        self._medicao = (agora, bytes_recebidos, erros)
+        vazao = (bytes_recebidos - bytes_antes) / max(agora - antes, 1e-6)
+
+        with self._cond:
+            if erros > erros_antes:
+                self.limite = max(self.limite_min, self.limite // 2)
+            elif self._fila and self._ativos >= self.limite:
+                if self._vazao_anterior is None or vazao > self._vazao_anterior * 1.05:
+                    self.limite = min(self.limite_max, self.limite + max(1, self.limite // 4))
+                elif vazao < self._vazao_anterior * 0.9:
+                    self.limite = max(self.limite_min, self.limite - max(1, self.limite // 4))
+            self._cond.notify_all()
+            concluidos, restante = len(self.resultados), self._restante
+        self._vazao_anterior = vazao
+
+        feito = sum(self._tamanhos.values()) - restante
+        eta = f"{restante * decorrido / feito:.0f}s" if feito else "?"
+        logging.info(f"Downloads: {concluidos}/{len(self._tamanhos)} genomas, {vazao / 1e6:.1f} MB/s, "
+                     f"{self.limite} simultâneos, tempo restante estimado {eta}")
+
+class FastaIndex:
+    """
+    Índice no formato .fai (samtools faidx) de um FASTA recebido em blocos.
+
+    Para cada sequência guarda [nome, tamanho, offset, bases por linha, bytes
+    por linha]. Os cabeçalhos são localizados por busca em cada bloco, sem
+    percorrer o FASTA linha a linha.
+    """
+
+    def __init__(self):
+        self.sequencias = []
+        self.bytes = 0
+        self._cabecalho = None     # bytearray enquanto um cabeçalho continua no próximo bloco
+        self._inicio_linha = True
+        self._primeira_linha = False
+        self._ultimo_byte = 0
+
+    def _fechar_cabecalho(self, fim):
+        campos = bytes(self._cabecalho).split()
+        nome = campos[0].decode("utf-8", "replace") if campos else ""
+        self.sequencias.append([nome, 0, fim + 1, 0, 0])
+        self._cabecalho = None
+        self._inicio_linha = True
+        self._primeira_linha = True
+
+    def atualizar(self, data):
+        base = self.bytes
+        i, n = 0, len(data)
+        while i < n:
+            if self._cabecalho is not None:
+                j = data.find(b"\n", i)
+                if j == -1:
+                    self._cabecalho += data[i:]
+                    break
+                self._cabecalho += data[i:j]
+                self._fechar_cabecalho(base + j)
+                i = j + 1
+                continue
+            if self._inicio_linha and data[i] == 0x3E:  # '>'
+                self._cabecalho = bytearray()
+                self._inicio_linha = False
+                i += 1
+                continue
+
+            # Trecho de sequência até o próximo cabeçalho (ou o fim do bloco); '>' é raro
+            # dentro de uma sequência, então procurá-lo sozinho é mais rápido que "\n>"
+            fim = data.find(b">", i + 1)
+            while fim != -1 and data[fim - 1] != 0x0A:
+                fim = data.find(b">", fim + 1)
+            if fim == -1:
+                fim = n
+            if self.sequencias:
+                sequencia = self.sequencias[-1]
+                sequencia[1] += fim - i - data.count(b"\n", i, fim)
+                if sequencia[4] - sequencia[3] != 1:  # quebras \r\n, ou primeira linha ainda aberta
+                    sequencia[1] -= data.count(b"\r", i, fim)
+                if self._primeira_linha:
+                    q = data.find(b"\n", i, fim)
+                    if q != -1:
+                        sequencia[4] = base + q + 1 - sequencia[2]
+                        anterior = data[q - 1] if q > 0 else self._ultimo_byte
+                        sequencia[3] = sequencia[4] - (2 if anterior == 0x0D else 1)
+                        self._primeira_linha = False
+            self._inicio_linha = data[fim - 1] == 0x0A
+            i = fim
+        if n:
+            self._ultimo_byte = data[-1]
+        self.bytes += n
+
+    @property
+    def identificadores(self):
+        return [sequencia[0] for sequencia in self.sequencias]
+
+    @property
+    def tamanho_total(self):
+        return sum(sequencia[1] for sequencia in self.sequencias)
+
+    def salvar(self, fai_path):
+        with open(fai_path, 'w') as f:
+            for sequencia in self.sequencias:
+                f.write("\t".join(map(str, sequencia)) + "\n")
+
+def indexar_fasta(fna_path, fai_path):
+    """
+    Indexa um .fna já existente no disco (genomas baixados antes dos índices .fai).
+    """
+    indice = FastaIndex()
+    with open(fna_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HTTP_CHUNK), b""):
+            indice.atualizar(chunk)
+    indice.salvar(fai_path)
+    return indice
+
+def ler_fai(fai_path):
+    indice = FastaIndex()
+    with open(fai_path, 'r') as f:
+        for line in f:
+            campos = line.rstrip('\n').split('\t')
+            if len(campos) == 5:
+                indice.sequencias.append([campos[0]] + [int(campo) for campo in campos[1:]])
+    return indice
+
+class GenomeStreamWriter:
+    """
+    Destino de HTTPConnectionPool.baixar para um .fna.gz: descomprime os blocos
+    à medida que chegam, grava o .fna e indexa os cabeçalhos no mesmo passo,
+    sem gravar nem reler o .gz. O MD5 é o do .fna.gz recebido, o mesmo publicado
+    pelo NCBI.
+
+    Como o estado do descompressor fica na memória, um download interrompido
+    continua do byte recebidos enquanto o mesmo objeto estiver aberto.
+    """
+
+    def __init__(self, fna_path):
+        self.fna_path = fna_path
+        self.index = FastaIndex()
+        self.md5 = hashlib.md5()
+        self.recebidos = 0
+        self._saida = open(fna_path, 'wb')
+        self._descompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._membro_aberto = False
+
+    @property
+    def fechado(self):
+        return self._saida.closed
+
+    def write(self, data):
+        self.md5.update(data)
+        self.recebidos += len(data)
+        partes = []
+        while data:
+            self._membro_aberto = True
+            partes.append(self._descompressor.decompress(data))
+            if not self._descompressor.eof:
+                break
+            # Arquivos gzip podem ter vários membros concatenados
+            data = self._descompressor.unused_data
+            self._descompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self._membro_aberto = False
+        bloco = b"".join(partes)
+        if bloco:
+            self._saida.write(bloco)
+            self.index.atualizar(bloco)
+
+    def close(self):
+        try:
+            if self._membro_aberto:
+                raise IOError("Arquivo gzip truncado")
+        finally:
+            self._saida.close()
+
+    def descartar(self):
+        self._saida.close()
+        if os.path.exists(self.fna_path):
+            os.remove(self.fna_path)
+
+class GenomeManifest:
+    """
+    Manifesto persistente (SQLite) dos genomas de um diretório de download.
+
+    Cada genoma é registrado ao ser baixado, com acesso, TaxID, IDs e número das
+    sequências, total de bases, tamanho do .fna e MD5 do .fna.gz (verified indica
+    que ele confere com o md5checksums.txt do NCBI). A taxonomia e a separação
+    por tamanho do main.pl leem o manifesto em vez dos FASTA.
+
+    O diretório funciona como um cache entre execuções: cada execução marca os
+    genomas que usou (last_used, uses), e escolher_despejo() indica os usados há
+    mais tempo quando o cache passa do limite de disco.
+    """
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self._lock = threading.Lock()
+        self._conexao = sqlite3.connect(manifest_file, check_same_thread=False)
+        self._conexao.execute("PRAGMA journal_mode = WAL")
+        self._conexao.execute("PRAGMA synchronous = NORMAL")  # Sem fsync a cada genoma registrado
+        self._conexao.execute("CREATE TABLE IF NOT EXISTS genomes (file_name TEXT PRIMARY KEY, accession TEXT, "
+                              "taxid TEXT, total_bases INTEGER, contigs INTEGER, file_bytes INTEGER, md5 TEXT, "
+                              "verified INTEGER DEFAULT 0, last_used REAL DEFAULT 0, uses INTEGER DEFAULT 0, identifiers TEXT) WITHOUT ROWID")
+        # Manifestos anteriores à verificação e ao controle de uso
+        colunas = {row[1] for row in self._conexao.execute("PRAGMA table_info(genomes)")}
+        for coluna, tipo in (("verified", "INTEGER"), ("last_used", "REAL"), ("uses", "INTEGER")):
+            if coluna not in colunas:
+                self._conexao.execute(f"ALTER TABLE genomes ADD COLUMN {coluna} {tipo} DEFAULT 0")
+        self._conexao.commit()
+
+    def registrar(self, file_name, accession, taxid, indice, md5=None, verified=False):
+        row = (file_name, accession, taxid, indice.tamanho_total, len(indice.sequencias), indice.bytes, md5,
+               int(verified), time.time(), 0, ";".join(indice.identificadores))
+        with self._lock:
+            self._conexao.execute(f"INSERT OR REPLACE INTO genomes ({', '.join(MANIFEST_COLUMNS)}) "
+                                  f"VALUES ({', '.join('?' * len(row))})", row)
+            self._conexao.commit()
+
+    def completo(self, file_name):
+        """
+        Se o genoma foi baixado por inteiro por este script (e não só encontrado no disco).
+        """
+        with self._lock:
+            row = self._conexao.execute("SELECT md5 FROM genomes WHERE file_name = ?", (file_name,)).fetchone()
+        return row is not None and row[0] is not None
+
+    def marcar_uso(self, file_names):
+        agora = time.time()
+        with self._lock:
+            self._conexao.executemany("UPDATE genomes SET last_used = ?, uses = uses + 1 WHERE file_name = ?",
+                                      [(agora, name) for name in file_names])
+            self._conexao.commit()
+
+    def escolher_despejo(self, limite_bytes, manter=()):
+        """
+        Genomas a apagar, dos usados há mais tempo (e, no empate, menos vezes) para os
+        mais recentes, até o total caber em limite_bytes. Os de manter nunca são
+        escolhidos. Retorna (arquivos, total que fica no cache).
+        """
+        with self._lock:
+            rows = self._conexao.execute("SELECT file_name, file_bytes FROM genomes "
+                                         "ORDER BY last_used, uses").fetchall()
+        total = sum(file_bytes or 0 for _, file_bytes in rows)
+        despejo = []
+        for file_name, file_bytes in rows:
+            if total <= limite_bytes:
+                break
+            if file_name not in manter:
+                despejo.append(file_name)
+                total -= file_bytes or 0
+        return despejo, total
+
+    def remover(self, file_names):
+        with self._lock:
+            self._conexao.executemany("DELETE FROM genomes WHERE file_name = ?", [(name,) for name in file_names])
+            self._conexao.commit()
+
+    def arquivos(self):
+        with self._lock:
+            return {row[0] for row in self._conexao.execute("SELECT file_name FROM genomes")}
+
+    def genomas(self, file_names=None):
+        """
+        Genomas registrados (só os de file_names, se dado), como dicts com as colunas de MANIFEST_COLUMNS.
+        """
+        with self._lock:
+            rows = self._conexao.execute(f"SELECT {', '.join(MANIFEST_COLUMNS)} FROM genomes "
+                                         "ORDER BY file_name").fetchall()
+        genomas = [dict(zip(MANIFEST_COLUMNS, row)) for row in rows]
+        if file_names is not None:
+            file_names = set(file_names)
+            genomas = [genoma for genoma in genomas if genoma['file_name'] in file_names]
+        return genomas
+
+    def exportar_tsv(self, tsv_file, file_names=None):
+        """
+        Exporta o manifesto (sem os IDs das sequências) em TSV, lido pelo main.pl.
+        Com file_names, exporta só esses genomas: a visão de uma execução.
+        """
+        columns = [column for column in MANIFEST_COLUMNS if column != 'identifiers']
+        temp_file = f"{tsv_file}.tmp"
+        with open(temp_file, 'w', newline='') as f:
+            writer = csv.writer(f, delimiter='\t')
+            writer.writerow(columns)
+            for genoma in self.genomas(file_names):
+                writer.writerow(['' if genoma[column] is None else genoma[column] for column in columns])
+        os.replace(temp_file, tsv_file)
+        logging.info(f"Manifesto de genomas exportado em: {tsv_file}")
+
+    def fechar(self):
+        with self._lock:
+            self._conexao.close()
+
 class GenomeDownloader:
     def __init__(self, output_dir, cache_dir):
         self.output_dir = output_dir
@@ -33,6 +658,8 @@ class GenomeDownloader:
         self.failed_downloads = set()
         self.successful_downloads = set()
         self.assembly_data = self.carregar_assembly_summaries()
+        self.http = HTTPConnectionPool()
+        self.manifest = GenomeManifest(os.path.join(output_dir, "genome_manifest.sqlite"))
 
     def baixar_assembly_summaries(self):
         """
@@ -77,24 +704,10 @@ class GenomeDownloader:
 
     def carregar_assembly_summaries(self):
         """
-        Carrega os dados dos arquivos de sumário de assembly.
-        """
-        assembly_data = {}
-        for key, file_path in self.assembly_summaries.items():
-            with open(file_path, 'r') as f:
-                for line in f:
-                    if line.startswith('#'):
-                        continue
-                    parts = line.strip().split('\t')
-                    if len(parts) > 19 and parts[19]:
-                        gcf = parts[0]
-                        assembly_data[gcf] = {
-                            'ftp_path': parts[19].replace('ftp://', 'https://'),
-                            'organism_name': parts[7],
-                            'taxid': parts[5],
-                            'file_name': f"{parts[0]}_{parts[1]}.fna"
-                        }
-        return assembly_data
+        Abre o catálogo indexado dos sumários de assembly, gerando-o se os arquivos em cache mudaram.
+        """
+        catalog_file = os.path.join(self.cache_dir, "assembly_catalog.sqlite")
+        return AssemblyCatalog(catalog_file, list(self.assembly_summaries.items()))
 
     def processar_identificadores(self, genomes_file):
         """
@@ -112,19 +725,31 @@ class GenomeDownloader:
 
     def executar_downloads(self, identifiers):
         """
-        Executa os downloads em paralelo usando ThreadPoolExecutor.
+        Executa os downloads em paralelo, dos maiores genomas para os menores, com o
+        DownloadScheduler ajustando quantos correm ao mesmo tempo.
         """
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = {executor.submit(self.baixar_genoma, gcf): gcf for gcf in identifiers}
-            for future in as_completed(futures):
-                gcf = futures[future]
-                try:
-                    result = future.result()
-                    if not result:
-                        self.failed_downloads.add(gcf)
-                except Exception as e:
-                    logging.error(f"Erro no download de {gcf}: {str(e)}")
-                    self.failed_downloads.add(gcf)
+        self.assembly_data.carregar(identifiers)
+        agendador = DownloadScheduler(self.baixar_genoma, self.http)
+        for gcf, result in agendador.executar(self.tamanhos_esperados(identifiers)).items():
+            if isinstance(result, Exception):
+                logging.error(f"Erro no download de {gcf}: {str(result)}")
+                self.failed_downloads.add(gcf)
+            elif not result:
+                self.failed_downloads.add(gcf)
+        self.http.fechar()
+
+    def tamanhos_esperados(self, identifiers):
+        """
+        Tamanho de cada genoma segundo o sumário de assembly; genomas já no cache, ou
+        sem tamanho no sumário (formato antigo), contam como 0 e ficam para o fim.
+        """
+        tamanhos = {}
+        for gcf in identifiers:
+            metadata = self.assembly_data.get(gcf) or {}
+            no_cache = metadata and self.manifest.completo(metadata['file_name']) and \
+                os.path.exists(os.path.join(self.output_dir, metadata['file_name']))
+            tamanhos[gcf] = 0 if no_cache else (metadata.get('genome_size') or 0)
+        return tamanhos
 
     def baixar_genoma(self, gcf):
         """
@@ -135,64 +760,91 @@ class GenomeDownloader:
             return False
 
         output_path = os.path.join(self.output_dir, metadata['file_name'])
-        if os.path.exists(output_path):
+        # Um .fna sem registro no manifesto pode ter sido truncado antes dos downloads atômicos
+        if os.path.exists(output_path) and self.manifest.completo(metadata['file_name']):
             self.successful_downloads.add(metadata['file_name'])
             return True
 
         return self.salvar_genoma(metadata, output_path)
 
+    def md5_publicado(self, metadata):
+        """
+        MD5 do .fna.gz segundo o md5checksums.txt do assembly, ou None se não estiver disponível.
+        """
+        nome = f"{os.path.basename(metadata['ftp_path'])}_genomic.fna.gz"
+        checksums = io.BytesIO()
+        try:
+            self.http.baixar(f"{metadata['ftp_path']}/md5checksums.txt", checksums)
+        except (OSError, http.client.HTTPException) as e:
+            logging.warning(f"md5checksums.txt indisponível para {metadata['file_name']}: {e}")
+            return None
+        for line in checksums.getvalue().decode("utf-8", "replace").splitlines():
+            campos = line.split()
+            if len(campos) == 2 and os.path.basename(campos[1]) == nome:
+                return campos[0].lower()
+        logging.warning(f"{nome} não consta no md5checksums.txt")
+        return None
+
     def salvar_genoma(self, metadata, output_path, retries=RETRIES):
         """
-        Baixa e salva um genoma usando wget.
+        Baixa e salva um genoma pelo pool de conexões HTTP, descomprimindo-o durante
+        o download e gravando ao lado o índice .fai com os IDs e tamanhos das sequências.
+        Uma tentativa que cai no meio continua do byte em que parou, e o .fna.gz
+        recebido é conferido com o MD5 publicado pelo NCBI.
         """
         url = f"{metadata['ftp_path']}/{os.path.basename(metadata['ftp_path'])}_genomic.fna.gz"
-        temp_gz = f"{output_path}.gz"
+        esperado = self.md5_publicado(metadata)
+        destino = None
 
         for attempt in range(retries):
             try:
-                comando = [
-                    "wget",
-                    "-O", temp_gz,
-                    "-q",
-                    "--tries=3",
-                    "--timeout=15",
-                    url
-                ]
-                subprocess.run(comando, check=True)
-
-                with gzip.open(temp_gz, 'rb') as f_in:
-                    with open(output_path, 'wb') as f_out:
-                        shutil.copyfileobj(f_in, f_out)
+                if destino is None:
+                    destino = GenomeStreamWriter(f"{output_path}.part")
+                elif destino.recebidos:
+                    logging.info(f"Retomando {metadata['file_name']} do byte {destino.recebidos}")
+                self.http.baixar(url, destino, destino.recebidos)
+                destino.close()
+                md5 = destino.md5.hexdigest()
+                if esperado is not None and md5 != esperado:
+                    raise ErroChecksum(f"MD5 {md5} difere do publicado ({esperado})")
 
-                os.remove(temp_gz)
+                # O .fai é gravado antes do .fna aparecer, e fica mais novo que ele
+                destino.index.salvar(f"{output_path}.fai")
+                os.replace(destino.fna_path, output_path)
+                self.manifest.registrar(metadata['file_name'], self.extrair_gcf(metadata['file_name']),
+                                        metadata['taxid'], destino.index, md5, esperado is not None)
                 self.successful_downloads.add(metadata['file_name'])
                 return True
-            except subprocess.CalledProcessError as e:
+            except (OSError, http.client.HTTPException, zlib.error) as e:
                 logging.warning(f"Tentativa {attempt + 1} de {retries} falhou para {metadata['file_name']}: {e}")
-                if attempt < retries - 1:
+                # Só uma transferência interrompida é retomada; conteúdo inválido (gzip
+                # truncado ou corrompido, MD5 divergente) ou Range recusado recomeçam do zero
+                if destino is not None and (destino.fechado or isinstance(e, (zlib.error, ErroRetomada))):
+                    destino.descartar()
+                    destino = None
+                # Erros 4xx (arquivo inexistente, acesso negado) não melhoram com novas tentativas
+                definitivo = isinstance(e, ErroHTTP) and 400 <= e.status < 500
+                if attempt < retries - 1 and not definitivo:
                     sleep(2 ** attempt)
                 else:
                     logging.error(f"Falha no download de {metadata['file_name']}: {str(e)}")
+                    if destino is not None:
+                        destino.descartar()
                     return False
 
-    def create_detailed_taxonomy_from_directory(self, taxonomy_file):
+    def create_detailed_taxonomy_from_directory(self, taxonomy_file, file_names=None):
         """
-        Cria um arquivo de taxonomia detalhada a partir dos genomas baixados.
+        Cria um arquivo de taxonomia detalhada a partir do manifesto dos genomas baixados
+        (só dos genomas em file_names, se dado).
         """
+        self.sincronizar_manifesto()
         mapping = defaultdict(lambda: {"taxid": "Unknown TaxID", "identifiers": set()})
         
-        for file in os.listdir(self.output_dir):
-            if file.endswith(".fna"):
-                file_path = os.path.join(self.output_dir, file)
-                gcf = self.extrair_gcf(file)
-                with open(file_path, "r") as f:
-                    for line in f:
-                        if line.startswith(">"):
-                            identifier = line.split()[0][1:]  # Remove o '>' e pega o identificador
-                            mapping[gcf]["identifiers"].add(identifier)
-                
-                metadata = self.assembly_data.get(gcf, {})
-                mapping[gcf]["taxid"] = metadata.get('taxid', "Unknown TaxID")
+        for genoma in self.manifest.genomas(file_names):
+            gcf = genoma['accession']
+            if genoma['identifiers']:
+                mapping[gcf]["identifiers"].update(genoma['identifiers'].split(";"))
+            mapping[gcf]["taxid"] = genoma['taxid']
         
         with open(taxonomy_file, "w", newline="") as csvfile:
             writer = csv.writer(csvfile, delimiter="\t")
@@ -206,44 +858,117 @@ class GenomeDownloader:
 
         logging.info(f"Arquivo de taxonomia detalhada salvo em: {taxonomy_file}")
 
-    def concatenar_genomas(self, output_file):
+    def indice_genoma(self, fna_path):
         """
-        Concatena todos os genomas baixados em um único arquivo.
+        Índice de um genoma já no disco, lido do .fai gravado no download.
+        Genomas sem índice (ou alterados depois dele) são indexados uma vez.
         """
-        logging.info("Concatenando genomas...")
-        with open(output_file, 'w') as out_f:
-            for filename in self.successful_downloads:
-                file_path = os.path.join(self.output_dir, filename)
-                try:
-                    with open(file_path, 'r') as in_f:
-                        shutil.copyfileobj(in_f, out_f)
-                except FileNotFoundError:
-                    logging.warning(f"Aviso: Arquivo {filename} não encontrado, pulando...")
-        logging.info(f"Genomas concatenados em {output_file}")
+        fai_path = f"{fna_path}.fai"
+        if os.path.exists(fai_path) and os.path.getmtime(fai_path) >= os.path.getmtime(fna_path):
+            indice = ler_fai(fai_path)
+            indice.bytes = os.path.getsize(fna_path)
+            return indice
+        return indexar_fasta(fna_path, fai_path)
+
+    def sincronizar_manifesto(self):
+        """
+        Acerta o manifesto com o diretório, que só é listado: registra os .fna que ele
+        ainda não conhece (baixados antes do manifesto) e esquece os que foram apagados.
+        """
+        no_disco = {file for file in os.listdir(self.output_dir) if file.endswith(".fna")}
+        registrados = self.manifest.arquivos()
+        self.manifest.remover(registrados - no_disco)
+
+        novos = sorted(no_disco - registrados)
+        if novos:
+            logging.info(f"Registrando {len(novos)} genomas no manifesto...")
+            self.assembly_data.carregar([self.extrair_gcf(file) for file in novos])
+        for file in novos:
+            gcf = self.extrair_gcf(file)
+            metadata = self.assembly_data.get(gcf, {})
+            indice = self.indice_genoma(os.path.join(self.output_dir, file))
+            self.manifest.registrar(file, gcf, metadata.get('taxid', "Unknown TaxID"), indice)
+
+    def limpar_cache(self, limite_bytes):
+        """
+        Apaga os genomas usados há mais tempo até o cache caber em limite_bytes,
+        sem tocar nos genomas desta execução.
+        """
+        despejo, total = self.manifest.escolher_despejo(limite_bytes, self.successful_downloads)
+        for file_name in despejo:
+            file_path = os.path.join(self.output_dir, file_name)
+            for path in (file_path, f"{file_path}.fai"):
+                if os.path.exists(path):
+                    os.remove(path)
+        self.manifest.remover(despejo)
+        if despejo:
+            logging.info(f"Removidos {len(despejo)} genomas do cache; ficam {total / 1e9:.2f} GB")
+        if total > limite_bytes:
+            logging.warning(f"Os genomas desta execução ocupam {total / 1e9:.2f} GB, "
+                            f"acima do limite do cache de {limite_bytes / 1e9:.2f} GB")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 5:
-        print("Uso: python3 download_genomes.py <genomes_file> <output_dir> <taxonomy_file> <cache_dir>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Baixa os genomas selecionados para o cache de genomas e "
+                                                 "gera a taxonomia detalhada da execução")
+    parser.add_argument("genomes_file", help="Acessos dos genomas selecionados, um por linha")
+    parser.add_argument("output_dir", help="Diretório (cache) dos genomas baixados")
+    parser.add_argument("taxonomy_file", help="Taxonomia detalhada dos genomas desta execução")
+    parser.add_argument("cache_dir", help="Diretório dos sumários de assembly")
+    parser.add_argument("hierarchy_file", nargs="?", help="Hierarquia taxonômica completa")
+    parser.add_argument("pruned_hierarchy_file", nargs="?", help="Hierarquia reduzida aos genomas baixados")
+    parser.add_argument("--run-manifest", help="Manifesto TSV só com os genomas desta execução "
+                                               "(padrão: genome_manifest.tsv em output_dir)")
+    parser.add_argument("--cache-limit-gb", type=float, default=0,
+                        help="Limite de disco do cache de genomas; os usados há mais tempo são apagados "
+                             "(0 = sem limite)")
+    parser.add_argument("--metrics", help="Acrescenta as métricas de cada etapa como linhas JSON a este arquivo "
+                                          "(padrão: $HYMET_METRICS, se definido)")
+    parser.add_argument("--profile", help="Grava as estatísticas do cProfile do processo principal neste arquivo")
+
+    args = parser.parse_args()
+    if (args.hierarchy_file is None) != (args.pruned_hierarchy_file is None):
+        parser.error("hierarchy_file e pruned_hierarchy_file devem ser dados juntos")
 
-    genomes_file = sys.argv[1]
-    output_dir = sys.argv[2]
-    taxonomy_file = sys.argv[3]
-    cache_dir = sys.argv[4]
+    genomes_file = args.genomes_file
+    output_dir = args.output_dir
+    taxonomy_file = args.taxonomy_file
+    cache_dir = args.cache_dir
 
     configurar_diretorios(output_dir, cache_dir)
-    
-    downloader = GenomeDownloader(output_dir, cache_dir)
-    identifiers = downloader.processar_identificadores(genomes_file)
-    
-    logging.info(f"Iniciando download de {len(identifiers)} genomas...")
-    downloader.executar_downloads(identifiers)
-    downloader.create_detailed_taxonomy_from_directory(taxonomy_file)
-    
-    combined_genomes_file = os.path.join(output_dir, "combined_genomes.fasta")
-    downloader.concatenar_genomas(combined_genomes_file)
-    
+    metrics = StageMetrics("downloadDB", args.metrics)
+
+    with profiling(args.profile):
+        with metrics.stage("open_catalog") as record:
+            downloader = GenomeDownloader(output_dir, cache_dir)
+            identifiers = downloader.processar_identificadores(genomes_file)
+            record["genomes"] = len(identifiers)
+
+        logging.info(f"Iniciando download de {len(identifiers)} genomas...")
+        with metrics.stage("download") as record:
+            downloader.executar_downloads(identifiers)
+            record["downloaded"] = len(downloader.successful_downloads)
+            record["failed"] = len(downloader.failed_downloads)
+            record["http_bytes"] = downloader.http.bytes_recebidos
+            record["http_errors"] = downloader.http.erros
+
+        # Só os genomas desta execução (baixados agora ou já no cache) entram na taxonomia e no manifesto
+        with metrics.stage("taxonomy"):
+            downloader.create_detailed_taxonomy_from_directory(taxonomy_file, downloader.successful_downloads)
+
+        with metrics.stage("genome_cache"):
+            downloader.manifest.marcar_uso(downloader.successful_downloads)
+            if args.cache_limit_gb > 0:
+                downloader.limpar_cache(int(args.cache_limit_gb * 1e9))
+            downloader.manifest.exportar_tsv(args.run_manifest or os.path.join(output_dir, "genome_manifest.tsv"),
+                                             downloader.successful_downloads)
+
+        # Hierarquia reduzida aos TaxIDs dos genomas baixados e seus ancestrais
+        if args.hierarchy_file:
+            with metrics.stage("prune_hierarchy") as record:
+                record["taxa"] = prune_taxonomy_hierarchy(args.hierarchy_file, taxonomy_file,
+                                                          args.pruned_hierarchy_file)
+
     logging.info("\nResumo:")
     logging.info(f" - Baixados com sucesso: {len(downloader.successful_downloads)}")
     logging.info(f" - Falhas: {len(downloader.failed_downloads)}")
-    logging.info(f" - Arquivo combinado: {combined_genomes_file}")
+    downloader.manifest.fechar()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+import os
+import logging
+import argparse
+from contextlib import nullcontext
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is only needed for Parquet output
+    pa = pq = None
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+ROW_GROUP_SIZE = 500000
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError("Parquet output requires pyarrow (conda install pyarrow)")
+
+def results_schema():
+    # Levels and lineages repeat across queries, so they are dictionary-encoded
+    return pa.schema([
+        ("query", pa.string()),
+        ("rank", pa.uint8()),
+        ("confidence", pa.float64()),
+        ("taxid", pa.int64()),
+        ("level", pa.dictionary(pa.int32(), pa.string())),
+        ("lineage", pa.dictionary(pa.int32(), pa.string())),
+    ])
+
+def _taxid_value(taxid):
+    return int(taxid) if taxid and taxid.isdigit() else None
+
+class ParquetResultsWriter:
+    """
+    Writes classifier results to a Parquet file as they stream out.
+
+    One row per candidate, numbered by rank within its query. Rows are
+    buffered column-wise and written as a row group every row_group_size
+    rows, so memory stays bounded however many queries are classified.
+    """
+
+    def __init__(self, path, row_group_size=ROW_GROUP_SIZE):
+        require_pyarrow()
+        self.path = path
+        self.row_group_size = row_group_size
+        self.schema = results_schema()
+        self.rows = 0
+        self._writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+        self._columns = tuple([] for _ in self.schema.names)
+        self._tables = []
+        self._buffered = 0
+
+    def write(self, results, max_candidates):
+        queries, ranks, confidences, taxids, levels, lineages = self._columns
+        for query, candidates in results:
+            for rank, (lineage, level, confidence, taxid) in enumerate(candidates[:max_candidates], 1):
+                queries.append(query)
+                ranks.append(rank)
+                confidences.append(confidence)
+                taxids.append(_taxid_value(taxid))
+                levels.append(level)
+                lineages.append(lineage)
+        if len(queries) + self._buffered >= self.row_group_size:
+            self.flush()
+
+    def write_columns(self, queries, ranks, confidences, codes, taxids, levels, lineages):
+        """
+        Buffer rows given as columns (the numpy engine's output): each row's
+        candidate is a code into the taxids, levels and lineages lists.
+        """
+        codes = pa.array(codes, pa.int32())
+        self._tables.append(pa.Table.from_arrays([
+            pa.array(queries, pa.string()),
+            pa.array(ranks, pa.uint8()),
+            pa.array(confidences, pa.float64()),
+            pa.array([_taxid_value(taxid) for taxid in taxids], pa.int64()).take(codes),
+            pa.DictionaryArray.from_arrays(codes, pa.array(levels, pa.string())),
+            pa.DictionaryArray.from_arrays(codes, pa.array(lineages, pa.string())),
+        ], schema=self.schema))
+        self._buffered += len(queries)
+        if len(self._columns[0]) + self._buffered >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        queries, ranks, confidences, taxids, levels, lineages = self._columns
+        tables = self._tables
+        if queries:
+            tables.append(pa.Table.from_arrays([
+                pa.array(queries, pa.string()),
+                pa.array(ranks, pa.uint8()),
+                pa.array(confidences, pa.float64()),
+                pa.array(taxids, pa.int64()),
+                pa.array(levels, pa.string()).dictionary_encode(),
+                pa.array(lineages, pa.string()).dictionary_encode(),
+            ], schema=self.schema))
+        if not tables:
+            return
+        table = pa.concat_tables(tables)
+        self._writer.write_table(table, row_group_size=max(table.num_rows, 1))
+        self.rows += table.num_rows
+        self._tables = []
+        self._buffered = 0
+        for column in self._columns:
+            column.clear()
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+        logging.info(f"Wrote {self.rows} candidate rows to {self.path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def open_results_store(path, row_group_size=ROW_GROUP_SIZE):
+    # Yields None when no Parquet output was requested
+    return ParquetResultsWriter(path, row_group_size) if path else nullcontext()
+
+def merge_results_stores(output_file, input_files):
+    """
+    Concatenate Parquet result stores row group by row group, without
+    decoding them to text.
+    """
+    require_pyarrow()
+    schema = results_schema()
+    rows = 0
+    temp_file = output_file + ".tmp"
+    with pq.ParquetWriter(temp_file, schema, compression="zstd") as writer:
+        for input_file in input_files:
+            store = pq.ParquetFile(input_file)
+            for index in range(store.num_row_groups):
+                table = store.read_row_group(index).cast(schema)
+                writer.write_table(table, row_group_size=max(table.num_rows, 1))
+                rows += table.num_rows
+    os.replace(temp_file, output_file)
+    logging.info(f"Merged {len(input_files)} result stores ({rows} rows) into {output_file}")
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge Parquet result stores written by the classifiers")
+    parser.add_argument("inputs", nargs="+", help="Result stores to merge, in output order")
+    parser.add_argument("--output", required=True, help="Merged Parquet file")
+
+    args = parser.parse_args()
+    merge_results_stores(args.output, [path for path in args.inputs if os.path.exists(path)])
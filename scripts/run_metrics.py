@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import logging
+import cProfile
+import resource
+from contextlib import contextmanager
+
+# main.pl points every Python stage at the same report through this variable
+METRICS_ENV = "HYMET_METRICS"
+
+def _maxrss_mb(who):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def _cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+def _io_bytes():
+    # Bytes passed through read()/write() by this process; Linux only
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+class StageMetrics:
+    """
+    Records wall time, CPU time, peak RSS and I/O bytes per pipeline stage.
+
+    Each finished stage is appended as one JSON line to report_file (or the
+    file named by HYMET_METRICS); without either, stages are only logged.
+    CPU time and peak RSS of child processes (pool workers, minimap2) are
+    reported separately and only include children that have exited.
+    """
+
+    def __init__(self, script, report_file=None):
+        self.script = script
+        self.report_file = report_file or os.environ.get(METRICS_ENV)
+
+    @contextmanager
+    def stage(self, name):
+        # The caller may add counts (queries, hits, ...) to the yielded record
+        record = {"script": self.script, "stage": name, "pid": os.getpid()}
+        start_wall = time.perf_counter()
+        start_cpu = _cpu_seconds(resource.RUSAGE_SELF)
+        start_children_cpu = _cpu_seconds(resource.RUSAGE_CHILDREN)
+        start_io = _io_bytes()
+        try:
+            yield record
+        finally:
+            record["wall_seconds"] = round(time.perf_counter() - start_wall, 4)
+            record["cpu_seconds"] = round(_cpu_seconds(resource.RUSAGE_SELF) - start_cpu, 4)
+            record["children_cpu_seconds"] = round(_cpu_seconds(resource.RUSAGE_CHILDREN) - start_children_cpu, 4)
+            record["peak_rss_mb"] = _maxrss_mb(resource.RUSAGE_SELF)
+            record["children_peak_rss_mb"] = _maxrss_mb(resource.RUSAGE_CHILDREN)
+            end_io = _io_bytes()
+            if start_io is not None and end_io is not None:
+                record["bytes_read"] = end_io[0] - start_io[0]
+                record["bytes_written"] = end_io[1] - start_io[1]
+            self._emit(record)
+
+    def _emit(self, record):
+        logging.info(f"Stage {record['stage']}: {record['wall_seconds']:.2f}s wall, "
+                     f"{record['cpu_seconds']:.2f}s CPU, peak RSS {record['peak_rss_mb']} MB")
+        if self.report_file:
+            # One write() per line keeps concurrent appends from interleaving
+            with open(self.report_file, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+@contextmanager
+def profiling(output_file):
+    # cProfile of the calling process only; pool workers are not profiled
+    if not output_file:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(output_file)
+        logging.info(f"Profile written to {output_file} (inspect with python -m pstats)")
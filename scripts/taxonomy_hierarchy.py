@@ -1,7 +1,21 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 import csv
+import pickle
+import hashlib
+import argparse
+from array import array
+from itertools import accumulate, compress, repeat
+from operator import itemgetter, ne
+
+from run_metrics import StageMetrics, profiling
+from taxonomy_index import build_taxonomy_index, update_taxonomy_index
+
+HEADER = "TaxID\tName\tRank\tParentTaxID\tLineage\n"
+SNAPSHOT_VERSION = 1
+COPY_CHUNK = 1 << 20
 
 def parse_names_dmp(file_path):
     """
@@ -10,7 +24,9 @@ def parse_names_dmp(file_path):
     taxid_to_name = {}
     with open(file_path, "r", encoding="utf-8") as f:
         for line in f:
-            parts = line.split("\t|\t")
+            if "scientific name" not in line:
+                continue
+            parts = line.split("\t|\t", 3)
             taxid = parts[0].strip()
             name = parts[1].strip()
             name_class = parts[3].strip("\t|\n")
@@ -25,7 +41,7 @@ def parse_nodes_dmp(file_path):
     taxid_to_hierarchy = {}
     with open(file_path, "r", encoding="utf-8") as f:
         for line in f:
-            parts = line.split("\t|\t")
+            parts = line.split("\t|\t", 5)
             taxid = parts[0].strip()
             parent_taxid = parts[1].strip()
             rank = parts[2].strip("\t|\n")
@@ -34,53 +50,476 @@ def parse_nodes_dmp(file_path):
             taxid_to_hierarchy[taxid] = (rank, parent_taxid)
     return taxid_to_hierarchy
 
-def generate_taxonomy_hierarchy(names_file, nodes_file, output_file):
+def parse_merged_dmp(file_path):
     """
-    Generate the taxonomy_hierarchy.tsv file with TaxID, Scientific Name, Rank, ParentTaxID, and Full Lineage.
+    Parse the merged.dmp file to create a dictionary mapping old TaxID to the TaxID it was merged into.
     """
-    print("Loading data from files...")
-    taxid_to_name = parse_names_dmp(names_file)
-    taxid_to_hierarchy = parse_nodes_dmp(nodes_file)
+    merged = {}
+    if os.path.exists(file_path):
+        with open(file_path, "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.split("\t|\t")
+                merged[parts[0].strip()] = parts[1].strip("\t|\n")
+    return merged
+
+def parse_delnodes_dmp(file_path):
+    """
+    Parse the delnodes.dmp file into the set of deleted TaxIDs.
+    """
+    if not os.path.exists(file_path):
+        return set()
+    with open(file_path, "r", encoding="utf-8") as f:
+        return {line.split("\t|")[0].strip() for line in f}
+
+def iter_lineages(taxid_to_hierarchy, taxid_to_name, taxids=None, cache=None):
+    """
+    Yield (TaxID, Lineage) for every TaxID of nodes.dmp (or only for taxids), in file order.
 
-    def get_lineage(taxid):
-        lineage = []
+    A lineage is its parent's lineage plus one "rank:name" entry, so each
+    ancestor path is built only once. Over the whole tree, lineages are cached
+    only for TaxIDs that are the parent of another TaxID, which keeps the
+    cache to the inner nodes; for a subset every lineage built is cached.
+    cache may be seeded with lineages that are already known.
+    """
+    inner_nodes = {parent_taxid for _, parent_taxid in taxid_to_hierarchy.values()} if taxids is None else None
+    cache = dict(cache or {})
+    cache["1"] = ""
+
+    for taxid in (taxid_to_hierarchy if taxids is None else taxids):
+        # Climb to the nearest ancestor with a known lineage, then extend it back down
+        path = []
         current_taxid = taxid
-        while current_taxid != "1":
-            rank, parent_taxid = taxid_to_hierarchy.get(current_taxid, ("", "1"))
-            name = taxid_to_name.get(current_taxid, "Unknown")
-            lineage.insert(0, f"{rank}:{name}")
-            current_taxid = parent_taxid
-        return ";".join(lineage)
+        while current_taxid not in cache:
+            path.append(current_taxid)
+            if len(path) > len(taxid_to_hierarchy):
+                raise ValueError(f"Cycle in nodes.dmp involving TaxID {taxid}")
+            current_taxid = taxid_to_hierarchy.get(current_taxid, ("", "1"))[1]
+
+        lineage = cache[current_taxid]
+        for node in reversed(path):
+            rank = taxid_to_hierarchy.get(node, ("", "1"))[0]
+            entry = f"{rank}:{taxid_to_name.get(node, 'Unknown')}"
+            lineage = f"{lineage};{entry}" if lineage else entry
+            if inner_nodes is None or node in inner_nodes:
+                cache[node] = lineage
+        yield taxid, lineage
+
+def write_hierarchy_file(output_file, taxid_to_hierarchy, taxid_to_name):
+    """
+    Write a row for every TaxID of nodes.dmp and return the byte length of each row, in file order.
+    """
+    row_bytes = array("Q")
+    with open(output_file, "wb") as out:
+        out.write(HEADER.encode("utf-8"))
+        for taxid, lineage in iter_lineages(taxid_to_hierarchy, taxid_to_name):
+            row = hierarchy_row(taxid, taxid_to_hierarchy, taxid_to_name, lineage)
+            out.write(row)
+            row_bytes.append(len(row))
+    return row_bytes
+
+def hierarchy_row(taxid, taxid_to_hierarchy, taxid_to_name, lineage):
+    rank, parent_taxid = taxid_to_hierarchy[taxid]
+    name = taxid_to_name.get(taxid, "Unknown")
+    return f"{taxid}\t{name}\t{rank}\t{parent_taxid}\t{lineage}\n".encode("utf-8")
+
+def dump_fingerprint(names_file, nodes_file):
+    """
+    Return an MD5 digest of names.dmp and nodes.dmp, the files the hierarchy is built from.
+    """
+    digest = hashlib.md5()
+    for path in (names_file, nodes_file):
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(COPY_CHUNK)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def snapshot_file(hierarchy_file):
+    return f"{hierarchy_file}.snapshot"
+
+def save_snapshot(hierarchy_file, fingerprint, taxids, names, ranks, parents, row_bytes):
+    """
+    Store the TaxID, name, rank and parent of every row of hierarchy_file, in
+    file order, with the byte length of each row and the fingerprint of the
+    taxdump it was built from. Updates diff the new taxdump against it instead
+    of reading the hierarchy back.
+    """
+    stat = os.stat(hierarchy_file)
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "fingerprint": fingerprint,
+        "hierarchy": (stat.st_size, stat.st_mtime_ns),
+        # Columns are stored joined: splitting a string is much faster than unpickling a list
+        "taxids": "\n".join(taxids),
+        "names": "\n".join(names),
+        "ranks": "\n".join(ranks),
+        "parents": "\n".join(parents),
+        "row_bytes": row_bytes.tobytes(),
+    }
+    temp_file = f"{snapshot_file(hierarchy_file)}.tmp"
+    with open(temp_file, "wb") as f:
+        pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_file, snapshot_file(hierarchy_file))
+
+def save_full_snapshot(hierarchy_file, fingerprint, taxid_to_hierarchy, taxid_to_name, row_bytes):
+    taxids = list(taxid_to_hierarchy)
+    ranks = [rank for rank, _ in taxid_to_hierarchy.values()]
+    parents = [parent_taxid for _, parent_taxid in taxid_to_hierarchy.values()]
+    names = [taxid_to_name.get(taxid, "Unknown") for taxid in taxids]
+    save_snapshot(hierarchy_file, fingerprint, taxids, names, ranks, parents, row_bytes)
+
+def load_snapshot(hierarchy_file):
+    """
+    Return the snapshot of hierarchy_file with its columns as lists, or None
+    when there is none or the hierarchy file changed after it was written.
+    """
+    path = snapshot_file(hierarchy_file)
+    if not os.path.exists(path) or not os.path.exists(hierarchy_file):
+        return None
+    with open(path, "rb") as f:
+        snapshot = pickle.load(f)
+    stat = os.stat(hierarchy_file)
+    if snapshot.get("version") != SNAPSHOT_VERSION or snapshot["hierarchy"] != (stat.st_size, stat.st_mtime_ns):
+        return None
+    for column in ("taxids", "names", "ranks", "parents"):
+        snapshot[column] = snapshot[column].split("\n") if snapshot[column] else []
+    row_bytes = array("Q")
+    row_bytes.frombytes(snapshot["row_bytes"])
+    snapshot["row_bytes"] = row_bytes
+    return snapshot
+
+def generate_taxonomy_hierarchy(names_file, nodes_file, output_file, metrics=None):
+    """
+    Generate the taxonomy_hierarchy.tsv file with TaxID, Scientific Name, Rank, ParentTaxID, and Full Lineage.
+    """
+    metrics = metrics or StageMetrics("taxonomy_hierarchy")
+
+    print("Loading data from files...")
+    with metrics.stage("parse_dmp") as parse_record:
+        taxid_to_name = parse_names_dmp(names_file)
+        taxid_to_hierarchy = parse_nodes_dmp(nodes_file)
+        parse_record["taxa"] = len(taxid_to_hierarchy)
 
     print("Generating taxonomy_hierarchy.tsv...")
-    with open(output_file, "w", encoding="utf-8") as out:
-        out.write("TaxID\tName\tRank\tParentTaxID\tLineage\n")
-        for taxid, (rank, parent_taxid) in taxid_to_hierarchy.items():
-            name = taxid_to_name.get(taxid, "Unknown")
-            lineage = get_lineage(taxid)
-            out.write(f"{taxid}\t{name}\t{rank}\t{parent_taxid}\t{lineage}\n")
+    with metrics.stage("write_hierarchy") as write_record:
+        row_bytes = write_hierarchy_file(output_file, taxid_to_hierarchy, taxid_to_name)
+        save_full_snapshot(output_file, dump_fingerprint(names_file, nodes_file), taxid_to_hierarchy,
+                           taxid_to_name, row_bytes)
 
     print(f"File generated successfully: {output_file}")
+    print(f"{len(taxid_to_hierarchy)} taxa in {parse_record['wall_seconds'] + write_record['wall_seconds']:.1f}s "
+          f"(parsing {parse_record['wall_seconds']:.1f}s, lineages {write_record['wall_seconds']:.1f}s), "
+          f"peak memory {write_record['peak_rss_mb']} MB")
+
+def find_changed_taxa(snapshot, taxid_to_hierarchy, taxid_to_name):
+    """
+    Compare the snapshot of an existing taxonomy_hierarchy.tsv with freshly parsed dump files.
+
+    Returns (changed, removed, old_parents): the TaxIDs whose name, rank or
+    parent differ (added and removed TaxIDs included), the TaxIDs no longer in
+    nodes.dmp, and the TaxIDs used as a parent in the old file.
+    """
+    # The new values are looked up in the order of the snapshot columns, so the
+    # comparison runs in map/compress without a Python-level loop per TaxID
+    taxids = snapshot["taxids"]
+    new_nodes = map(taxid_to_hierarchy.get, taxids)
+    changed = set(compress(taxids, map(ne, new_nodes, zip(snapshot["ranks"], snapshot["parents"]))))
+    new_names = map(taxid_to_name.get, taxids, repeat("Unknown"))
+    changed.update(compress(taxids, map(ne, new_names, snapshot["names"])))
+    removed = {taxid for taxid in changed if taxid not in taxid_to_hierarchy}
+    changed.update(taxid_to_hierarchy.keys() - set(taxids))
+    return changed, removed, set(snapshot["parents"])
+
+def find_dirty_taxa(taxid_to_hierarchy, changed):
+    """
+    Return the TaxIDs of nodes.dmp whose lineage has to be rebuilt: those that
+    changed themselves or have a changed ancestor.
+    """
+    taxids = list(taxid_to_hierarchy)
+    parents = list(map(itemgetter(1), taxid_to_hierarchy.values()))
+
+    dirty = {taxid for taxid in changed if taxid in taxid_to_hierarchy}
+    # One scan of the parent column per level below the changed taxa. The
+    # root's own row never shows up in a lineage, so its subtree is left alone.
+    level = changed - {"1"}
+    while level:
+        level = set(compress(taxids, map(level.__contains__, parents))) - dirty
+        dirty |= level
+    return dirty
+
+def copy_range(source, out, start, length):
+    source.seek(start)
+    while length > 0:
+        chunk = source.read(min(length, COPY_CHUNK))
+        if not chunk:
+            break
+        out.write(chunk)
+        length -= len(chunk)
+
+def patch_hierarchy_file(hierarchy_file, temp_file, snapshot, taxid_to_hierarchy, taxid_to_name, dirty, removed):
+    """
+    Write hierarchy_file to temp_file with the dirty rows rebuilt and the
+    removed ones dropped; the rows in between are copied as byte ranges found
+    through the snapshot. New TaxIDs go last, in nodes.dmp order. The snapshot
+    columns are updated to match.
+    """
+    taxids = snapshot["taxids"]
+    row_bytes = snapshot["row_bytes"]
+    starts = list(accumulate(row_bytes, initial=len(HEADER.encode("utf-8"))))
+    position = dict(zip(taxids, range(len(taxids))))
+    touched = sorted(position[taxid] for taxid in dirty | removed if taxid in position)
+
+    with open(hierarchy_file, "rb") as source:
+        # Lineages of the unchanged parents of rebuilt taxa are read from their rows
+        known = {}
+        for taxid in {taxid_to_hierarchy[taxid][1] for taxid in dirty} - dirty:
+            if taxid in position:
+                source.seek(starts[position[taxid]])
+                row = source.read(row_bytes[position[taxid]]).decode("utf-8")
+                known[taxid] = row.rstrip("\n").split("\t", 4)[4]
+        dirty_order = list(compress(taxid_to_hierarchy, map(dirty.__contains__, taxid_to_hierarchy)))
+        lineages = dict(iter_lineages(taxid_to_hierarchy, taxid_to_name, dirty_order, known))
+
+        with open(temp_file, "wb") as out:
+            cursor = 0
+            for index in touched:
+                copy_range(source, out, cursor, starts[index] - cursor)
+                taxid = taxids[index]
+                if taxid in dirty:
+                    row = hierarchy_row(taxid, taxid_to_hierarchy, taxid_to_name, lineages[taxid])
+                    out.write(row)
+                    snapshot["names"][index] = taxid_to_name.get(taxid, "Unknown")
+                    snapshot["ranks"][index], snapshot["parents"][index] = taxid_to_hierarchy[taxid]
+                    row_bytes[index] = len(row)
+                cursor = starts[index + 1]
+            copy_range(source, out, cursor, starts[-1] - cursor)
+
+            added = [taxid for taxid in dirty_order if taxid not in position]
+            added_bytes = []
+            for taxid in added:
+                row = hierarchy_row(taxid, taxid_to_hierarchy, taxid_to_name, lineages[taxid])
+                out.write(row)
+                added_bytes.append(len(row))
+
+    if removed:
+        keep = [taxid not in removed for taxid in taxids]
+        for column in ("taxids", "names", "ranks", "parents"):
+            snapshot[column] = list(compress(snapshot[column], keep))
+        snapshot["row_bytes"] = array("Q", compress(row_bytes, keep))
+    snapshot["taxids"].extend(added)
+    snapshot["names"].extend(taxid_to_name.get(taxid, "Unknown") for taxid in added)
+    snapshot["ranks"].extend(taxid_to_hierarchy[taxid][0] for taxid in added)
+    snapshot["parents"].extend(taxid_to_hierarchy[taxid][1] for taxid in added)
+    snapshot["row_bytes"].extend(added_bytes)
+
+def remap_taxonomy_file(taxonomy_file, merged):
+    """
+    Replace merged TaxIDs in a detailed_taxonomy.tsv file with the TaxIDs they were merged into.
+    """
+    temp_file = f"{taxonomy_file}.tmp"
+    remapped = 0
+    with open(taxonomy_file, "r", newline="") as f, open(temp_file, "w", newline="") as out:
+        reader = csv.reader(f, delimiter="\t")
+        writer = csv.writer(out, delimiter="\t")
+        header = next(reader)
+        taxid_col = header.index("TaxID")
+        writer.writerow(header)
+        for row in reader:
+            if len(row) > taxid_col and row[taxid_col] in merged:
+                row[taxid_col] = merged[row[taxid_col]]
+                remapped += 1
+            writer.writerow(row)
+    os.replace(temp_file, taxonomy_file)
+    print(f"Remapped {remapped} merged TaxIDs in {taxonomy_file}")
+
+def update_taxonomy_hierarchy(names_file, nodes_file, merged_file, delnodes_file, output_file, snapshot,
+                              index_files=(), taxonomy_files=(), metrics=None):
+    """
+    Update an existing taxonomy_hierarchy.tsv for a new taxdump.
+
+    The new dump is diffed against the snapshot saved with the hierarchy
+    (see load_snapshot); an unchanged dump is detected from its fingerprint
+    alone. Lineages are rebuilt only for TaxIDs whose row or ancestors
+    changed, and every other row is copied as a byte range. Compiled indexes
+    are patched in place and merged TaxIDs are remapped in the given detailed
+    taxonomy files.
+    """
+    metrics = metrics or StageMetrics("taxonomy_hierarchy")
+
+    with metrics.stage("fingerprint_dmp"):
+        fingerprint = dump_fingerprint(names_file, nodes_file)
+    if fingerprint == snapshot["fingerprint"]:
+        print(f"{output_file} is up to date with {nodes_file}")
+        return
+
+    print("Loading data from files...")
+    with metrics.stage("parse_dmp") as parse_record:
+        taxid_to_name = parse_names_dmp(names_file)
+        taxid_to_hierarchy = parse_nodes_dmp(nodes_file)
+        merged = parse_merged_dmp(merged_file)
+        deleted = parse_delnodes_dmp(delnodes_file)
+        parse_record["taxa"] = len(taxid_to_hierarchy)
+
+    print(f"Comparing with the snapshot of {output_file}...")
+    with metrics.stage("diff_hierarchy") as diff_record:
+        changed, removed, old_parents = find_changed_taxa(snapshot, taxid_to_hierarchy, taxid_to_name)
+        dirty = find_dirty_taxa(taxid_to_hierarchy, changed)
+        diff_record["changed"] = len(changed)
+        diff_record["dirty"] = len(dirty)
+
+    print(f"{len(changed)} taxa changed ({len(removed)} removed: "
+          f"{len(removed & merged.keys())} merged, {len(removed & deleted)} deleted); "
+          f"rebuilding {len(dirty)} lineages")
+    with metrics.stage("write_hierarchy") as write_record:
+        temp_file = f"{output_file}.tmp"
+        if 2 * len(dirty) > len(taxid_to_hierarchy):
+            # Most lineages change anyway, so a plain rebuild is cheaper than patching
+            row_bytes = write_hierarchy_file(temp_file, taxid_to_hierarchy, taxid_to_name)
+            os.replace(temp_file, output_file)
+            save_full_snapshot(output_file, fingerprint, taxid_to_hierarchy, taxid_to_name, row_bytes)
+        else:
+            patch_hierarchy_file(output_file, temp_file, snapshot, taxid_to_hierarchy, taxid_to_name, dirty,
+                                 removed)
+            os.replace(temp_file, output_file)
+            save_snapshot(output_file, fingerprint, snapshot["taxids"], snapshot["names"], snapshot["ranks"],
+                          snapshot["parents"], snapshot["row_bytes"])
+
+    with metrics.stage("update_index"):
+        # Parents missing from nodes.dmp are indexed as unnamed taxa under the root
+        new_parents = set(map(itemgetter(1), taxid_to_hierarchy.values()))
+        old_placeholders = old_parents - taxid_to_hierarchy.keys() - removed
+        new_placeholders = new_parents - taxid_to_hierarchy.keys()
+        index_rows = {}
+        for taxid in changed - removed:
+            rank, parent_taxid = taxid_to_hierarchy[taxid]
+            index_rows[int(taxid)] = (taxid_to_name.get(taxid, "Unknown"), rank, int(parent_taxid))
+        for taxid in new_placeholders:
+            index_rows[int(taxid)] = ("Unknown", "", 1)
+        index_removed = [int(taxid) for taxid in (removed | old_placeholders) - new_placeholders]
+        int_merged = {int(old): int(new) for old, new in merged.items()}
+        for index_file in index_files:
+            if os.path.exists(index_file):
+                update_taxonomy_index(index_file, index_rows, index_removed, int_merged)
+        for taxonomy_file in taxonomy_files:
+            if os.path.exists(taxonomy_file):
+                remap_taxonomy_file(taxonomy_file, merged)
+
+    print(f"File updated successfully: {output_file}")
+    seconds = parse_record["wall_seconds"] + diff_record["wall_seconds"] + write_record["wall_seconds"]
+    print(f"{len(taxid_to_hierarchy)} taxa in {seconds:.1f}s (parsing {parse_record['wall_seconds']:.1f}s, "
+          f"diff {diff_record['wall_seconds']:.1f}s, lineages {write_record['wall_seconds']:.1f}s), "
+          f"peak memory {write_record['peak_rss_mb']} MB")
+
+def prune_taxonomy_hierarchy(hierarchy_file, taxonomy_file, output_file):
+    """
+    Write the rows of hierarchy_file for the TaxIDs referenced by a detailed
+    taxonomy file plus all their ancestors. Classifiers given the pruned file
+    load only the part of the tree the run's references can resolve.
+    """
+    referenced = set()
+    with open(taxonomy_file, "r", newline="") as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        for row in reader:
+            referenced.add(row["TaxID"].strip())
+
+    parents = {}
+    with open(hierarchy_file, "r", encoding="utf-8") as f:
+        f.readline()
+        for line in f:
+            taxid, _, _, parent_taxid, _ = line.split("\t", 4)
+            parents[taxid] = parent_taxid
+
+    keep = {"1"} if "1" in parents else set()
+    for taxid in referenced:
+        while taxid in parents and taxid not in keep:
+            keep.add(taxid)
+            taxid = parents[taxid]
+
+    temp_file = f"{output_file}.tmp"
+    with open(hierarchy_file, "r", encoding="utf-8") as f, open(temp_file, "w", encoding="utf-8") as out:
+        out.write(f.readline())
+        for line in f:
+            if line.split("\t", 1)[0] in keep:
+                out.write(line)
+    os.replace(temp_file, output_file)
+
+    missing = len(referenced - parents.keys())
+    print(f"Pruned hierarchy saved to {output_file}: {len(keep)} of {len(parents)} taxa for "
+          f"{len(referenced)} referenced TaxIDs ({missing} not in the hierarchy)")
+    return len(keep)
 
 if __name__ == "__main__":
     BASE_PATH = '.'
     TAXONOMY_FILES_DIR = os.path.join(BASE_PATH, 'taxonomy_files')
     DATA_DIR = os.path.join(BASE_PATH, 'data')  # Changed from 'scripts' to 'data'
-    
+
+    parser = argparse.ArgumentParser(description="Generate taxonomy_hierarchy.tsv from the NCBI taxdump, "
+                                                 "updating an existing one incrementally")
+    parser.add_argument("--taxdump-dir", default=TAXONOMY_FILES_DIR,
+                        help="Directory with names.dmp, nodes.dmp, merged.dmp and delnodes.dmp")
+    parser.add_argument("--output", default=os.path.join(DATA_DIR, 'taxonomy_hierarchy.tsv'),
+                        help="Hierarchy file to generate or update")
+    parser.add_argument("--index", nargs="*", default=[],
+                        help="Compiled taxonomy indexes to patch in place (compiled from scratch after a "
+                             "full rebuild)")
+    parser.add_argument("--taxonomy", nargs="*", default=[],
+                        help="Detailed taxonomy files whose merged TaxIDs should be remapped")
+    parser.add_argument("--full", action="store_true", help="Rebuild from scratch even if the output exists")
+    parser.add_argument("--prune", metavar="TAXONOMY_FILE",
+                        help="Instead of building, write the part of --output that this detailed "
+                             "taxonomy file references to --pruned-output")
+    parser.add_argument("--pruned-output", help="Pruned hierarchy file written by --prune")
+    parser.add_argument("--metrics", help="Append per-stage metrics as JSON lines to this file "
+                                          "(default: $HYMET_METRICS, if set)")
+    parser.add_argument("--profile", help="Write cProfile statistics to this file")
+
+    args = parser.parse_args()
+    metrics = StageMetrics("taxonomy_hierarchy", args.metrics)
+
+    if args.prune:
+        if not args.pruned_output:
+            parser.error("--prune requires --pruned-output")
+        with profiling(args.profile), metrics.stage("prune_hierarchy") as record:
+            record["taxa"] = prune_taxonomy_hierarchy(args.output, args.prune, args.pruned_output)
+        sys.exit(0)
+
     # Create data directory if it does not exist
-    if not os.path.exists(DATA_DIR):
-        os.makedirs(DATA_DIR)
-    
-    NAMES_DMP_PATH = os.path.join(TAXONOMY_FILES_DIR, 'names.dmp')
-    NODES_DMP_PATH = os.path.join(TAXONOMY_FILES_DIR, 'nodes.dmp')
-    OUTPUT_HIERARCHY_FILE_PATH = os.path.join(DATA_DIR, 'taxonomy_hierarchy.tsv')  # Changed output location
-    
+    output_dir = os.path.dirname(args.output)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    NAMES_DMP_PATH = os.path.join(args.taxdump_dir, 'names.dmp')
+    NODES_DMP_PATH = os.path.join(args.taxdump_dir, 'nodes.dmp')
+    MERGED_DMP_PATH = os.path.join(args.taxdump_dir, 'merged.dmp')
+    DELNODES_DMP_PATH = os.path.join(args.taxdump_dir, 'delnodes.dmp')
+
     # Check if files exist
     if not os.path.exists(NAMES_DMP_PATH):
         raise FileNotFoundError(f"File {NAMES_DMP_PATH} not found.")
-    
+
     if not os.path.exists(NODES_DMP_PATH):
         raise FileNotFoundError(f"File {NODES_DMP_PATH} not found.")
 
-    # Generate taxonomy hierarchy
-    generate_taxonomy_hierarchy(NAMES_DMP_PATH, NODES_DMP_PATH, OUTPUT_HIERARCHY_FILE_PATH)
\ No newline at end of file
+    with profiling(args.profile):
+        # Without a snapshot (or with a hierarchy edited since) the hierarchy is rebuilt
+        with metrics.stage("load_snapshot"):
+            snapshot = None if args.full else load_snapshot(args.output)
+        incremental = snapshot is not None
+        # Indexes that cannot be patched are compiled from the new hierarchy
+        compile_indexes = [index_file for index_file in args.index
+                           if not incremental or not os.path.exists(index_file)]
+        if incremental:
+            update_taxonomy_hierarchy(NAMES_DMP_PATH, NODES_DMP_PATH, MERGED_DMP_PATH, DELNODES_DMP_PATH,
+                                      args.output, snapshot,
+                                      [index_file for index_file in args.index if index_file not in compile_indexes],
+                                      args.taxonomy, metrics)
+        else:
+            # Generate taxonomy hierarchy
+            generate_taxonomy_hierarchy(NAMES_DMP_PATH, NODES_DMP_PATH, args.output, metrics)
+        for index_file in compile_indexes:
+            with metrics.stage("build_index") as record:
+                build_taxonomy_index(index_file, hierarchy_file=args.output)
+                record["index_bytes"] = os.path.getsize(index_file)
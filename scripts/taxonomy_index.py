@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+import os
+import sys
+import mmap
+import struct
+import logging
+import argparse
+from array import array
+from collections.abc import Mapping
+from functools import lru_cache
+
+from run_metrics import StageMetrics, profiling
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# File layout: header, section table, then 8-byte aligned sections.
+MAGIC = b"HYMETIDX"
+VERSION = 1
+HEADER = struct.Struct("<8sIIc7x")
+SECTION = struct.Struct("<8sQQ")
+
+HIERARCHY_SECTIONS = ("parents", "ranks", "names", "rankstr", "nameoff", "nameblob")
+ACCESSION_SECTIONS = ("accoff", "accblob", "acctax")
+
+NO_TAXID = -1
+ROOT_TAXID = 1
+ACCESSION_CACHE_SIZE = 1 << 16
+
+def _byteorder_flag():
+    return b"L" if sys.byteorder == "little" else b"B"
+
+def _string_table(strings):
+    """
+    Pack a list of strings into an offsets array and a UTF-8 blob.
+    """
+    offsets = array("Q", [0])
+    blob = bytearray()
+    for value in strings:
+        blob += value.encode("utf-8") if isinstance(value, str) else value
+        offsets.append(len(blob))
+    return offsets.tobytes(), bytes(blob)
+
+def compile_hierarchy_file(hierarchy_file):
+    """
+    Compile taxonomy_hierarchy.tsv into the raw hierarchy sections of the index.
+    """
+    taxids = array("i")
+    parent_ids = array("i")
+    rank_codes = array("B")
+    name_ids = array("i")
+    rank_table = {}
+    name_table = {}
+
+    with open(hierarchy_file, "r", encoding="utf-8") as f:
+        header = f.readline().rstrip("\n").split("\t")
+        columns = {column: position for position, column in enumerate(header)}
+        taxid_col = columns["TaxID"]
+        name_col = columns["Name"]
+        rank_col = columns["Rank"]
+        parent_col = columns["ParentTaxID"]
+
+        for line in f:
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) < len(header):
+                continue
+            taxids.append(int(parts[taxid_col]))
+            parent_ids.append(int(parts[parent_col]))
+            rank_codes.append(rank_table.setdefault(parts[rank_col], len(rank_table)))
+            name_ids.append(name_table.setdefault(parts[name_col], len(name_table)))
+
+    # Parents missing from the table are written by taxonomy_hierarchy.py as an
+    # unnamed, unranked node directly below the root; keep that behaviour.
+    present = set(taxids)
+    for parent in set(parent_ids) - present:
+        taxids.append(parent)
+        parent_ids.append(ROOT_TAXID)
+        rank_codes.append(rank_table.setdefault("", len(rank_table)))
+        name_ids.append(name_table.setdefault("Unknown", len(name_table)))
+
+    size = max(taxids) + 1 if taxids else ROOT_TAXID + 1
+    parents = array("i", [NO_TAXID]) * size
+    ranks = array("B", [0]) * size
+    names = array("i", [0]) * size
+    for taxid, parent, rank, name in zip(taxids, parent_ids, rank_codes, name_ids):
+        parents[taxid] = parent
+        ranks[taxid] = rank
+        names[taxid] = name
+
+    nameoff, nameblob = _string_table(name_table)
+    logging.info(f"Compiled {len(taxids)} taxa, {len(name_table)} distinct names "
+                 f"and {len(rank_table)} ranks from {hierarchy_file}")
+    return {
+        "parents": parents.tobytes(),
+        "ranks": ranks.tobytes(),
+        "names": names.tobytes(),
+        "rankstr": "\n".join(rank_table).encode("utf-8"),
+        "nameoff": nameoff,
+        "nameblob": nameblob,
+    }
+
+def compile_taxonomy_file(taxonomy_file):
+    """
+    Compile detailed_taxonomy.tsv into a sorted accession -> TaxID lookup table.
+    """
+    mapping = {}
+    with open(taxonomy_file, "r", encoding="utf-8") as f:
+        header = f.readline().rstrip("\n").split("\t")
+        taxid_col = header.index("TaxID")
+        identifiers_col = header.index("Identifiers")
+        for line in f:
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) <= max(taxid_col, identifiers_col):
+                continue
+            taxid = parts[taxid_col]
+            taxid = int(taxid) if taxid.isdigit() else NO_TAXID
+            for identifier in parts[identifiers_col].split(";"):
+                cleaned_id = identifier.strip()
+                if cleaned_id:
+                    mapping[cleaned_id.encode("utf-8")] = taxid
+
+    accessions = sorted(mapping)
+    accoff, accblob = _string_table(accessions)
+    logging.info(f"Compiled {len(accessions)} accession mappings from {taxonomy_file}")
+    return {
+        "accoff": accoff,
+        "accblob": accblob,
+        "acctax": array("i", (mapping[accession] for accession in accessions)).tobytes(),
+    }
+
+def write_index(sections, output_file):
+    """
+    Write the sections to output_file atomically.
+    """
+    names = list(sections)
+    offset = HEADER.size + SECTION.size * len(names)
+    table = []
+    for name in names:
+        offset += -offset % 8
+        table.append((name, offset, len(sections[name])))
+        offset += len(sections[name])
+
+    temp_file = f"{output_file}.tmp"
+    with open(temp_file, "wb") as out:
+        out.write(HEADER.pack(MAGIC, VERSION, len(names), _byteorder_flag()))
+        for name, section_offset, length in table:
+            out.write(SECTION.pack(name.encode("ascii"), section_offset, length))
+        for name, section_offset, _ in table:
+            out.write(b"\0" * (section_offset - out.tell()))
+            out.write(sections[name])
+    os.replace(temp_file, output_file)
+
+def read_sections(index_file, names=None):
+    """
+    Read raw section bytes from an existing index (used to relink accessions).
+    """
+    with open(index_file, "rb") as f:
+        data = f.read()
+    table = _parse_section_table(data, index_file)
+    wanted = names if names is not None else table.keys()
+    return {name: bytes(data[table[name][0]:table[name][0] + table[name][1]]) for name in wanted}
+
+def _parse_section_table(buffer, index_file):
+    magic, version, count, byteorder = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{index_file} is not a HYMET taxonomy index (version {VERSION})")
+    if byteorder != _byteorder_flag():
+        raise ValueError(f"{index_file} was built on a machine with a different byte order")
+    table = {}
+    for position in range(count):
+        name, offset, length = SECTION.unpack_from(buffer, HEADER.size + position * SECTION.size)
+        table[name.rstrip(b"\0").decode("ascii")] = (offset, length)
+    return table
+
+def build_taxonomy_index(output_file, hierarchy_file=None, taxonomy_file=None, base_index=None):
+    """
+    Build a taxonomy index from taxonomy_hierarchy.tsv (or the hierarchy sections
+    of base_index) plus, optionally, the accession table of detailed_taxonomy.tsv.
+    """
+    if base_index:
+        sections = read_sections(base_index, HIERARCHY_SECTIONS)
+    elif hierarchy_file:
+        sections = compile_hierarchy_file(hierarchy_file)
+    else:
+        raise ValueError("Either a hierarchy file or a base index is required")
+
+    if taxonomy_file:
+        sections.update(compile_taxonomy_file(taxonomy_file))
+    else:
+        sections.update({"accoff": array("Q", [0]).tobytes(), "accblob": b"", "acctax": b""})
+
+    write_index(sections, output_file)
+    logging.info(f"Taxonomy index saved to {output_file}")
+
+def update_hierarchy_sections(sections, rows, removed=()):
+    """
+    Patch the hierarchy sections of an index with changed rows, given as
+    {taxid: (name, rank, parent_taxid)} with integer TaxIDs, and with removed
+    TaxIDs, instead of recompiling the whole hierarchy. New names are appended
+    to the name table; names no longer referenced are left in it.
+    """
+    parents = array("i", sections["parents"])
+    ranks = array("B", sections["ranks"])
+    names = array("i", sections["names"])
+    nameoff = array("Q", sections["nameoff"])
+    nameblob = bytearray(sections["nameblob"])
+    rank_table = {rank: code for code, rank in enumerate(sections["rankstr"].decode("utf-8").split("\n"))}
+    name_table = {}
+
+    size = max(rows, default=0) + 1
+    if size > len(parents):
+        parents.extend(array("i", [NO_TAXID]) * (size - len(parents)))
+        ranks.extend(array("B", [0]) * (size - len(ranks)))
+        names.extend(array("i", [0]) * (size - len(names)))
+
+    for taxid in removed:
+        if 0 <= taxid < len(parents):
+            parents[taxid] = NO_TAXID
+            ranks[taxid] = 0
+            names[taxid] = 0
+
+    for taxid, (name, rank, parent) in rows.items():
+        if rank not in rank_table:
+            if len(rank_table) > 255:
+                raise ValueError("The index supports at most 256 distinct ranks")
+            rank_table[rank] = len(rank_table)
+        if name not in name_table:
+            name_table[name] = len(nameoff) - 1
+            nameblob += name.encode("utf-8")
+            nameoff.append(len(nameblob))
+        parents[taxid] = parent
+        ranks[taxid] = rank_table[rank]
+        names[taxid] = name_table[name]
+
+    sections.update({
+        "parents": parents.tobytes(),
+        "ranks": ranks.tobytes(),
+        "names": names.tobytes(),
+        "rankstr": "\n".join(rank_table).encode("utf-8"),
+        "nameoff": nameoff.tobytes(),
+        "nameblob": bytes(nameblob),
+    })
+    logging.info(f"Patched {len(rows)} taxa and removed {len(removed)} from the index hierarchy")
+
+def remap_accession_taxids(sections, merged):
+    """
+    Point accessions mapped to a merged TaxID at the TaxID it was merged into.
+    Returns the number of accessions remapped.
+    """
+    acctax = array("i", sections["acctax"])
+    remapped = 0
+    for position, taxid in enumerate(acctax):
+        if taxid in merged:
+            acctax[position] = merged[taxid]
+            remapped += 1
+    sections["acctax"] = acctax.tobytes()
+    return remapped
+
+def update_taxonomy_index(index_file, rows, removed=(), merged=None):
+    """
+    Apply an incremental hierarchy update (see update_hierarchy_sections) and
+    merged TaxIDs ({old: new}) to an existing index, replacing it atomically.
+    The accession table is kept.
+    """
+    sections = read_sections(index_file)
+    update_hierarchy_sections(sections, rows, removed)
+    if merged:
+        remapped = remap_accession_taxids(sections, merged)
+        if remapped:
+            logging.info(f"Remapped {remapped} accessions from merged TaxIDs")
+    write_index(sections, index_file)
+    logging.info(f"Taxonomy index updated in place: {index_file}")
+
+class TaxonomyIndex:
+    """
+    Read-only, memory-mapped view of a compiled taxonomy index.
+
+    Arrays are indexed directly by TaxID, so parent, rank and name lookups are
+    O(1); lineage strings are only built when requested.
+    """
+
+    def __init__(self, index_file):
+        self.path = os.path.abspath(index_file)
+        self._file = open(self.path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buffer = memoryview(self._mmap)
+        table = _parse_section_table(self._buffer, self.path)
+
+        def section(name, typecode=None):
+            offset, length = table[name]
+            view = self._buffer[offset:offset + length]
+            return view.cast(typecode) if typecode else view
+
+        self._parents = section("parents", "i")
+        self._ranks = section("ranks", "B")
+        self._names = section("names", "i")
+        self._name_offsets = section("nameoff", "Q")
+        self._name_blob = section("nameblob")
+        self._acc_offsets = section("accoff", "Q")
+        self._acc_blob = section("accblob")
+        self._acc_taxids = section("acctax", "i")
+        self.rank_names = bytes(section("rankstr")).decode("utf-8").split("\n")
+
+        self.taxid_for_accession = lru_cache(maxsize=ACCESSION_CACHE_SIZE)(self._lookup_accession)
+        self.accessions = AccessionView(self)
+        self.lineages = LineageView(self)
+        self.parents = ParentView(self)
+        self.ranks = RankView(self)
+        self.names = NameView(self)
+
+    def close(self):
+        for view in (self._parents, self._ranks, self._names, self._name_offsets, self._name_blob,
+                     self._acc_offsets, self._acc_blob, self._acc_taxids, self._buffer):
+            view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __reduce__(self):
+        return (open_taxonomy_index, (self.path,))
+
+    def __contains__(self, taxid):
+        return 0 <= taxid < len(self._parents) and self._parents[taxid] != NO_TAXID
+
+    def __len__(self):
+        return len(self._parents)
+
+    def parent(self, taxid):
+        return self._parents[taxid]
+
+    def rank(self, taxid):
+        return self.rank_names[self._ranks[taxid]]
+
+    def name(self, taxid):
+        name_id = self._names[taxid]
+        start, end = self._name_offsets[name_id], self._name_offsets[name_id + 1]
+        return bytes(self._name_blob[start:end]).decode("utf-8")
+
+    def lineage(self, taxid):
+        lineage = []
+        current_taxid = taxid
+        while current_taxid != ROOT_TAXID:
+            lineage.append(f"{self.rank(current_taxid)}:{self.name(current_taxid)}")
+            current_taxid = self._parents[current_taxid]
+        lineage.reverse()
+        return ";".join(lineage)
+
+    def accession_count(self):
+        return len(self._acc_offsets) - 1
+
+    def _accession_key(self, position):
+        return bytes(self._acc_blob[self._acc_offsets[position]:self._acc_offsets[position + 1]])
+
+    def _lookup_accession(self, accession):
+        key = accession.encode("utf-8")
+        low, high = 0, self.accession_count()
+        while low < high:
+            middle = (low + high) // 2
+            if self._accession_key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.accession_count() and self._accession_key(low) == key:
+            return self._acc_taxids[low]
+        return None
+
+class AccessionView(Mapping):
+    """
+    Accession -> TaxID string mapping, a drop-in for load_taxonomy_file().
+    """
+
+    def __init__(self, index):
+        self._index = index
+
+    def __reduce__(self):
+        return (_index_attribute, (self._index.path, "accessions"))
+
+    def __getitem__(self, accession):
+        taxid = self._index.taxid_for_accession(accession)
+        if taxid is None:
+            raise KeyError(accession)
+        return str(taxid)
+
+    def __contains__(self, accession):
+        return self._index.taxid_for_accession(accession) is not None
+
+    def __iter__(self):
+        for position in range(self._index.accession_count()):
+            yield self._index._accession_key(position).decode("utf-8")
+
+    def __len__(self):
+        return self._index.accession_count()
+
+class LineageView(Mapping):
+    """
+    TaxID string -> lineage mapping, a drop-in for load_taxonomy_hierarchy_file().
+    """
+
+    def __init__(self, index):
+        self._index = index
+
+    def __reduce__(self):
+        return (_index_attribute, (self._index.path, "lineages"))
+
+    @staticmethod
+    def _taxid(key):
+        try:
+            return int(key)
+        except (TypeError, ValueError):
+            return NO_TAXID
+
+    def _value(self, taxid):
+        return self._index.lineage(taxid)
+
+    def __getitem__(self, taxid):
+        numeric_taxid = self._taxid(taxid)
+        if numeric_taxid not in self._index:
+            raise KeyError(taxid)
+        return self._value(numeric_taxid)
+
+    def __contains__(self, taxid):
+        return self._taxid(taxid) in self._index
+
+    def __iter__(self):
+        for taxid in range(len(self._index)):
+            if taxid in self._index:
+                yield str(taxid)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+class ParentView(LineageView):
+    """
+    TaxID string -> parent TaxID string mapping (the ParentTaxID column).
+    """
+
+    def __reduce__(self):
+        return (_index_attribute, (self._index.path, "parents"))
+
+    def _value(self, taxid):
+        return str(self._index.parent(taxid))
+
+class RankView(LineageView):
+    """
+    TaxID string -> rank mapping (the Rank column).
+    """
+
+    def __reduce__(self):
+        return (_index_attribute, (self._index.path, "ranks"))
+
+    def _value(self, taxid):
+        return self._index.rank(taxid)
+
+class NameView(LineageView):
+    """
+    TaxID string -> scientific name mapping (the Name column).
+    """
+
+    def __reduce__(self):
+        return (_index_attribute, (self._index.path, "names"))
+
+    def _value(self, taxid):
+        return self._index.name(taxid)
+
+_open_indexes = {}
+
+def open_taxonomy_index(index_file):
+    """
+    Open (once per process) a memory-mapped taxonomy index.
+    """
+    path = os.path.abspath(index_file)
+    if path not in _open_indexes:
+        _open_indexes[path] = TaxonomyIndex(path)
+    return _open_indexes[path]
+
+def _index_attribute(index_file, attribute):
+    return getattr(open_taxonomy_index(index_file), attribute)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile HYMET taxonomy files into a memory-mappable index")
+    parser.add_argument("--hierarchy", help="Taxonomy hierarchy file (taxonomy_hierarchy.tsv)")
+    parser.add_argument("--base-index", help="Existing index to take the hierarchy from instead of --hierarchy")
+    parser.add_argument("--taxonomy", help="Taxonomy mapping file (detailed_taxonomy.tsv)")
+    parser.add_argument("--output", required=True, help="Output index file")
+    parser.add_argument("--metrics", help="Append per-stage metrics as JSON lines to this file "
+                                          "(default: $HYMET_METRICS, if set)")
+    parser.add_argument("--profile", help="Write cProfile statistics to this file")
+
+    args = parser.parse_args()
+
+    if not args.hierarchy and not args.base_index:
+        parser.error("one of --hierarchy or --base-index is required")
+
+    metrics = StageMetrics("taxonomy_index", args.metrics)
+    with profiling(args.profile), metrics.stage("build_index") as record:
+        build_taxonomy_index(args.output, args.hierarchy, args.taxonomy, args.base_index)
+        record["index_bytes"] = os.path.getsize(args.output)
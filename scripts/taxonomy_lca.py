@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+ROOT_TAXID = "1"
+
+class TaxonomyLCA:
+    """
+    Constant-time lowest common ancestor queries on the NCBI parent tree.
+
+    Only the subtree spanned by the given TaxIDs and their ancestors is
+    indexed. Preprocessing builds an Euler tour of that subtree and a sparse
+    table over the tour depths, so every pairwise LCA is two table lookups and
+    ancestor tests are interval checks on the tour positions.
+    """
+
+    def __init__(self, parents, taxids):
+        # parents: mapping TaxID -> parent TaxID (strings, as in taxonomy_hierarchy.tsv)
+        self.node_ids = {ROOT_TAXID: 0}
+        self.taxids = [ROOT_TAXID]
+        children = [[]]
+
+        for taxid in taxids:
+            path = []
+            current = taxid
+            while current not in self.node_ids:
+                if current not in parents or current in path:
+                    break
+                path.append(current)
+                current = parents[current]
+            # TaxIDs without a known path to the root hang from the root
+            parent_id = self.node_ids.get(current, 0)
+            for node in reversed(path):
+                node_id = self.node_ids[node] = len(self.taxids)
+                self.taxids.append(node)
+                children.append([])
+                children[parent_id].append(node_id)
+                parent_id = node_id
+
+        self._build_euler_tour(children)
+        self._build_sparse_table()
+
+    def _build_euler_tour(self, children):
+        node_count = len(self.taxids)
+        self.first = [0] * node_count
+        self.last = [0] * node_count
+        self.depth = [0] * node_count
+        self.euler = []
+
+        stack = [(0, 0)]
+        while stack:
+            node, child_position = stack.pop()
+            if child_position == 0:
+                self.first[node] = len(self.euler)
+            self.euler.append(node)
+            if child_position < len(children[node]):
+                child = children[node][child_position]
+                self.depth[child] = self.depth[node] + 1
+                stack.append((node, child_position + 1))
+                stack.append((child, 0))
+            else:
+                self.last[node] = len(self.euler) - 1
+
+    def _build_sparse_table(self):
+        depth = self.depth
+        level = list(self.euler)
+        self.table = [level]
+        span = 1
+        while 2 * span <= len(self.euler):
+            previous = level
+            level = [
+                left if depth[left] <= depth[right] else right
+                for left, right in zip(previous, previous[span:])
+            ]
+            self.table.append(level)
+            span *= 2
+
+    def __contains__(self, taxid):
+        return taxid in self.node_ids
+
+    def _lca_ids(self, a, b):
+        left, right = self.first[a], self.first[b]
+        if left > right:
+            left, right = right, left
+        level = (right - left + 1).bit_length() - 1
+        row = self.table[level]
+        x, y = row[left], row[right - (1 << level) + 1]
+        return x if self.depth[x] <= self.depth[y] else y
+
+    def lca(self, taxid_a, taxid_b):
+        return self.taxids[self._lca_ids(self.node_ids[taxid_a], self.node_ids[taxid_b])]
+
+    def lca_of(self, taxids):
+        node_ids = [self.node_ids[taxid] for taxid in taxids]
+        if not node_ids:
+            return None
+        # The LCA of a set is the LCA of its leftmost and rightmost nodes in the tour
+        leftmost = min(node_ids, key=self.first.__getitem__)
+        rightmost = max(node_ids, key=self.first.__getitem__)
+        return self.taxids[self._lca_ids(leftmost, rightmost)]
+
+    def is_ancestor(self, ancestor, taxid):
+        ancestor_id, node_id = self.node_ids[ancestor], self.node_ids[taxid]
+        return self.first[ancestor_id] <= self.first[node_id] <= self.last[ancestor_id]
+
+    def weighted_lca(self, taxid_weights, total_weight, min_fraction=0.0):
+        """
+        LCA of the TaxIDs holding at least min_fraction of total_weight.
+
+        Returns (taxid, support), where support is the fraction of the total
+        weight placed on the LCA or below it, or (None, 0.0).
+        """
+        if total_weight == 0:
+            return None, 0.0
+
+        candidates = [taxid for taxid, weight in taxid_weights.items()
+                      if taxid in self.node_ids and weight / total_weight >= min_fraction]
+        if not candidates:
+            return None, 0.0
+
+        ancestor = self.lca_of(candidates)
+        support = sum(weight for taxid, weight in taxid_weights.items()
+                      if taxid in self.node_ids and self.is_ancestor(ancestor, taxid))
+        return ancestor, support / total_weight
@@ -0,0 +1,129 @@
+import io
+import os
+import sys
+import gzip
+import threading
+from functools import partial
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+
+from bench_download import RangeHandler, generate_genomes  # also puts scripts/ on sys.path
+import downloadDB
+from downloadDB import ErroRetomada, GenomeDownloader, HTTPConnectionPool
+
+INTERRUPT_BYTES = 4096
+
+class RecordingHandler(RangeHandler):
+    """
+    RangeHandler that records the Range header of every genome request. With
+    honour_range off it answers Range requests with the whole file (200), and
+    with corrupt_first it serves another valid gzip on a genome's first transfer.
+    """
+    honour_range = True
+    corrupt_first = False
+
+    def send_head(self):
+        genome = self.path.endswith(".fna.gz")
+        if genome:
+            with self.lock:
+                self.ranges.append(self.headers.get("Range"))
+        if not self.honour_range:
+            del self.headers["Range"]
+        if genome and self.corrupt_first:
+            with self.lock:
+                first = self.path not in self.corrupted
+                self.corrupted.add(self.path)
+            if first:
+                body = gzip.compress(b">NZ_99999999.1 other\nACGT\n")
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                return io.BytesIO(body)
+        return super().send_head()
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+    """
+    Returns a function that starts a local server for one synthetic genome with
+    the given handler attributes, and returns (downloader, accession, handler).
+    """
+    monkeypatch.setattr(downloadDB, "sleep", lambda seconds: None)
+    servers = []
+
+    def start(**attributes):
+        handler = type("Handler", (RecordingHandler,),
+                       dict(ranges=[], interrupted=set(), corrupted=set(), **attributes))
+        server = ThreadingHTTPServer(("127.0.0.1", 0), partial(handler, directory=str(tmp_path)))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        accession, = generate_genomes(str(tmp_path), f"http://127.0.0.1:{server.server_address[1]}", 1, 64)
+        output_dir = tmp_path / "out"
+        output_dir.mkdir()
+        downloader = GenomeDownloader(str(output_dir), str(tmp_path / "cache"))
+        downloader.assembly_data.carregar([accession])
+        return downloader, accession, handler
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def genome_url(downloader, accession):
+    ftp_path = downloader.assembly_data.get(accession)["ftp_path"]
+    return f"{ftp_path}/{os.path.basename(ftp_path)}_genomic.fna.gz"
+
+def assert_downloaded(downloader, accession):
+    metadata = downloader.assembly_data.get(accession)
+    fna_path = os.path.join(downloader.output_dir, metadata["file_name"])
+    served = os.path.join(os.path.dirname(downloader.output_dir), "genomes", os.path.basename(metadata["ftp_path"]),
+                          os.path.basename(genome_url(downloader, accession)))
+    with gzip.open(served, "rb") as f, open(fna_path, "rb") as fna:
+        assert fna.read() == f.read()
+    assert not os.path.exists(f"{fna_path}.part")
+    genome, = downloader.manifest.genomas()
+    assert genome["verified"]
+
+def test_short_body_raises(site):
+    downloader, accession, _ = site(interrupt_bytes=INTERRUPT_BYTES)
+    with pytest.raises(IOError, match="Resposta incompleta"):
+        HTTPConnectionPool().baixar(genome_url(downloader, accession), io.BytesIO())
+
+def test_ignored_range_raises(site):
+    downloader, accession, _ = site(honour_range=False)
+    with pytest.raises(ErroRetomada):
+        HTTPConnectionPool().baixar(genome_url(downloader, accession), io.BytesIO(), inicio=100)
+
+def test_interrupted_download_resumes(site):
+    downloader, accession, handler = site(interrupt_bytes=INTERRUPT_BYTES)
+    assert downloader.baixar_genoma(accession)
+    assert handler.ranges == [None, f"bytes={INTERRUPT_BYTES}-"]
+    assert_downloaded(downloader, accession)
+
+def test_ignored_range_restarts_from_zero(site):
+    downloader, accession, handler = site(interrupt_bytes=INTERRUPT_BYTES, honour_range=False)
+    assert downloader.baixar_genoma(accession)
+    assert handler.ranges == [None, f"bytes={INTERRUPT_BYTES}-", None]
+    assert_downloaded(downloader, accession)
+
+def test_md5_mismatch_discards_and_retries(site):
+    downloader, accession, handler = site(corrupt_first=True)
+    assert downloader.baixar_genoma(accession)
+    assert handler.ranges == [None, None]
+    assert_downloaded(downloader, accession)
+
+def test_md5_mismatch_gives_up(site, tmp_path):
+    downloader, accession, handler = site()
+    metadata = downloader.assembly_data.get(accession)
+    checksums = tmp_path / "genomes" / os.path.basename(metadata["ftp_path"]) / "md5checksums.txt"
+    name = checksums.read_text().split()[1]
+    checksums.write_text(f"{'0' * 32}  {name}\n")
+
+    assert not downloader.baixar_genoma(accession)
+    assert handler.ranges == [None] * downloadDB.RETRIES
+    fna_path = os.path.join(downloader.output_dir, metadata["file_name"])
+    assert not os.path.exists(fna_path) and not os.path.exists(f"{fna_path}.part")
+    assert downloader.manifest.genomas() == []